@@ -0,0 +1,56 @@
+"""
+Checks that concurrent completions overlap instead of queueing behind each other.
+
+Sends N requests at once through CompletionClient to a local fake endpoint with a fixed latency, and compares the
+total time with the latency of a single request. With a non-blocking client this ratio stays close to 1 as long as
+N is within the client's concurrency limit.
+
+Run from the repository root with ``python -m Benchmarks.concurrent_completions [--requests 8] [--latency 0.5]``.
+"""
+import argparse
+import asyncio
+import time
+
+from Benchmarks.fake_openai import FakeOpenAIServer
+from CompletionClient import CompletionClient
+
+
+async def run(requests, latency, max_concurrent_requests):
+    server = FakeOpenAIServer(latency=latency)
+    await server.start()
+    client = CompletionClient("fake-key", "gpt-4o", max_concurrent_requests=max_concurrent_requests,
+                              base_url=server.base_url)
+    chain = [{"role": "system", "content": "You are a bot"}, {"role": "user", "content": "someone: hello"}]
+    try:
+        start = time.perf_counter()
+        await client.create(chain)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(client.create(chain) for _ in range(requests)))
+        concurrent = time.perf_counter() - start
+    finally:
+        await client.close()
+        await server.stop()
+
+    errors = [error for _, error in results if error]
+    print(f"1 request: {single:.2f}s, {requests} concurrent requests: {concurrent:.2f}s "
+          f"({concurrent / single:.2f}x a single request), {len(errors)} errors")
+    return concurrent / single
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=8, help="The number of concurrent requests")
+    parser.add_argument("--latency", type=float, default=0.5, help="The fake endpoint latency in seconds")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="The client's concurrency limit")
+    args = parser.parse_args()
+    ratio = asyncio.run(run(args.requests, args.latency, args.max_concurrent))
+    # The requests should overlap, allow some slack for connection setup
+    expected = -(-args.requests // args.max_concurrent)
+    if ratio > expected * 1.5:
+        raise SystemExit(f"Requests did not run concurrently: expected about {expected}x, got {ratio:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
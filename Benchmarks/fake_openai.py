@@ -0,0 +1,131 @@
+"""
+A local stand-in for the OpenAI chat completions endpoint, for benchmarks.
+
+It speaks just enough HTTP/1.1 (with keep-alive) for the OpenAI client, waits a configurable latency before
+answering, and can answer with a canned tool call instead of text, or with a rate limit error.
+"""
+import asyncio
+import json
+import random
+import time
+
+
+class FakeOpenAIServer:
+    """Serves /v1/chat/completions on localhost with a fixed latency."""
+    def __init__(self, latency=0.5, jitter=0.0, tool_call_rate=0.0, tool_calls=None, stream_chunks=20,
+                 rate_limit_rate=0.0):
+        """
+        :param latency: The time to wait before answering each request, in seconds.
+        :param jitter: A random extra delay of up to this many seconds.
+        :param tool_call_rate: The fraction of requests answered with a tool call, if the request offered tools.
+        :param tool_calls: The canned tool calls to answer with, as (name, arguments) pairs.
+        :param stream_chunks: The number of chunks a streamed answer is split into.
+        :param rate_limit_rate: The fraction of requests answered with a 429 rate limit error.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.tool_call_rate = tool_call_rate
+        self.tool_calls = tool_calls or [("python", json.dumps({"command": "print(2 ** 64)"}))]
+        self.stream_chunks = stream_chunks
+        self.rate_limit_rate = rate_limit_rate
+        self.requests = 0
+        self.rate_limited = 0
+        self.server = None
+        self.port = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle_connection, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self.respond(writer, json.loads(body) if body else {})
+        except (ConnectionResetError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, request):
+        self.requests += 1
+        await asyncio.sleep(self.latency + random.random() * self.jitter)
+
+        if random.random() < self.rate_limit_rate:
+            self.rate_limited += 1
+            payload = json.dumps({"error": {"message": "Rate limit reached", "type": "requests",
+                                            "code": "rate_limit_exceeded"}}).encode()
+            writer.write(b"HTTP/1.1 429 Too Many Requests\r\nContent-Type: application/json\r\nRetry-After: 0\r\n"
+                         b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+            await writer.drain()
+            return
+
+        message = {"role": "assistant", "content": f"Reply to {len(request.get('messages', []))} messages"}
+        finish_reason = "stop"
+        # Never answer a tool result with another tool call, so tool loops terminate
+        last_role = request.get("messages", [{}])[-1].get("role")
+        if request.get("tools") and last_role != "tool" and random.random() < self.tool_call_rate:
+            name, arguments = random.choice(self.tool_calls)
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{self.requests}", "type": "function", "function": {"name": name, "arguments": arguments}
+            }]}
+            finish_reason = "tool_calls"
+
+        if request.get("stream"):
+            await self.respond_streaming(writer, request, message, finish_reason)
+            return
+
+        payload = json.dumps({
+            "id": f"chatcmpl-{self.requests}", "object": "chat.completion", "created": int(time.time()),
+            "model": request.get("model", "fake"),
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 10, "total_tokens": 20},
+        }).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                     b"Content-Length: " + str(len(payload)).encode() + b"\r\n\r\n" + payload)
+        await writer.drain()
+
+    async def respond_streaming(self, writer, request, message, finish_reason):
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n")
+
+        def chunk(delta, finish=None):
+            data = json.dumps({
+                "id": f"chatcmpl-{self.requests}", "object": "chat.completion.chunk", "created": int(time.time()),
+                "model": request.get("model", "fake"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish}],
+            })
+            event = f"data: {data}\n\n".encode()
+            return f"{len(event):x}\r\n".encode() + event + b"\r\n"
+
+        if message.get("tool_calls"):
+            call = message["tool_calls"][0]
+            writer.write(chunk({"role": "assistant", "tool_calls": [{"index": 0, **call}]}))
+        else:
+            content = message["content"] + " " + "lorem ipsum " * 200
+            size = max(len(content) // self.stream_chunks, 1)
+            for start in range(0, len(content), size):
+                writer.write(chunk({"content": content[start:start + size]}))
+                await writer.drain()
+                await asyncio.sleep(self.latency / self.stream_chunks)
+        writer.write(chunk({}, finish_reason))
+        event = b"data: [DONE]\n\n"
+        writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n0\r\n\r\n")
+        await writer.drain()
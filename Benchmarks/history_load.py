@@ -0,0 +1,102 @@
+"""
+Compares startup time and peak memory of loading a large message_history.json with json.load against the streaming
+snapshot reader used by DictMessageStore.
+
+Run from the repository root with ``python -m Benchmarks.history_load [--size-mb 100] [--recent 0.1]``.
+"""
+import argparse
+import gc
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from MessageNode import MessageNode
+from SnapshotReader import iter_snapshot
+
+
+def write_history(file_path, size_mb, recent_fraction):
+    """
+    Write a synthetic history file of roughly size_mb megabytes.
+    A recent_fraction of the messages are from the last day, the rest are a month old.
+    :return: The number of messages written.
+    """
+    now = time.time()
+    target_bytes = size_mb * 1024 * 1024
+    written = 0
+    count = 0
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write("{")
+        while written < target_bytes:
+            age = 86400 if (count * recent_fraction) % 1 + recent_fraction >= 1 else 30 * 86400
+            message_id = 1_200_000_000_000_000_000 + count
+            record = {"message_id": message_id, "role": "user" if count % 2 else "assistant",
+                      "content": f"Some user: message number {count} with a little bit of padding text",
+                      "timestamp": now - age, "parent_id": message_id - 1 if count % 4 else None, "tool_call": None}
+            line = f"{',' if count else ''}\n{json.dumps(str(message_id))}: {json.dumps(record)}"
+            file.write(line)
+            written += len(line)
+            count += 1
+        file.write("\n}")
+    return count
+
+
+def load_with_json_load(file_path):
+    """The loader used before streaming: parse everything, then filter with datetime.fromtimestamp."""
+    messages = {}
+    one_week_ago = datetime.now() - timedelta(weeks=1)
+    with open(file_path, 'r') as file:
+        data = json.load(file)
+        for mdata in data.values():
+            if datetime.fromtimestamp(mdata["timestamp"]) > one_week_ago:
+                messages[mdata["message_id"]] = MessageNode.from_dict(mdata)
+    return messages
+
+
+def load_streaming(file_path):
+    """The streaming loader, filtering on the raw timestamp."""
+    messages = {}
+    one_week_ago = (datetime.now() - timedelta(weeks=1)).timestamp()
+    for mdata in iter_snapshot(file_path, min_timestamp=one_week_ago):
+        node = MessageNode.from_dict(mdata)
+        messages[node.message_id] = node
+    return messages
+
+
+def measure(loader, file_path):
+    """
+    :return: A tuple of load time in seconds, peak traced memory in bytes and the number of messages retained.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    retained = len(loader(file_path))
+    load_time = time.perf_counter() - start
+
+    gc.collect()
+    tracemalloc.start()
+    loader(file_path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return load_time, peak, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--size-mb", type=int, default=100, help="The size of the synthetic history file")
+    parser.add_argument("--recent", type=float, default=0.1, help="The fraction of messages within the cutoff")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, "message_history.json")
+        count = write_history(file_path, args.size_mb, args.recent)
+        print(f"History file: {os.path.getsize(file_path) / 2 ** 20:.0f} MB, {count:,} messages")
+
+        for name, loader in [("json.load", load_with_json_load), ("streaming", load_streaming)]:
+            load_time, peak, retained = measure(loader, file_path)
+            print(f"{name:>10}: {load_time:6.2f} s, peak {peak / 2 ** 20:7.1f} MB, {retained:,} messages retained")
+
+
+if __name__ == "__main__":
+    main()
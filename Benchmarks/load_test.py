@@ -0,0 +1,376 @@
+"""
+Measures how many messages per second the bot sustains, end to end.
+
+Drives ClydesBrother.on_message with synthetic Discord messages at a fixed arrival rate: mentions, replies to the
+bot's earlier replies, ``prompt:`` and ``imitator:`` prefixes, and chatter the bot ignores. The OpenAI endpoint is the
+local FakeOpenAIServer, which answers some requests with a canned Python tool call. Docker and the imitator model are
+replaced by stand-ins with a fixed run time, and the bot runs in a temporary directory with a throwaway secrets.json
+and message database.
+
+Reports the throughput, the p50 and p99 latency of every stage, and the lag of the event loop. A blocked event loop
+shows up as lag, and as every stage slowing down together.
+
+Run from the repository root with ``python -m Benchmarks.load_test [--rate 20] [--duration 30] [--latency 0.5]``.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import types
+
+from Benchmarks.fake_openai import FakeOpenAIServer
+from Metrics import Metrics, metrics
+from OutputCapture import OutputCapture
+from SandboxUsage import EXIT_OK, RunUsage
+
+# Stages recorded by the bot itself, in the shared metrics registry
+BOT_STAGES = ["messages.build_chain", "scheduler.wait", "openai.first_token", "openai.latency",
+              "discord.first_visible_token", "tools.python"]
+
+ids = itertools.count(10 ** 17)
+
+
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.display_name = name
+        self.mention = f"<@{user_id}>"
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+    def typing(self):
+        return FakeTyping()
+
+    async def send(self, content):
+        return FakeMessage(content, BOT_USER, self)
+
+
+class FakeReference:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class FakeMessage:
+    """Just enough of discord.Message for the bot's handlers."""
+    def __init__(self, content, author, channel, reply_to=None, mentions=()):
+        self.id = next(ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.reference = FakeReference(reply_to.id) if reply_to else None
+        self.mentions = list(mentions)
+        self.reply_to = reply_to
+
+    async def reply(self, content, file=None):
+        await asyncio.sleep(DISCORD_LATENCY)
+        sent_message = FakeMessage(content, BOT_USER, self.channel, reply_to=self)
+        harness.record_reply(self, sent_message)
+        return sent_message
+
+    async def edit(self, content):
+        await asyncio.sleep(DISCORD_LATENCY)
+        self.content = content
+
+    async def delete(self):
+        await asyncio.sleep(DISCORD_LATENCY)
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(DISCORD_LATENCY)
+
+
+BOT_USER = FakeUser(1, "ClydesBrother")
+DISCORD_LATENCY = 0.0
+
+
+class LoadTest:
+    """Sends the synthetic messages and times how long the bot takes to answer them."""
+    def __init__(self, bot, rate, duration, users, channels, mix):
+        self.bot = bot
+        self.rate = rate
+        self.duration = duration
+        self.users = [FakeUser(1000 + i, f"user{i}") for i in range(users)]
+        self.channels = [FakeChannel(2000 + i) for i in range(channels)]
+        self.mix = mix
+        self.timings = Metrics(max_samples=1_000_000)
+        self.sent_at = {}  # message ID -> time the message was sent
+        self.answered = set()
+        self.bot_replies = []  # Recent final replies from the bot that users can reply to
+        self.sent = 0
+        self.expected = 0
+        self.superseded = 0  # Batches cancelled for a newer message, which are answered again with it
+        self.failed = 0  # Messages the bot gave up on without replying
+
+    def record_reply(self, original_message, sent_message):
+        sent_at = self.sent_at.get(original_message.id)
+        if sent_at is None:
+            return
+        if original_message.id not in self.answered:
+            self.answered.add(original_message.id)
+            self.timings.observe("first_reply", time.perf_counter() - sent_at)
+
+    def record_done(self, messages):
+        """Record a batch the bot finished with, as answered if it replied to the batch's latest message."""
+        delivered = messages[-1].id in self.answered
+        now = time.perf_counter()
+        for message in messages:
+            sent_at = self.sent_at.pop(message.id, None)
+            if sent_at is None:
+                continue
+            if delivered:
+                self.timings.observe("end_to_end", now - sent_at)
+            else:
+                self.failed += 1
+
+    def record_failed(self, messages):
+        for message in messages:
+            if self.sent_at.pop(message.id, None) is not None:
+                self.failed += 1
+
+    def next_message(self):
+        user = random.choice(self.users)
+        channel = random.choice(self.channels)
+        kind = random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        if kind == "reply" and not self.bot_replies:
+            kind = "mention"
+
+        if kind == "mention":
+            return kind, FakeMessage(f"{BOT_USER.mention} what is {random.randint(1, 100)} squared?", user, channel,
+                                     mentions=[BOT_USER])
+        if kind == "reply":
+            reply_to = random.choice(self.bot_replies)
+            return kind, FakeMessage("and what about cubed?", user, reply_to.channel, reply_to=reply_to)
+        if kind == "prompt":
+            return kind, FakeMessage("prompt: You are a pirate.", user, channel)
+        if kind == "imitator":
+            return kind, FakeMessage("imitator: hello there", user, channel)
+        return kind, FakeMessage("just chatting", user, channel)
+
+    async def send(self, kind, message):
+        started = time.perf_counter()
+        if kind in ("mention", "reply"):
+            self.sent_at[message.id] = started
+            self.expected += 1
+        await self.bot.on_message(message)
+        self.timings.observe("on_message", time.perf_counter() - started)
+        self.timings.observe(f"on_message.{kind}", time.perf_counter() - started)
+
+    async def monitor_loop_lag(self, interval=0.01):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.timings.observe("loop_lag", time.perf_counter() - started - interval)
+
+    async def run(self):
+        monitor = asyncio.create_task(self.monitor_loop_lag())
+        handlers = set()
+        started = time.perf_counter()
+        while time.perf_counter() - started < self.duration:
+            kind, message = self.next_message()
+            task = asyncio.create_task(self.send(kind, message))
+            handlers.add(task)
+            task.add_done_callback(handlers.discard)
+            self.sent += 1
+            # Poisson arrivals
+            await asyncio.sleep(random.expovariate(self.rate))
+
+        # Wait for the last answers, allowing for the coalescing window and slow tool calls
+        drain_deadline = time.perf_counter() + 60
+        while (handlers or self.sent_at) and time.perf_counter() < drain_deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        monitor.cancel()
+        return elapsed
+
+
+def install_stand_ins(python_run_time, imitator_run_time):
+    """
+    Replace the modules the bot would use for Docker and the imitator model, before the bot is imported.
+    """
+    class StandInPythonExecutor:
+        def __init__(self, image_name=None, timeout=None, pool=None, forkserver=False, max_output_bytes=None,
+                     sessions=None, result_cache=None, memory_limit_bytes=None, cpu_time_limit=None):
+            self.usage = RunUsage()
+
+        def run_code(self, code, session_id=None):
+            time.sleep(python_run_time)
+            output = OutputCapture()
+            output.write(b"42\n")
+            self.usage.wall_seconds = python_run_time
+            self.usage.output_bytes = len(output)
+            self.usage.exit_reason = EXIT_OK
+            return output, None
+
+    docker_module = types.ModuleType("DockerPythonExecutor")
+    docker_module.DockerPythonExecutor = StandInPythonExecutor
+    sys.modules["DockerPythonExecutor"] = docker_module
+
+    def generate_message(input_message, model_path, tokenizer_path=None):
+        # Generation runs on the CPU in the event loop thread, like the real model
+        time.sleep(imitator_run_time)
+        return "a reply in someone's style"
+
+    imitator_modules = {
+        "Imitator.imitator_message_gen": {"generate_message": generate_message},
+        "Imitator.IMITATOR_CONFIG": {"model_path": "imitator-model"},
+        "Imitator.GetMessages": {"save_messages": lambda messages, file_name=None: None},
+    }
+    for name, attributes in imitator_modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+
+def import_bot(work_dir):
+    """
+    Import ClydesBrother inside work_dir, so its secrets, message database and timers are throwaway files.
+    """
+    with open(os.path.join(work_dir, "secrets.json"), "w") as secrets_file:
+        json.dump({"discord_api_key": "load-test", "openai_api_key": "load-test"}, secrets_file)
+    with open(os.path.join(work_dir, "timers.json"), "w") as timers_file:
+        json.dump([], timers_file)
+    os.chdir(work_dir)
+    import ClydesBrother
+    ClydesBrother.discord_client._connection.user = BOT_USER
+    return ClydesBrother
+
+
+def print_report(test, elapsed, server):
+    answered = test.timings.timings.get("end_to_end", ())
+    print(f"Sent {test.sent} messages in {elapsed:.1f}s, {test.expected} needed a model response")
+    print(f"Throughput: {test.sent / elapsed:.1f} messages/s handled, "
+          f"{len(answered) / elapsed:.1f} responses/s, {len(answered)}/{test.expected} answered")
+    print(f"Batches superseded by a newer message: {test.superseded}, messages not answered: "
+          f"{test.failed + len(test.sent_at)}")
+    print(f"Model requests: {server.requests}")
+    print()
+    print(f"{'stage':<32}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    stages = [(name, test.timings) for name in sorted(test.timings.timings) if name != "loop_lag"]
+    stages += [(name, metrics) for name in BOT_STAGES if name in metrics.timings]
+    stages.append(("loop_lag", test.timings))
+    for name, registry in stages:
+        samples = registry.timings[name]
+        print(f"{name:<32}{len(samples):>8}{registry.percentile(name, 50) * 1000:>10.1f}"
+              f"{registry.percentile(name, 99) * 1000:>10.1f}")
+    lag = test.timings.timings.get("loop_lag")
+    if lag:
+        print(f"Longest event loop stall: {max(lag) * 1000:.1f}ms")
+    counters = {name: value for name, value in metrics.counters.items() if value}
+    if counters:
+        print()
+        print("Counters: " + ", ".join(f"{name}={value}" for name, value in sorted(counters.items())))
+
+
+async def run(args, bot):
+    from CompletionClient import CompletionClient
+    from RequestScheduler import RequestScheduler
+
+    server = FakeOpenAIServer(latency=args.latency, jitter=args.jitter, tool_call_rate=args.tool_call_rate,
+                              stream_chunks=args.stream_chunks)
+    await server.start()
+    scheduler = RequestScheduler(max_concurrent_requests=bot.OPENAI_MAX_CONCURRENT_REQUESTS,
+                                 requests_per_minute=args.requests_per_minute)
+    bot.completion_client = CompletionClient("load-test", bot.model, bot.tools, base_url=server.base_url,
+                                             max_connections=bot.OPENAI_MAX_CONNECTIONS, scheduler=scheduler,
+                                             response_cache=bot.response_cache)
+    bot.STREAM_RESPONSES = not args.no_stream
+    bot.STREAM_EDIT_INTERVAL = args.edit_interval
+    bot.COALESCE_WINDOW = args.coalesce_window
+    bot.request_coalescer.window = args.coalesce_window
+
+    mix = {"mention": args.mentions, "reply": args.replies, "prompt": args.prompts, "imitator": args.imitator,
+           "chatter": args.chatter}
+    test = LoadTest(bot, args.rate, args.duration, args.users, args.channels, mix)
+    global harness
+    harness = test
+
+    # Remember the bot's final replies, so later messages can continue those conversations
+    respond_to_messages = bot.respond_to_messages
+
+    async def timed_respond_to_messages(messages):
+        try:
+            await respond_to_messages(messages)
+        except asyncio.CancelledError:
+            # Superseded by a newer message, its messages stay pending until the batch that replaces this one is done
+            test.superseded += 1
+            raise
+        except Exception:
+            test.record_failed(messages)
+            raise
+        test.record_done(messages)
+
+    bot.request_coalescer.handler = timed_respond_to_messages
+    bot.respond_to_messages = timed_respond_to_messages
+    log_response_parts = bot.log_response_parts
+
+    def recorded_log_response_parts(sent_parts, message_id):
+        log_response_parts(sent_parts, message_id)
+        test.bot_replies.extend(sent_message for sent_message, _ in sent_parts[-1:])
+        del test.bot_replies[:-100]
+
+    bot.log_response_parts = recorded_log_response_parts
+
+    try:
+        elapsed = await test.run()
+    finally:
+        await bot.completion_client.close()
+        await server.stop()
+    print_report(test, elapsed, server)
+
+
+harness = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rate", type=float, default=20, help="Messages sent per second")
+    parser.add_argument("--duration", type=float, default=30, help="How long to send messages for, in seconds")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--mentions", type=float, default=0.4, help="Share of messages mentioning the bot")
+    parser.add_argument("--replies", type=float, default=0.3, help="Share of replies to the bot's replies")
+    parser.add_argument("--prompts", type=float, default=0.05, help="Share of prompt: messages")
+    parser.add_argument("--imitator", type=float, default=0.02, help="Share of imitator: messages")
+    parser.add_argument("--chatter", type=float, default=0.23, help="Share of messages the bot ignores")
+    parser.add_argument("--latency", type=float, default=0.5, help="The fake endpoint latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Extra random fake endpoint latency in seconds")
+    parser.add_argument("--tool-call-rate", type=float, default=0.1, help="Share of responses that call Python")
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--python-run-time", type=float, default=0.3, help="Stand-in Docker run time in seconds")
+    parser.add_argument("--imitator-run-time", type=float, default=0.2,
+                        help="Stand-in imitator generation time in seconds, blocking like the real model")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Latency of every Discord API call")
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="Client-side rate limit, if any")
+    parser.add_argument("--coalesce-window", type=float, default=0.75)
+    parser.add_argument("--edit-interval", type=float, default=1.0)
+    parser.add_argument("--no-stream", action="store_true", help="Send whole responses instead of streaming them")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    global DISCORD_LATENCY
+    DISCORD_LATENCY = args.discord_latency
+    random.seed(args.seed)
+    sys.path.insert(0, os.getcwd())
+    install_stand_ins(args.python_run_time, args.imitator_run_time)
+    with tempfile.TemporaryDirectory() as work_dir:
+        bot = import_bot(work_dir)
+        asyncio.run(run(args, bot))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Compares the memory use and build time of MessageNode against the original dictionary-backed implementation.
+
+Run from the repository root with ``python -m Benchmarks.message_node_memory [--count N]``.
+Each node is built from a freshly parsed JSON record, as when loading message_history.json, so strings that the
+legacy node keeps per instance (roles, stringified IDs) are counted.
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from MessageNode import MessageNode
+
+ROLES = ["system", "user", "assistant", "user"]
+
+
+class LegacyMessageNode:
+    """The MessageNode implementation before __slots__, role enums and integer IDs."""
+    def __init__(self, message_id, role, content, timestamp, parent_id=None, tool_call=None):
+        self.message_id = message_id
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.parent_id = parent_id
+        self.tool_call = tool_call
+
+    @staticmethod
+    def from_dict(data):
+        return LegacyMessageNode(data["message_id"], data["role"], data["content"], data["timestamp"],
+                                 data["parent_id"], data["tool_call"])
+
+
+def synthetic_records(count):
+    """
+    Generate JSON-encoded message records forming reply chains of four messages.
+    Message IDs are written as strings, as JSON object keys in the history file are.
+    """
+    base_id = 1_200_000_000_000_000_000
+    base_time = time.time()
+    for i in range(count):
+        parent_id = f'"{base_id + i - 1}"' if i % 4 else "null"
+        yield (f'{{"message_id": "{base_id + i}", "role": "{ROLES[i % 4]}", "content": "Message number {i}", '
+               f'"timestamp": {base_time + i}, "parent_id": {parent_id}, "tool_call": null}}')
+
+
+def build(node_class, count):
+    """Build a graph dictionary of count nodes, parsing each record as it goes."""
+    messages = {}
+    for line in synthetic_records(count):
+        node = node_class.from_dict(json.loads(line))
+        messages[node.message_id] = node
+    return messages
+
+
+def measure(node_class, count):
+    """
+    :return: A tuple of the build time in seconds and the bytes retained per node.
+    """
+    gc.collect()
+    start = time.perf_counter()
+    messages = build(node_class, count)
+    build_time = time.perf_counter() - start
+    del messages
+
+    gc.collect()
+    tracemalloc.start()
+    messages = build(node_class, count)
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del messages
+    return build_time, retained / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--count", type=int, default=1_000_000, help="The number of synthetic messages to build")
+    args = parser.parse_args()
+
+    print(f"Building {args.count:,} messages per implementation")
+    results = {}
+    for name, node_class in [("legacy", LegacyMessageNode), ("compact", MessageNode)]:
+        build_time, bytes_per_node = measure(node_class, args.count)
+        results[name] = bytes_per_node
+        print(f"{name:>8}: {build_time:6.2f} s to build, {bytes_per_node:6.1f} bytes per node (including the graph dict)")
+
+    print(f"Compact nodes use {1 - results['compact'] / results['legacy']:.0%} less memory")
+
+
+if __name__ == "__main__":
+    main()
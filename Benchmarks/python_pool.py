@@ -0,0 +1,115 @@
+"""
+Compares the latency of the python tool with a new container per run against warm containers from a pool.
+
+Needs Docker and the python_runner image (see Dockerfile_PythonRunner). Runs the same snippets through
+DockerPythonExecutor without a pool, with a PythonContainerPool, and with a pool of containers running
+PythonForkServer, one at a time and then several at once. Then compares a follow-up calculation on loaded data
+run from scratch, reloading the data, against the same calculation in a python session that already has it.
+
+Run from the repository root with ``python -m Benchmarks.python_pool [--runs 20] [--concurrency 4]``.
+"""
+import argparse
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from DockerPythonExecutor import DockerPythonExecutor
+from PythonContainerPool import PythonContainerPool
+from PythonForkServer import SERVE_COMMAND, PING_COMMAND
+from PythonSessionManager import PythonSessionManager
+
+SNIPPETS = [
+    "print(2 ** 64)",
+    "import numpy as np\nprint(np.arange(10).sum())",
+    "import math\nprint(math.factorial(20))",
+    "open('leftover.txt', 'w').write('state')\nprint('wrote a file')",  # Forces the container to be replaced
+]
+
+# A multi-step analysis: the data is loaded once, then several follow-up questions are asked about it
+LOAD_DATA = ("import numpy as np\nimport pandas as pd\nrng = np.random.default_rng(0)\n"
+             "df = pd.DataFrame(rng.normal(size=(200_000, 8)), columns=list('abcdefgh'))")
+FOLLOW_UP = "print(df.corr().round(2).loc['a', 'b'])"
+
+
+def time_runs(executor, runs, concurrency):
+    def timed_run(index):
+        started = time.perf_counter()
+        output, error = executor.run_code(SNIPPETS[index % len(SNIPPETS)])
+        if error:
+            print(f"Run {index} failed: {error}")
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        latencies = sorted(threads.map(timed_run, range(runs)))
+    return latencies, time.perf_counter() - started
+
+
+def time_follow_ups(executor, runs, concurrency, use_sessions):
+    """
+    Time the follow-up calculation, in one conversation per worker. Without sessions, every run loads the data again.
+    """
+    def timed_run(index):
+        session_id = index % concurrency if use_sessions else None
+        code = FOLLOW_UP if use_sessions else f"{LOAD_DATA}\n{FOLLOW_UP}"
+        started = time.perf_counter()
+        output, error = executor.run_code(code, session_id)
+        if error:
+            print(f"Run {index} failed: {error}")
+        return time.perf_counter() - started
+
+    if use_sessions:
+        with ThreadPoolExecutor(max_workers=concurrency) as threads:
+            list(threads.map(lambda session_id: executor.run_code(LOAD_DATA, session_id), range(concurrency)))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as threads:
+        latencies = sorted(threads.map(timed_run, range(runs)))
+    return latencies, time.perf_counter() - started
+
+
+def report(name, latencies, elapsed):
+    p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    print(f"{name:<28}p50 {statistics.median(latencies) * 1000:>8.0f}ms   p99 {p99 * 1000:>8.0f}ms   "
+          f"{len(latencies) / elapsed:>6.2f} runs/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="Runs at once in the concurrent test")
+    parser.add_argument("--image", default="python_runner")
+    args = parser.parse_args()
+
+    cold = DockerPythonExecutor(image_name=args.image)
+    pool = PythonContainerPool(image_name=args.image, min_size=args.concurrency, max_size=args.concurrency * 2)
+    pooled = DockerPythonExecutor(image_name=args.image, pool=pool)
+    fork_pool = PythonContainerPool(image_name=args.image, min_size=args.concurrency, max_size=args.concurrency * 2,
+                                    command=SERVE_COMMAND, ready_command=PING_COMMAND)
+    session_pool = PythonContainerPool(image_name=args.image, min_size=1, max_size=1, command=SERVE_COMMAND,
+                                       ready_command=PING_COMMAND)
+    sessions = PythonSessionManager(session_pool, max_sessions=args.concurrency)
+    forked = DockerPythonExecutor(image_name=args.image, pool=fork_pool, forkserver=True, sessions=sessions,
+                                  timeout=30)
+    pools = [pool, fork_pool, session_pool]
+    for each_pool in pools:
+        each_pool.start()
+        if not each_pool.wait_until_ready():
+            raise SystemExit("The pool did not start its containers, is Docker running and the image built?")
+
+    try:
+        for concurrency in (1, args.concurrency):
+            report(f"cold, {concurrency} at once", *time_runs(cold, args.runs, concurrency))
+            report(f"pooled, {concurrency} at once", *time_runs(pooled, args.runs, concurrency))
+            report(f"forkserver, {concurrency} at once", *time_runs(forked, args.runs, concurrency))
+        for concurrency in (1, args.concurrency):
+            report(f"follow-up, {concurrency} at once", *time_follow_ups(forked, args.runs, concurrency, False))
+            report(f"session, {concurrency} at once", *time_follow_ups(forked, args.runs, concurrency, True))
+    finally:
+        sessions.shutdown()
+        for each_pool in pools:
+            each_pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""
+Compares the latency of the python tool's sandbox backends: a resource-limited local subprocess against Docker.
+
+Runs the python_pool snippets through SubprocessPythonExecutor and, unless --no-docker is given, through
+DockerPythonExecutor with a new container per run and with a pool of warm containers running PythonForkServer, one at
+a time and then several at once. The Docker backends need Docker and the python_runner image
+(see Dockerfile_PythonRunner).
+
+Run from the repository root with ``python -m Benchmarks.sandbox_backends [--runs 20] [--concurrency 4]``.
+"""
+import argparse
+
+from Benchmarks.python_pool import report, time_runs
+from DockerPythonExecutor import DockerPythonExecutor
+from PythonContainerPool import PythonContainerPool
+from PythonForkServer import SERVE_COMMAND, PING_COMMAND
+from SubprocessPythonExecutor import SubprocessPythonExecutor
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4, help="Runs at once in the concurrent test")
+    parser.add_argument("--image", default="python_runner")
+    parser.add_argument("--no-docker", action="store_true", help="Only benchmark the subprocess backend")
+    args = parser.parse_args()
+
+    backends = [("subprocess", SubprocessPythonExecutor())]
+    pool = None
+    if not args.no_docker:
+        pool = PythonContainerPool(image_name=args.image, min_size=args.concurrency, max_size=args.concurrency * 2,
+                                   command=SERVE_COMMAND, ready_command=PING_COMMAND)
+        pool.start()
+        if not pool.wait_until_ready():
+            raise SystemExit("The pool did not start its containers, is Docker running and the image built?")
+        backends.append(("docker, cold", DockerPythonExecutor(image_name=args.image)))
+        backends.append(("docker, forkserver pool", DockerPythonExecutor(image_name=args.image, pool=pool,
+                                                                         forkserver=True)))
+
+    try:
+        for concurrency in (1, args.concurrency):
+            for name, executor in backends:
+                report(f"{name}, {concurrency} at once", *time_runs(executor, args.runs, concurrency))
+    finally:
+        if pool:
+            pool.close()
+
+
+if __name__ == "__main__":
+    main()
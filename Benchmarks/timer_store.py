@@ -0,0 +1,139 @@
+"""
+Stress tests the timer storage: thousands of concurrent adds and fires through the TimerStore and TimerScheduler,
+and a writer killed mid-write.
+
+Checks that no timer is lost or fired twice, that nothing is left in the store once every timer has fired, and that
+every timer a killed writer had stored is still there, in an intact database. Reports how late timers fired.
+
+Run from the repository root with ``python -m Benchmarks.timer_store [--timers 5000] [--threads 8]``.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from TimerScheduler import TimerScheduler
+from TimerStore import TimerStore
+
+
+def concurrent_adds(db_path, timers, threads):
+    """
+    Add timers from several threads at once, straight to the store.
+    """
+    store = TimerStore(db_path)
+    expire_time = datetime.now() + timedelta(days=1)
+
+    def add(index):
+        return store.add(index, index % 10, f"timer {index}", expire_time)["id"]
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        ids = list(pool.map(add, range(timers)))
+    elapsed = time.perf_counter() - started
+
+    print(f"{timers} adds from {threads} threads: {timers / elapsed:.0f} adds/s")
+    assert len(set(ids)) == timers, "Two timers were given the same id"
+    assert len(store) == timers, f"{len(store)} of {timers} timers were stored"
+    store.delete(ids)
+    assert len(store) == 0, "Deleted timers are still stored"
+    store.close()
+
+
+async def adds_and_fires(db_path, timers, spread):
+    """
+    Add timers from many tasks at once while the scheduler fires them.
+    """
+    store = TimerStore(db_path)
+    scheduler = TimerScheduler(store)
+    fired = {}
+    lateness = []
+
+    async def on_expired(expired):
+        now = time.time()
+        for timer in expired:
+            fired[timer["id"]] = fired.get(timer["id"], 0) + 1
+            lateness.append(now - datetime.fromisoformat(timer["expire_time"]).timestamp())
+
+    async def add(index):
+        # Spread the adds over the first half of the run, each due up to spread seconds later
+        await asyncio.sleep(index / timers * spread / 2)
+        delay = (index * 7919 % 1000) / 1000 * spread
+        scheduler.add(index, index % 10, f"timer {index}", datetime.now() + timedelta(seconds=delay))
+
+    runner = asyncio.create_task(scheduler.run(on_expired))
+    started = time.perf_counter()
+    await asyncio.gather(*(add(index) for index in range(timers)))
+    while len(scheduler) and time.perf_counter() - started < spread * 3 + 10:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.1)  # Let the last batch be deleted from the store
+    runner.cancel()
+
+    print(f"{timers} timers added and fired: lateness p50 {statistics.median(lateness) * 1000:.1f}ms, "
+          f"max {max(lateness) * 1000:.1f}ms")
+    assert len(fired) == timers, f"{timers - len(fired)} timers did not fire"
+    assert max(fired.values()) == 1, "A timer fired more than once"
+    assert len(store) == 0, f"{len(store)} fired timers are still stored"
+    assert not store.due(time.time()), "The store still has due timers"
+    store.close()
+
+
+def killed_writer(db_path, seconds):
+    """
+    Kill a process while it adds timers, then check every timer it reported as added is still stored.
+    """
+    child = subprocess.Popen([sys.executable, "-m", "Benchmarks.timer_store", "--writer", db_path],
+                             stdout=subprocess.PIPE, text=True)
+    time.sleep(seconds)
+    child.send_signal(signal.SIGKILL)
+    output, _ = child.communicate()
+    added = {int(line) for line in output.split()}
+
+    connection = sqlite3.connect(db_path)
+    integrity = connection.execute("PRAGMA integrity_check").fetchone()[0]
+    stored = {row[0] for row in connection.execute("SELECT id FROM timers")}
+    connection.close()
+
+    print(f"Writer killed after adding {len(added)} timers: integrity {integrity}, "
+          f"{len(added - stored)} added timers missing")
+    assert integrity == "ok", "The database was damaged"
+    assert added <= stored, "Timers the writer had added were lost"
+
+
+def write_until_killed(db_path):
+    """Add timers as fast as possible, printing the id of each once it is stored."""
+    store = TimerStore(db_path)
+    expire_time = datetime.now() + timedelta(days=1)
+    index = 0
+    while True:
+        timer = store.add(index, 0, f"timer {index}", expire_time)
+        print(timer["id"], flush=True)
+        index += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--timers", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--spread", type=float, default=2.0, help="Seconds over which the timers expire")
+    parser.add_argument("--writer", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.writer:
+        write_until_killed(args.writer)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        concurrent_adds(os.path.join(directory, "threads.db"), args.timers, args.threads)
+        asyncio.run(adds_and_fires(os.path.join(directory, "scheduler.db"), args.timers, args.spread))
+        killed_writer(os.path.join(directory, "killed.db"), 1.0)
+
+
+if __name__ == "__main__":
+    main()
@@ -49,6 +49,10 @@ tools = [
     }
 ]
 
+# Added to the python tool's description when python sessions are enabled
+python_session_note = (" Variables, imports and data persist between python calls in the same conversation, so "
+                       "reuse them instead of recomputing or reloading them.")
+
 initial_prompt = ("""
                   You are Clyde's brother. 
                   You are a Discord bot that responds to messages in a discord, which are given in the format USERNAME: MESSAGE. 
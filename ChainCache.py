@@ -0,0 +1,130 @@
+from collections import OrderedDict
+
+
+class ChainCache:
+    """
+    Memoizes message chains by the ID of their last message.
+    A chain is stored as a tuple of message nodes, and a reply's chain is built by extending its parent's
+    cached tuple rather than walking back to the root for every reply.
+    The cache holds at most max_entries nodes in total (counted across all chains) and evicts the least
+    recently used chains first.
+    """
+    def __init__(self, max_entries=100000):
+        """
+        Initialize an empty cache.
+        :param max_entries: The memory budget, as the total length of all cached chains.
+        """
+        self.max_entries = max_entries
+        self.chains = OrderedDict()  # message ID -> tuple of message nodes
+        self.size = 0
+        # Parent links of every message in a cached chain, kept while any chain through them is cached,
+        # so that changing or deleting any message can find every chain built on top of it
+        self.parent_of = {}
+        self.children = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message_id):
+        """
+        Get the cached chain ending at the given message.
+        :param message_id: The discord ID of the last message in the chain.
+        :return: A tuple of message nodes, root first, or None if the chain is not cached.
+        """
+        chain = self.chains.get(message_id)
+        if chain is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.chains.move_to_end(message_id)
+        return chain
+
+    def peek(self, message_id):
+        """
+        Get the cached chain ending at the given message without counting a hit or miss or marking it recently used,
+        e.g. to extend a parent's chain after the lookup of its reply has already been counted.
+        :param message_id: The discord ID of the last message in the chain.
+        :return: A tuple of message nodes, root first, or None if the chain is not cached.
+        """
+        return self.chains.get(message_id)
+
+    def put(self, message_id, chain):
+        """
+        Cache the chain ending at the given message.
+        :param message_id: The discord ID of the last message in the chain.
+        :param chain: The chain, as a tuple of message nodes, root first.
+        """
+        if len(chain) > self.max_entries:
+            return
+        self.invalidate(message_id)
+
+        self.chains[message_id] = chain
+        self.size += len(chain)
+        # Link every message in the chain to its parent, stopping at the first link that already exists.
+        # A root with a missing parent (e.g. evicted, or not stored yet) is linked to it too.
+        for index in range(len(chain) - 1, -1, -1):
+            child_id = chain[index].message_id
+            parent_id = chain[index - 1].message_id if index else chain[0].parent_id
+            if parent_id is None or self.parent_of.get(child_id) == parent_id:
+                break
+            self.parent_of[child_id] = parent_id
+            self.children.setdefault(parent_id, set()).add(child_id)
+
+        while self.size > self.max_entries:
+            evicted_id, evicted_chain = self.chains.popitem(last=False)
+            self.size -= len(evicted_chain)
+            self.unlink(evicted_id)
+
+    def invalidate(self, message_id):
+        """
+        Drop the cached chain ending at the given message and every cached chain that extends it.
+        Call this whenever a message is replaced, deleted, or given a new parent.
+        :param message_id: The discord ID of the message.
+        """
+        original_parent_id = self.parent_of.get(message_id)
+        stack = [message_id]
+        while stack:
+            current_id = stack.pop()
+            chain = self.chains.pop(current_id, None)
+            if chain is not None:
+                self.size -= len(chain)
+            stack.extend(self.children.pop(current_id, ()))
+            parent_id = self.parent_of.pop(current_id, None)
+            if parent_id is not None and parent_id in self.children:
+                self.children[parent_id].discard(current_id)
+        self.unlink(original_parent_id)
+
+    def unlink(self, message_id):
+        """
+        Remove parent links that no cached chain depends on any more, walking up from the given message.
+        """
+        current_id = message_id
+        while current_id is not None and current_id not in self.chains and not self.children.get(current_id):
+            self.children.pop(current_id, None)
+            parent_id = self.parent_of.pop(current_id, None)
+            if parent_id is not None and parent_id in self.children:
+                self.children[parent_id].discard(current_id)
+            current_id = parent_id
+
+    def clear(self):
+        """
+        Empty the cache, keeping the hit and miss counters.
+        """
+        self.chains.clear()
+        self.parent_of.clear()
+        self.children.clear()
+        self.size = 0
+
+    def stats(self):
+        """
+        :return: A dictionary with the number of cached chains, their total length, and the hit/miss counters.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "chains": len(self.chains),
+            "entries": self.size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -1,4 +1,6 @@
+import asyncio
 import atexit
+import io
 import json
 import random
 import time
@@ -7,26 +9,89 @@ from typing import Tuple, List
 
 import discord
 from discord.ext import tasks
-from openai import OpenAI
 from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
 
-from CONFIG import tools, initial_prompt
+from CONFIG import tools, initial_prompt, python_session_note
+from CodeExecutionQueue import CodeExecutionQueue
+from CompletionClient import CompletionClient
 from DockerPythonExecutor import DockerPythonExecutor
 from FindNewMagicStory import MagicStoryChecker
 from Imitator.GetMessages import save_messages
 from Imitator.IMITATOR_CONFIG import model_path
 from Imitator.imitator_message_gen import generate_message
 from MessageGraph import MessageGraph
-from TimerTool import set_timer
+from PythonContainerPool import PythonContainerPool
+from PythonForkServer import SERVE_COMMAND, PING_COMMAND
+from PythonSessionManager import PythonSessionManager
+from MessageStore import SQLiteMessageStore
+from OutputCapture import OutputCapture
+from RequestCoalescer import RequestCoalescer
+from ResponseCache import ResponseCache
+from SandboxResultCache import SandboxResultCache
+from SandboxUsage import RunUsage, SandboxUsageTracker
+from RequestScheduler import RequestScheduler, PRIORITY_HIGH, PRIORITY_NORMAL
+from StreamingReply import StreamingReply
+from SubprocessPythonExecutor import SubprocessPythonExecutor
+from Metrics import metrics
+from TimerScheduler import TimerScheduler
+from TimerStore import TimerStore
+from TimerTool import set_timer, timer_notifications
 
 # Constants
 SECRETS_FILE = "secrets.json"
-TIMERS_FILE = "timers.json"
+TIMERS_FILE = "timers.json"  # Imported into the timer database the first time it is opened
+TIMERS_DATABASE_FILE = "timers.db"
 MESSAGE_HISTORY_FILE = 'message_history.json'
+MESSAGE_DATABASE_FILE = 'message_history.db'
+MESSAGE_CACHE_SIZE = 4096
 SCRAPE_MESSAGES_CHANNEL_ID = 944200738605776906
 SCRAPE_START_DATE = "2023-01-02"
 MAGIC_STORY_CHANNEL_ID = 1032688705128902788
 RESPONSE_CHANCE = 0.005
+MESSAGE_SNAPSHOT_INTERVAL_MINUTES = 10
+MESSAGE_RETENTION = timedelta(weeks=1)
+MESSAGE_EVICTION_INTERVAL_MINUTES = 15
+CONTEXT_TOKEN_BUDGET = 16000  # Longer conversations have their middle trimmed before being sent to the model
+CONTEXT_KEEP_RECENT_MESSAGES = 6
+OPENAI_MAX_CONCURRENT_REQUESTS = 8  # Further requests wait for a free slot
+OPENAI_MAX_CONNECTIONS = 16
+OPENAI_REQUEST_TIMEOUT = 60  # Seconds
+OPENAI_REQUESTS_PER_MINUTE = 500  # Client-side rate limits, set these to the account's limits or None
+OPENAI_TOKENS_PER_MINUTE = 30000
+OPENAI_MAX_RETRIES = 4  # Rate limit and server errors are retried with jittered exponential backoff
+STREAM_RESPONSES = True  # Post a placeholder reply and edit it as the response is generated
+STREAM_EDIT_INTERVAL = 1.0  # Seconds between edits of a streamed reply, to respect Discord's rate limits
+COALESCE_WINDOW = 0.75  # Seconds to wait for further messages in a thread before responding, 0 to disable
+COALESCE_MAX_DELAY = 3.0  # The longest a message waits for a burst to end, in seconds
+RESPONSE_CACHE_ENABLED = True  # Answer repeated standalone questions without calling the model again
+RESPONSE_CACHE_FILE = 'response_cache.json'
+RESPONSE_CACHE_MAX_BYTES = 4 * 1024 * 1024
+RESPONSE_CACHE_TTL = timedelta(hours=24)
+# Where python tool calls run: 'docker' in sandbox containers, or 'subprocess' in a resource-limited local process
+# for hosts without Docker. Pools and sessions only apply to Docker. The subprocess backend hides the host's files,
+# such as secrets.json, by running the code in a root of its own, which needs unshare and unprivileged user namespaces.
+# Without them it refuses to run code rather than let it read the bot's secrets.
+PYTHON_SANDBOX_BACKEND = 'docker'
+PYTHON_MEMORY_LIMIT_BYTES = 1024 * 1024 * 1024  # Per run, sessions have PYTHON_SESSION_MEMORY_BYTES
+PYTHON_CPU_TIME_LIMIT = 6  # Seconds of CPU time per run
+PYTHON_POOL_MIN_SIZE = 2  # Idle sandbox containers kept ready for the python tool
+PYTHON_POOL_MAX_SIZE = 4
+PYTHON_POOL_MAX_RUNS = 50  # Runs before a sandbox container is replaced
+PYTHON_POOL_HEALTH_CHECK_MINUTES = 5
+PYTHON_USE_FORKSERVER = True  # Run code through a fork server that has numpy, pandas etc. imported already
+PYTHON_MAX_OUTPUT_BYTES = 1024 * 1024  # Per stream, a run printing more is stopped
+PYTHON_OUTPUT_MODEL_CHARS = 4000  # Longer output is summarised by its start and end before it is sent to the model
+PYTHON_OUTPUT_AS_ATTACHMENT = True  # Upload output too long for a Discord message as a file
+PYTHON_SESSIONS_ENABLED = True  # Keep python variables between tool calls in the same conversation
+PYTHON_MAX_SESSIONS = 8  # The least recently used session is closed to open another
+PYTHON_SESSION_IDLE_TIMEOUT = timedelta(minutes=15)
+PYTHON_SESSION_MEMORY_BYTES = 512 * 1024 * 1024
+SANDBOX_CACHE_ENABLED = True  # Reuse the output of deterministic python code the model has run before
+SANDBOX_CACHE_DIRECTORY = 'sandbox_cache'
+SANDBOX_CACHE_MAX_BYTES = 64 * 1024 * 1024
+SANDBOX_USAGE_WINDOW = timedelta(hours=24)  # How long runs count towards the sandbox: usage statistics
+TOOL_MAX_ROUNDS = 5  # The most rounds of tool calls the model may make before answering
+TOOL_TURN_TIME_BUDGET = 120  # Seconds a response may take, including every tool call and model request
 
 # Initialize the Discord API key and OpenAI API key from secrets.json
 # Initialize the Discord and OpenAI API keys
@@ -41,10 +106,47 @@ intents.messages = True
 intents.guilds = True
 intents.message_content = True
 discord_client = discord.Client(intents=intents)
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
 model = "gpt-4o"
-message_graph = MessageGraph(MESSAGE_HISTORY_FILE)
+# Every model call is queued here, mentions first and fairly across channels and users
+request_scheduler = RequestScheduler(max_concurrent_requests=OPENAI_MAX_CONCURRENT_REQUESTS,
+                                     requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+                                     tokens_per_minute=OPENAI_TOKENS_PER_MINUTE, max_retries=OPENAI_MAX_RETRIES)
+response_cache = ResponseCache(RESPONSE_CACHE_FILE, max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                               ttl=RESPONSE_CACHE_TTL.total_seconds()) if RESPONSE_CACHE_ENABLED else None
+# One shared async client, so completions never block the event loop and reuse pooled connections
+completion_client = CompletionClient(OPENAI_API_KEY, model, tools, max_connections=OPENAI_MAX_CONNECTIONS,
+                                     request_timeout=OPENAI_REQUEST_TIMEOUT, scheduler=request_scheduler,
+                                     response_cache=response_cache)
+# Messages are stored in SQLite, importing the old JSON history on first run.
+# Use MessageGraph(MESSAGE_HISTORY_FILE) for the in-memory dictionary backend instead.
+message_graph = MessageGraph(store=SQLiteMessageStore(MESSAGE_DATABASE_FILE, cache_size=MESSAGE_CACHE_SIZE,
+                                                      legacy_json_path=MESSAGE_HISTORY_FILE))
+# Python tool calls run in warm containers from this pool, started when the bot is ready
+python_container_pool = PythonContainerPool(min_size=PYTHON_POOL_MIN_SIZE, max_size=PYTHON_POOL_MAX_SIZE,
+                                            max_runs=PYTHON_POOL_MAX_RUNS,
+                                            command=SERVE_COMMAND if PYTHON_USE_FORKSERVER else None,
+                                            ready_command=PING_COMMAND if PYTHON_USE_FORKSERVER else None)
+# Python sessions are forked in a container of their own, so the pool's containers stay clean
+python_sessions = None
+if PYTHON_SESSIONS_ENABLED and PYTHON_SANDBOX_BACKEND == 'docker':
+    python_sessions = PythonSessionManager(
+        PythonContainerPool(min_size=1, max_size=1, command=SERVE_COMMAND, ready_command=PING_COMMAND),
+        max_sessions=PYTHON_MAX_SESSIONS, idle_timeout=PYTHON_SESSION_IDLE_TIMEOUT.total_seconds(),
+        memory_limit_bytes=PYTHON_SESSION_MEMORY_BYTES)
+    # Let the model build on its earlier python calls in the conversation
+    for tool in tools:
+        if tool["function"]["name"] == "python":
+            tool["function"]["description"] += python_session_note
+sandbox_result_cache = SandboxResultCache(SANDBOX_CACHE_DIRECTORY,
+                                          max_bytes=SANDBOX_CACHE_MAX_BYTES) if SANDBOX_CACHE_ENABLED else None
+sandbox_usage = SandboxUsageTracker(window=SANDBOX_USAGE_WINDOW.total_seconds())
+# Python runs in worker threads, at most one per sandbox container, taking turns between users
+code_execution_queue = CodeExecutionQueue(max_concurrent_runs=PYTHON_POOL_MAX_SIZE)
+# Pending timers, loaded once and fired as they expire by a task started when the bot is ready
+timer_scheduler = TimerScheduler(TimerStore(TIMERS_DATABASE_FILE, legacy_json_path=TIMERS_FILE))
+timer_task = None
 scrape_messages = False
+background_tasks = set()  # Tasks started by run_in_background that have not finished yet
 
 
 # Tasks
@@ -68,42 +170,106 @@ async def post_new_articles() -> None:
         await channel.send(f"https://magic.wizards.com{article}")
 
 
-@tasks.loop(seconds=5)
-async def check_timers() -> None:
-    """Check for timers and perform actions when they expire."""
-    # Try to check the timers file, if it doesn't exist, return
+@tasks.loop(minutes=MESSAGE_SNAPSHOT_INTERVAL_MINUTES)
+async def snapshot_message_graph() -> None:
+    """
+    Persist the message graph, for the dictionary backend this snapshots it and truncates its log.
+    The response cache is saved at the same time.
+    """
+    try:
+        message_graph.save_messages()
+    except Exception as e:
+        print(f"Error saving message graph snapshot: {e}")
+
+    if response_cache:
+        try:
+            response_cache.save()
+        except Exception as e:
+            print(f"Error saving response cache: {e}")
+        metrics.set_gauge("response_cache.hit_rate", response_cache.stats()["hit_rate"])
+    if sandbox_result_cache:
+        sandbox_stats = sandbox_result_cache.stats()
+        metrics.set_gauge("sandbox_cache.hit_rate", sandbox_stats["hit_rate"])
+        metrics.set_gauge("sandbox_cache.saved_seconds", sandbox_stats["saved_seconds"])
+
+
+@tasks.loop(minutes=MESSAGE_EVICTION_INTERVAL_MINUTES)
+async def evict_old_messages() -> None:
+    """Delete messages older than the retention period so the message graph does not grow without bound."""
     try:
-        with open(TIMERS_FILE, "r") as file:
-            timers = json.load(file)
+        eviction = message_graph.delete_old_messages(MESSAGE_RETENTION)
     except Exception as e:
-        print(f"Error reading timers file: {e}")
+        print(f"Error evicting old messages: {e}")
         return
 
-    # Get current time
-    current_time = datetime.now()
-    updated_timers = []
-
-    # Check each timer
-    for timer in timers:
-        expire_time = datetime.fromisoformat(timer['expire_time'])
-
-        # If the timer has expired, perform the action
-        if current_time >= expire_time:
-            # Send the message
-            print(f"Timer expired: {timer['name']}")
-            user = await discord_client.fetch_user(timer['user_id'])  # Fetch the user based on user_id
-            channel = discord_client.get_channel(timer['channel_id'])
-            await channel.send(f"{user.mention} :alarm_clock:: '{timer['name']}'")
-        else:
-            # Only re-add timers that have not yet expired
-            updated_timers.append(timer)
+    metrics.increment("messages.evicted", eviction["evicted"])
+    metrics.observe("messages.eviction_duration", eviction["duration"])
+    metrics.set_gauge("messages.chain_cache_entries", message_graph.chain_cache.size)
+    if eviction["evicted"]:
+        print(f"Evicted {eviction['evicted']} old messages in {eviction['duration']:.3f}s")
+
+
+@tasks.loop(minutes=PYTHON_POOL_HEALTH_CHECK_MINUTES)
+async def check_python_containers() -> None:
+    """Start the python sandbox containers, and later replace any that have died or changed."""
+    try:
+        if python_container_pool.client is None:
+            await asyncio.to_thread(python_container_pool.start)
+            return
+        replaced = await asyncio.to_thread(python_container_pool.check_health)
+    except Exception as e:
+        print(f"Error checking python sandbox containers: {e}")
+        return
+
+    if replaced:
+        print(f"Replaced {replaced} unhealthy python sandbox containers")
+    metrics.set_gauge("python_pool.idle", python_container_pool.stats()["idle"])
+
+
+@tasks.loop(minutes=1)
+async def evict_idle_python_sessions() -> None:
+    """Start the python session container, and later close sessions that have not been used for a while."""
+    try:
+        if python_sessions.pool.client is None:
+            await asyncio.to_thread(python_sessions.pool.start)
+            return
+        evicted = await asyncio.to_thread(python_sessions.evict_idle)
+    except Exception as e:
+        print(f"Error evicting idle python sessions: {e}")
+        return
+
+    metrics.increment("python_sessions.evicted", evicted)
+    metrics.set_gauge("python_sessions.open", python_sessions.stats()["sessions"])
+
+
+async def notify_expired_timers(timers: list[dict]) -> None:
+    """
+    Notify the users of timers that have expired, called by the timer scheduler.
+    Timers that expired together in the same channel share a message, and the channels are notified concurrently.
+    :param timers: The expired timers.
+    """
+    print(f"Timers expired: {', '.join(timer['name'] for timer in timers)}")
+    notifications = timer_notifications(timers)
+    await asyncio.gather(*(send_timer_notification(channel_id, messages)
+                           for channel_id, messages in notifications.items()))
 
-    # Save the updated list of timers back to the file
+
+async def send_timer_notification(channel_id: int, messages: list[str]) -> None:
+    """
+    Send the timer notification messages of one channel, in order.
+    :param channel_id: The ID of the channel.
+    :param messages: The messages, see timer_notifications.
+    """
+    channel = discord_client.get_channel(channel_id)
+    if channel is None:
+        print(f"Channel with ID {channel_id} not found for timer notification.")
+        return
     try:
-        with open(TIMERS_FILE, "w") as file:
-            json.dump(updated_timers, file)
+        for content in messages:
+            await channel.send(content)
+            metrics.increment("timers.notifications")
     except Exception as e:
-        print(f"Error writing timers file: {e}")
+        print(f"Error sending timer notification to channel {channel_id}: {e}")
 
 
 # Event Handlers
@@ -114,8 +280,17 @@ async def on_ready() -> None:
     """
     print(f'We have logged in as {discord_client.user}')
     # Start our tasks
+    global timer_task
     post_new_articles.start()
-    check_timers.start()
+    # on_ready runs again after a reconnect, the scheduler is already running by then
+    if timer_task is None or timer_task.done():
+        timer_task = asyncio.create_task(timer_scheduler.run(notify_expired_timers))
+    snapshot_message_graph.start()
+    evict_old_messages.start()
+    if PYTHON_SANDBOX_BACKEND == 'docker':
+        check_python_containers.start()
+    if python_sessions:
+        evict_idle_python_sessions.start()
 
     # Scrape messages from a channel if enabled
     if scrape_messages:
@@ -149,10 +324,26 @@ async def on_message(message: discord.Message) -> None:
         await process_imitator_prompt(message)
         return
 
+    # Show what the python tool has used for the user and the channel with the sandbox: prefix
+    if message.content.startswith("sandbox:"):
+        await process_sandbox_usage_request(message)
+        return
+
     # Process general messages
     await process_general_message(message)
 
 
+@discord_client.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent) -> None:
+    """
+    Stops running code for a message once it is deleted, as there is nothing left to reply to.
+    :param payload: The deletion event, raw so it also arrives for messages that are not in the client's cache.
+    """
+    cancelled = code_execution_queue.cancel(payload.message_id)
+    if cancelled:
+        print(f"Cancelled {cancelled} python runs for deleted message {payload.message_id}")
+
+
 async def process_imitator_prompt(message: discord.Message) -> None:
     content = message.content[9:]
     async with message.channel.typing():
@@ -175,20 +366,65 @@ async def process_general_message(message: discord.Message) -> None:
     if message_graph.get_message_role(message_details['reply_to_id']) == "user":
         return
 
-    message_graph.add_message(
-        message_details['id'], message_details['author_role'], message_details['content'], time.time(),
-        reply_to=message_details['reply_to_id']
-    )
+    if COALESCE_WINDOW <= 0:
+        await respond_to_messages([message])
+        return
+
+    # Messages replying to the same message, or mentioning the bot in the same channel, are answered together
+    thread_key = message_details['reply_to_id'] or f"channel_{message.channel.id}"
+    request_coalescer.submit(thread_key, message)
+
+
+async def respond_to_messages(messages: List[discord.Message]) -> None:
+    """
+    Responds to a burst of messages from the same thread with a single model call.
+    The messages are added to the message graph as one chain, each replying to the one before it,
+    and the response replies to the latest message.
+    :param messages: The messages, oldest first.
+    """
+    reply_to_id = parse_reply_to_id(messages[0])
+    for burst_message in messages:
+        burst_details = parse_message(burst_message)
+        message_graph.add_message(
+            burst_details['id'], burst_details['author_role'], burst_details['content'], time.time(),
+            reply_to=reply_to_id
+        )
+        reply_to_id = burst_details['id']
+
+    message = messages[-1]
+    message_details = parse_message(message)
+    # Answer people who mentioned the bot before people continuing a conversation with it
+    bot_mentioned = any(discord_client.user in burst_message.mentions for burst_message in messages)
+    message_details['priority'] = PRIORITY_HIGH if bot_mentioned else PRIORITY_NORMAL
+
+    if STREAM_RESPONSES:
+        await stream_message_response(message, message_details)
+        return
 
     async with message.channel.typing():
         response, error = await process_message(message_details)
 
+    # Once a response has arrived, finish delivering it even if a newer message supersedes this one, and have a newer
+    # message answered on its own rather than these messages answered again
+    request_coalescer.commit()
+    await asyncio.shield(deliver_response(message, message_details, response, error))
+
+
+async def deliver_response(message: discord.Message, message_details: dict,
+                           response: ChatCompletionMessage | None, error: str | None) -> None:
+    """
+    Sends the response to a message, or runs its tool calls, or reports the error.
+    :param message: The user message to reply to.
+    :param message_details: The details of the message.
+    :param response: The response from the OpenAI API, or None if an error occurred.
+    :param error: The error message, or None.
+    """
     if error:
         await message.reply(error)
         return
 
     if response.tool_calls:
-        await process_tool_calls(message, response)
+        await process_tool_calls(message, response, message_details)
     else:
         await finalize_message_response(message, response, message_details['id'])
 
@@ -206,26 +442,99 @@ async def process_message(message_details: dict) -> Tuple[ChatCompletionMessage,
     if not message_details:
         return None, "Message details not provided."
 
+    return await fetch_response_from_openai(build_message_chain(message_details), message_details)
+
+
+async def stream_message_response(message: discord.Message, message_details: dict) -> None:
+    """
+    Streams the response to a message into a placeholder reply that is edited as the response is generated.
+    The finished response is logged in the message graph in the same way as finalize_message_response does.
+    :param message: The user message to reply to.
+    :param message_details: The details of the message.
+    """
+    streaming_reply = StreamingReply(message, edit_interval=STREAM_EDIT_INTERVAL)
+    await streaming_reply.start()
+    try:
+        response, error = await completion_client.stream(
+            build_message_chain(message_details), streaming_reply.update,
+            priority=message_details.get('priority', PRIORITY_NORMAL),
+            user_id=message_details['author_id'], channel_id=message_details['channel_id']
+        )
+    except asyncio.CancelledError:
+        # Superseded by a newer message in the same thread, remove the partial reply
+        await streaming_reply.discard()
+        raise
+
+    # Once the response is complete, finish delivering it even if a newer message supersedes this one, and have a
+    # newer message answered on its own rather than these messages answered again
+    request_coalescer.commit()
+    await asyncio.shield(deliver_streamed_response(message, message_details, streaming_reply, response, error))
+
+
+async def deliver_streamed_response(message: discord.Message, message_details: dict, streaming_reply: StreamingReply,
+                                    response: ChatCompletionMessage | None, error: str | None) -> None:
+    """
+    Completes a streamed reply, or runs the tool calls of the response, or reports the error.
+    :param message: The user message to reply to.
+    :param message_details: The details of the message.
+    :param streaming_reply: The reply the response was streamed into.
+    :param response: The response from the OpenAI API, or None if an error occurred.
+    :param error: The error message, or None.
+    """
+    if error:
+        # Show the error in place of the placeholder, without logging it
+        await streaming_reply.finish(error)
+        return
+
+    if response.tool_calls:
+        await streaming_reply.discard()
+        await process_tool_calls(message, response, message_details)
+        return
+
+    if not response.content:
+        await streaming_reply.finish("Error: The response was empty.")
+        return
+
+    sent_parts = await streaming_reply.finish(response.content)
+    log_response_parts(sent_parts, message_details['id'])
+
+
+def build_message_chain(message_details: dict) -> list:
+    """
+    Builds the conversation history to send to the model for a message.
+    The conversation is made to start with the initial prompt and is trimmed to fit the context budget.
+    :param message_details: The details of the incoming message.
+    :return: The message chain.
+    """
+    started = time.perf_counter()
     message_chain = message_graph.get_message_chain(message_details['id'])
-    # Ensure the conversation starts with the initial prompt if necessary
-    if len(message_chain) == 1:
-        prepend_initial_prompt(message_details['id'])
-        message_chain = message_graph.get_message_chain(message_details['id'])
+    # Ensure the conversation starts with the initial prompt if necessary.
+    # This also covers conversations whose first messages have been evicted.
+    if message_chain[0]['role'] != "system":
+        prepend_initial_prompt(message_graph.get_root_id(message_details['id']))
+
+    # Trim long conversations to fit the context budget
+    message_chain, trimmed_tokens = message_graph.get_budgeted_message_chain(
+        message_details['id'], CONTEXT_TOKEN_BUDGET, keep_recent=CONTEXT_KEEP_RECENT_MESSAGES
+    )
+    if trimmed_tokens:
+        print(f"Trimmed {trimmed_tokens} tokens from the conversation for message {message_details['id']}")
 
-    return await fetch_response_from_openai(message_chain)
+    metrics.observe("messages.build_chain", time.perf_counter() - started)
+    return message_chain
 
 
 def prepend_initial_prompt(message_id: int) -> None:
     """
     Prepends the initial prompt to the message chain if necessary.
-    :param message_id: The ID of the message to prepend the initial prompt to.
+    :param message_id: The ID of the first message in the chain, which the initial prompt is prepended to.
     """
     if not message_id:
         return
 
     system_message_id = f"{message_id}_system"
     message_graph.add_message(system_message_id, "system", initial_prompt, time.time())
-    message_graph.messages[message_id].parent_id = system_message_id
+    message_graph.set_parent(message_id, system_message_id)
 
 
 async def process_custom_prompt(message: discord.Message) -> None:
@@ -253,26 +562,40 @@ async def process_custom_prompt(message: discord.Message) -> None:
     await message.add_reaction("👍")
 
 
+async def process_sandbox_usage_request(message: discord.Message) -> None:
+    """
+    Replies with what the python tool's runs cost for the author and the channel, over the last SANDBOX_USAGE_WINDOW.
+    :param message: The message asking for the usage.
+    """
+    hours = SANDBOX_USAGE_WINDOW.total_seconds() / 3600
+    lines = [f"Python sandbox usage over the last {hours:g} hours:"]
+    for name, stats in (("You", sandbox_usage.stats(user_id=message.author.id)),
+                        ("This channel", sandbox_usage.stats(channel_id=message.channel.id))):
+        reasons = ", ".join(f"{reason} {count}" for reason, count in sorted(stats["exit_reasons"].items()))
+        peak_megabytes = stats["peak_memory_bytes"] / (1024 * 1024)
+        lines.append(f"{name}: {stats['runs']} runs, {stats['wall_seconds']:.1f}s wall time, "
+                     f"{stats['cpu_seconds']:.1f}s CPU time, peak memory {peak_megabytes:.0f} MB, "
+                     f"{stats['output_bytes']} bytes of output" + (f" ({reasons})" if reasons else ""))
+    await message.reply("\n".join(lines))
+
+
 # OpenAI API Functions
 
-async def fetch_response_from_openai(message_chain: list) -> Tuple[ChatCompletionMessage, None] | Tuple[None, str]:
+async def fetch_response_from_openai(message_chain: list, message_details: dict = None
+                                     ) -> Tuple[ChatCompletionMessage, None] | Tuple[None, str]:
     """
     Fetches a response from the OpenAI API.
     :param message_chain: the conversation history
+    :param message_details: The details of the message being responded to, used to schedule the request.
     :return: A tuple containing the response and an error message. One of them will be None.
     """
-    try:
-        completion = openai_client.chat.completions.create(
-            model=model,
-            messages=message_chain,
-            tools=tools,
-            tool_choice="auto"
-        )
-        response = completion.choices[0].message
-        return response, None
-    except Exception as e:
-        print(e)
-        return None, f"Error: {str(e)}"
+    if not message_details:
+        return await completion_client.create(message_chain)
+
+    return await completion_client.create(
+        message_chain, priority=message_details.get('priority', PRIORITY_NORMAL),
+        user_id=message_details['author_id'], channel_id=message_details['channel_id']
+    )
 
 
 # Utility Functions
@@ -282,8 +605,8 @@ def parse_message(message: discord.Message) -> dict | None:
     """
     Extracts important information from the message object retrieved from Discord's API.
     :param message: The message object.
-    :return: A dictionary containing the message details: ID, author role, content, and reply-to ID.
-    Role can be "user" or "assistant"
+    :return: A dictionary containing the message details: ID, author role, content, reply-to ID, author ID and
+    channel ID. Role can be "user" or "assistant"
     """
     if not message:
         return None
@@ -292,7 +615,9 @@ def parse_message(message: discord.Message) -> dict | None:
         'id': message.id,
         'author_role': "assistant" if message.author == discord_client.user else "user",
         'content': f"{message.author.display_name}: {message.content}",
-        'reply_to_id': parse_reply_to_id(message)
+        'reply_to_id': parse_reply_to_id(message),
+        'author_id': message.author.id,
+        'channel_id': message.channel.id
     }
 
 
@@ -304,7 +629,7 @@ def parse_reply_to_id(message: discord.Message) -> int | None:
     """
     if message.reference and message.reference.message_id:
         reply_to_id = message.reference.message_id
-        return reply_to_id if reply_to_id in message_graph.messages else None
+        return reply_to_id if reply_to_id in message_graph else None
     return None
 
 
@@ -320,60 +645,146 @@ async def finalize_message_response(original_message: discord.Message,
     :param message_id: The ID of the message in the message graph
     """
     # Split the response into multiple messages if it's too long
-    if len(response.content) > 2000:
-        response_parts = [response.content[i:i + 2000] for i in range(0, len(response.content), 2000)]
-        for part in response_parts:
-            sent_message = await original_message.reply(part)
-            response_id = sent_message.id
-            message_graph.add_message(response_id, "assistant", part, time.time(), reply_to=message_id)
-            message_id = response_id
-        return
-    sent_message = await original_message.reply(response.content)
-    response_id = sent_message.id
-    message_graph.add_message(response_id, "assistant", response.content, time.time(), reply_to=message_id)
+    response_parts = [response.content[i:i + 2000] for i in range(0, len(response.content), 2000)]
+    sent_parts = []
+    for part in response_parts:
+        sent_message = await original_message.reply(part)
+        sent_parts.append((sent_message, part))
+    log_response_parts(sent_parts, message_id)
+
+
+def log_response_parts(sent_parts: list, message_id: int) -> None:
+    """
+    Logs the parts of a response in the message graph, each part replying to the one before it.
+    :param sent_parts: A list of (sent message, part) tuples, in order.
+    :param message_id: The ID of the message the response replies to
+    """
+    for sent_message, part in sent_parts:
+        message_graph.add_message(sent_message.id, "assistant", part, time.time(), reply_to=message_id)
+        message_id = sent_message.id
 
 
 # Tool Call Handlers
 
 
-async def process_tool_calls(message: discord.Message, response: ChatCompletionMessage) -> None:
+async def process_tool_calls(message: discord.Message, response: ChatCompletionMessage,
+                             message_details: dict) -> None:
     """
-    Processes tool calls within the response.
+    Runs the tool calls of a response and sends their results back to the model until it gives a final answer.
 
-    This function dispatches each tool call to its respective handler based on the tool's name.
-    It makes it easy to extend the bot with additional tools by simply adding new handlers.
+    Every round, the tool calls in the response run concurrently, each dispatched to its handler in TOOL_HANDLERS.
+    The assistant message calling the tools and each result are added to the message graph, so the model sees them
+    in the next request and in any later conversation. This stops after TOOL_MAX_ROUNDS rounds, or when the turn
+    has taken longer than TOOL_TURN_TIME_BUDGET seconds.
+    :param message: The user message that the response answers.
+    :param response: The response from the OpenAI API containing the tool calls.
+    :param message_details: The details of the message.
     """
     if not response.tool_calls:
         return
     if not message:
         return
 
-    for tool_call in response.tool_calls:
-        tool_name = tool_call.function.name
-        # Dispatch the tool call to its handler
-        if tool_name == "python":
-            await handle_python_tool_call(message, tool_call)
-        elif tool_name == "timer":
-            await handle_timer_tool_call(message, tool_call)
-        else:
-            print(f"No handler for tool: {tool_name}")
+    deadline = time.monotonic() + TOOL_TURN_TIME_BUDGET
+    last_message_id = message_details['id']
+    for round_number in range(TOOL_MAX_ROUNDS):
+        tool_calls_id = f"{message_details['id']}_tool_calls_{round_number}"
+        try:
+            results = await asyncio.wait_for(
+                asyncio.gather(*(run_tool_call(message, tool_call) for tool_call in response.tool_calls)),
+                timeout=max(deadline - time.monotonic(), 0)
+            )
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # Every tool call still gets a result, later requests through an unanswered tool call would be invalid
+            timed_out = isinstance(e, asyncio.TimeoutError)
+            result = "Error: The tool took too long to respond." if timed_out else "Error: The tool was cancelled."
+            log_tool_round(tool_calls_id, response, [result] * len(response.tool_calls), last_message_id)
+            if not timed_out:
+                raise
+            await message.reply("Error: The tools took too long to respond.")
+            return
+
+        last_message_id = log_tool_round(tool_calls_id, response, results, last_message_id)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            await message.reply("Error: Ran out of time before the response was finished.")
+            return
+
+        async with message.channel.typing():
+            try:
+                response, error = await asyncio.wait_for(
+                    process_message({**message_details, 'id': last_message_id}), timeout=remaining
+                )
+            except asyncio.TimeoutError:
+                response, error = None, "Error: Ran out of time before the response was finished."
+        if error:
+            await message.reply(error)
+            return
+
+        if not response.tool_calls:
+            await finalize_message_response(message, response, last_message_id)
+            return
+
+    await message.reply(f"Error: Stopped after {TOOL_MAX_ROUNDS} rounds of tool calls.")
+
+
+def log_tool_round(tool_calls_id: str, response: ChatCompletionMessage, results: list[str], reply_to) -> str:
+    """
+    Adds the assistant message calling the tools and the result of each call to the message graph, each replying to
+    the one before it. They are only added together, the model rejects a tool call without a result.
+    :param tool_calls_id: The ID to give the assistant message.
+    :param response: The response from the OpenAI API containing the tool calls.
+    :param results: The result of each tool call, in the same order.
+    :param reply_to: The ID of the message the assistant message replies to.
+    :return: The ID of the last message added.
+    """
+    message_graph.add_message(tool_calls_id, "assistant", response.content or "", time.time(), reply_to=reply_to,
+                              tool_call=json.dumps([tool_call.model_dump() for tool_call in response.tool_calls]))
+    last_message_id = tool_calls_id
+    for tool_call, result in zip(response.tool_calls, results):
+        message_graph.add_message(tool_call.id, "tool", result, time.time(), reply_to=last_message_id,
+                                  tool_call=tool_call.id)
+        last_message_id = tool_call.id
+    return last_message_id
+
+
+async def run_tool_call(message: discord.Message, tool_call: ChatCompletionMessageToolCall) -> str:
+    """
+    Runs a single tool call with its handler.
+    :param message: The user message that the tool call answers.
+    :param tool_call: The tool call to run.
+    :return: The result to send back to the model, which describes the error if the tool failed.
+    """
+    tool_name = tool_call.function.name
+    handler = TOOL_HANDLERS.get(tool_name)
+    if handler is None:
+        print(f"No handler for tool: {tool_name}")
+        return f"Error: There is no tool called {tool_name}."
+
+    started = time.perf_counter()
+    try:
+        return await handler(message, tool_call)
+    except Exception as e:
+        print(f"Error running tool {tool_name}: {e}")
+        return f"Error: {e}"
+    finally:
+        metrics.observe(f"tools.{tool_name}", time.perf_counter() - started)
 
 
-async def handle_python_tool_call(message: discord.Message, tool_call: ChatCompletionMessageToolCall) -> None:
+async def handle_python_tool_call(message: discord.Message, tool_call: ChatCompletionMessageToolCall) -> str:
     """
     Handles tool calls for the Python executor tool.
 
     This function is responsible for executing Python code provided in tool calls
-    and sending the results back as a reply to the original message.
+    and showing the code and its results as replies to the original message.
+    The code runs in a worker thread from the code execution queue, so other messages are handled while it runs.
     :param message: The original message that triggered the tool call.
     :param tool_call: The tool call to handle.
+    :return: The output of the code, or the error it raised.
     """
-    if not message:
-        return
-    if not tool_call:
-        return
     if not tool_call.function.arguments:
-        return
+        return "Error: No code was provided."
 
     # Parse the command in case it's in JSON format
     command = parse_command_from_json(tool_call.function.arguments)
@@ -381,29 +792,51 @@ async def handle_python_tool_call(message: discord.Message, tool_call: ChatCompl
     tool_call_message = await message.reply(f"```python\n{command}```")
 
     # Execute the Python code
-    response, error = execute_python(command)
+    # Calls in the same conversation share a python session, keyed by the conversation's first message
+    root_id = message_graph.get_root_id(message.id) if python_sessions else None
+    session_id = PythonSessionManager.session_id_for(root_id) if root_id is not None else None
+    output, error, usage = await code_execution_queue.run(execute_python, command, session_id,
+                                                          user_id=message.author.id, message_id=message.id)
+    sandbox_usage.record(usage, user_id=message.author.id, channel_id=message.channel.id)
     if error:
-        await tool_call_message.reply(f"Error: {error}")
-        # add the error message to the graph
-        message_graph.add_message(tool_call_message.id, "system", error, time.time(), reply_to=message.id)
+        await tool_call_message.reply(f"Error: {error}"[:2000])
+        return f"Error: {error}"
+
+    await reply_with_output(tool_call_message, output)
+    return output.summary(PYTHON_OUTPUT_MODEL_CHARS)
+
+
+async def reply_with_output(message: discord.Message, output: OutputCapture) -> None:
+    """
+    Shows the output of a Python run. Output too long for one message is shown as its start and end, with the full
+    output attached as a file if attachments are enabled.
+    :param message: The message to reply to.
+    :param output: The output of the run.
+    """
+    max_chars = 2000 - len("``````")
+    fits = not output.exceeded and len(output.text()) <= max_chars
+    if fits or not PYTHON_OUTPUT_AS_ATTACHMENT:
+        await message.reply(f"```{output.summary(max_chars)}```")
         return
 
-    tool_response_message = await tool_call_message.reply(f"```{response}```")
-    # Log the tool call and the response in the message graph
-    log_tool_call_in_message_graph(message.id, tool_call_message.id, tool_response_message.id, command, response)
+    note = f"Output was {len(output)} bytes, see the attached file."
+    summary = output.summary(max_chars - len(note) - 1)
+    await message.reply(f"```{summary}```\n{note}",
+                        file=discord.File(io.BytesIO(output.data()), filename="output.txt"))
 
 
-async def handle_timer_tool_call(message: discord.Message, tool_call: ChatCompletionMessageToolCall) -> None:
+async def handle_timer_tool_call(message: discord.Message, tool_call: ChatCompletionMessageToolCall) -> str:
     """
     Handles tool calls for the timer tool.
+    The user is asked to confirm the timer in the background, so the model does not wait for them.
     :param message:  The original message that triggered the tool call.
     :param tool_call:  The tool call to handle.
-    :return:  None
+    :return:  The result to send back to the model.
     """
     # Get the parameters from the tool call
     parameters = tool_call.function.arguments
     if not parameters:
-        return
+        return "Error: No parameters were provided."
     # Get the name and the time/relative time from the parameters
     # Get the parameters as a dictionary from json
     parameters = json.loads(parameters)
@@ -412,10 +845,10 @@ async def handle_timer_tool_call(message: discord.Message, tool_call: ChatComple
     relative_time = parameters.get("relative_time")
     if timer_time is None and relative_time is None:
         print("Error: Either time or relative_time must be provided.")
-        return
+        return "Error: Either time or relative_time must be provided."
     # Set the timer
     if timer_time:
-        await set_timer(message, discord_client, timer_time, timer_name)
+        run_in_background(set_timer(message, discord_client, timer_scheduler, timer_time, timer_name))
     elif relative_time:
         # Get the current datetime
         now = datetime.now()
@@ -439,7 +872,25 @@ async def handle_timer_tool_call(message: discord.Message, tool_call: ChatComple
         # Convert the datetime object to an ISO 8601 formatted string
         iso_format_time = absolute_time.isoformat()
         # Pass the ISO 8601 string to the set_timer function
-        await set_timer(message, discord_client, iso_format_time, timer_name)
+        run_in_background(set_timer(message, discord_client, timer_scheduler, iso_format_time, timer_name))
+    return f"Asked the user to confirm the timer '{timer_name}'."
+
+
+# Handlers for each tool in CONFIG.py, taking the message and the tool call and returning the result for the model
+TOOL_HANDLERS = {
+    "python": handle_python_tool_call,
+    "timer": handle_timer_tool_call,
+}
+
+
+def run_in_background(coroutine) -> None:
+    """
+    Runs a coroutine without waiting for it, keeping a reference so the task is not garbage collected before it ends.
+    :param coroutine: The coroutine to run.
+    """
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
 
 
 def parse_command_from_json(command: str) -> str:
@@ -459,31 +910,29 @@ def parse_command_from_json(command: str) -> str:
         return command
 
 
-def log_tool_call_in_message_graph(message_id: int, tool_call_message_id: int, tool_response_message_id: int,
-                                   command: str, response: str) -> None:
-    """
-    Logs the tool call and its response in the message graph for persistence and future reference.
-    :param message_id: The Discord ID of the original message.
-    :param tool_call_message_id: The Discord ID of the tool call message.
-    :param tool_response_message_id:  The Discord ID of the tool response message.
-    :param command: The command executed by the tool.
-    :param response: The response generated by the tool.
+def execute_python(code: str, session_id: str | None = None
+                   ) -> Tuple[OutputCapture | None, str | None, RunUsage]:
     """
-    message_graph.add_message(tool_call_message_id, "assistant", command, time.time(), reply_to=message_id)
-    message_graph.add_message(tool_response_message_id, "system", response, time.time(),
-                              reply_to=tool_call_message_id)
-
-
-def execute_python(code: str) -> Tuple[str, str]:
-    """
-    Executes Python code using a DockerPythonExecutor.
-    Returns the output and any error encountered during execution.
+    Executes Python code in the sandbox backend chosen by PYTHON_SANDBOX_BACKEND. With Docker the code runs in a warm
+    container from the pool or in a python session.
+    Returns the output, any error encountered during execution and what the run used.
     :param code: The Python code to execute.
-    :return: A tuple containing the output and error messages. One of them will be None.
-    """
-    executor = DockerPythonExecutor()
-    output, error = executor.run_code(code)
-    return output, error
+    :param session_id: The python session to run the code in, or None to run it from scratch.
+    :return: A tuple containing the captured output, an error message and the run's usage. One of the first two will
+        be None.
+    """
+    if PYTHON_SANDBOX_BACKEND == 'subprocess':
+        executor = SubprocessPythonExecutor(max_output_bytes=PYTHON_MAX_OUTPUT_BYTES,
+                                            memory_limit_bytes=PYTHON_MEMORY_LIMIT_BYTES,
+                                            cpu_time_limit=PYTHON_CPU_TIME_LIMIT, result_cache=sandbox_result_cache)
+        output, error = executor.run_code(code)
+        return output, error, executor.usage
+    executor = DockerPythonExecutor(pool=python_container_pool, forkserver=PYTHON_USE_FORKSERVER,
+                                    max_output_bytes=PYTHON_MAX_OUTPUT_BYTES, sessions=python_sessions,
+                                    result_cache=sandbox_result_cache, memory_limit_bytes=PYTHON_MEMORY_LIMIT_BYTES,
+                                    cpu_time_limit=PYTHON_CPU_TIME_LIMIT)
+    output, error = executor.run_code(code, session_id)
+    return output, error, executor.usage
 
 
 # Message Scraping Functions
@@ -541,7 +990,17 @@ async def fetch_messages_after_date(channel_id: int, after_date: str) -> List[di
     return messages
 
 
+request_coalescer = RequestCoalescer(respond_to_messages, window=COALESCE_WINDOW, max_delay=COALESCE_MAX_DELAY)
+
 # Final setup
-discord_client.run(DISCORD_API_KEY)
-# Ensure that the message graph is saved when the bot exits
-atexit.register(lambda: message_graph.save_messages())
+# Only run the bot when started directly, so the load test in Benchmarks can import this module and drive on_message
+if __name__ == "__main__":
+    # Ensure that the message graph is saved when the bot exits, this must be registered before the blocking run() call
+    atexit.register(lambda: message_graph.save_messages())
+    atexit.register(lambda: python_container_pool.close())
+    atexit.register(lambda: timer_scheduler.store.close())
+    if python_sessions:
+        atexit.register(lambda: python_sessions.shutdown())
+    if response_cache:
+        atexit.register(lambda: response_cache.save())
+    discord_client.run(DISCORD_API_KEY)
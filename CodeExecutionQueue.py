@@ -0,0 +1,66 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from RequestScheduler import RequestScheduler, PRIORITY_NORMAL
+
+
+class CodeExecutionQueue:
+    """
+    Runs blocking sandbox jobs, e.g. DockerPythonExecutor.run_code, on a bounded pool of worker threads so the event
+    loop keeps serving other messages and timers while code runs.
+    At most max_concurrent_runs jobs run at once, the rest wait in a RequestScheduler queue that takes turns between
+    users. Jobs are registered under the message that asked for them, so they can be cancelled if it is deleted.
+    """
+    def __init__(self, max_concurrent_runs=4):
+        """
+        :param max_concurrent_runs: The maximum number of jobs running at once, e.g. the number of sandbox containers.
+        """
+        self.scheduler = RequestScheduler(max_concurrent_requests=max_concurrent_runs, max_retries=0,
+                                          metrics_prefix="sandbox")
+        self.threads = ThreadPoolExecutor(max_workers=max_concurrent_runs, thread_name_prefix="sandbox")
+        self.jobs = {}  # message ID -> tasks running or waiting to run jobs for that message
+
+    async def run(self, function, *args, user_id=None, message_id=None):
+        """
+        Wait for a free worker, then run the function in it.
+        If the job is cancelled while running, the worker is only freed once the function returns, so the cap on
+        concurrent jobs also holds for jobs nobody is waiting for any more.
+        :param function: The blocking function to run.
+        :param args: The arguments of the function.
+        :param user_id: The user the job is for, used to share the workers fairly.
+        :param message_id: The message the job is for, see cancel.
+        :return: The result of the function.
+        """
+        task = asyncio.current_task()
+        if message_id is not None:
+            self.jobs.setdefault(message_id, set()).add(task)
+        try:
+            await self.scheduler.acquire(0, PRIORITY_NORMAL, user_id=user_id)
+            future = asyncio.get_running_loop().run_in_executor(self.threads, function, *args)
+            future.add_done_callback(lambda _: self.scheduler.release())
+            return await asyncio.shield(future)
+        finally:
+            if message_id is not None:
+                tasks = self.jobs.get(message_id)
+                if tasks is not None:
+                    tasks.discard(task)
+                    if not tasks:
+                        del self.jobs[message_id]
+
+    def cancel(self, message_id) -> int:
+        """
+        Cancel the jobs for a message, e.g. because it was deleted. Waiting jobs never start, the callers of running
+        jobs stop waiting for them.
+        :param message_id: The ID of the message.
+        :return: The number of jobs cancelled.
+        """
+        tasks = self.jobs.pop(message_id, ())
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+    def stats(self) -> dict:
+        """
+        :return: The number of jobs waiting and running.
+        """
+        return {"queued": self.scheduler.queue_depth, "running": self.scheduler.in_flight}
@@ -0,0 +1,194 @@
+import time
+from typing import Tuple
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS, NOT_GIVEN
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
+
+from Metrics import metrics
+from RequestScheduler import RequestScheduler, PRIORITY_NORMAL
+from TokenCounter import count_tokens, MESSAGE_OVERHEAD_TOKENS
+
+
+class CompletionClient:
+    """
+    Sends chat completion requests without blocking the event loop.
+    All requests share one AsyncOpenAI client, and so one pool of keep-alive HTTP connections. Every request goes
+    through a RequestScheduler, which caps how many are in flight at once, applies the rate limits and retries failed
+    requests, and every request has its own timeout.
+    """
+    def __init__(self, api_key, model, tools=None, max_concurrent_requests=8, max_connections=16,
+                 request_timeout=60.0, base_url=None, scheduler=None, completion_token_estimate=500,
+                 response_cache=None):
+        """
+        Initialize the client.
+        :param api_key: The OpenAI API key.
+        :param model: The model to request completions from.
+        :param tools: The tool definitions sent with every request, or None.
+        :param max_concurrent_requests: The maximum number of requests in flight at once, others wait their turn.
+        :param max_connections: The size of the HTTP connection pool.
+        :param request_timeout: The timeout of a single request in seconds.
+        :param base_url: An alternative API endpoint, e.g. a local stand-in for benchmarks.
+        :param scheduler: The RequestScheduler to send requests through. By default, one without rate limits that
+        allows max_concurrent_requests at once.
+        :param completion_token_estimate: The number of tokens a response is assumed to use when rate limiting.
+        :param response_cache: A ResponseCache to answer repeated questions from, or None to always call the model.
+        """
+        self.model = model
+        self.tools = tools
+        self.request_timeout = request_timeout
+        self.scheduler = scheduler or RequestScheduler(max_concurrent_requests=max_concurrent_requests)
+        self.completion_token_estimate = completion_token_estimate
+        self.response_cache = response_cache
+        # The limits type of whichever HTTP library this version of openai is built on
+        limits = type(DEFAULT_CONNECTION_LIMITS)(max_connections=max_connections,
+                                                 max_keepalive_connections=max_connections)
+        http_client = DefaultAsyncHttpxClient(limits=limits)
+        # The scheduler does the retrying, with backoff shared by every request
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                                  timeout=request_timeout, max_retries=0)
+
+    async def create(self, message_chain: list, priority=PRIORITY_NORMAL, user_id=None,
+                     channel_id=None) -> Tuple[ChatCompletionMessage, None] | Tuple[None, str]:
+        """
+        Fetches a completion for the conversation.
+        :param message_chain: the conversation history
+        :param priority: The scheduling priority of the request, see RequestScheduler.
+        :param user_id: The user the request is for, used to share capacity fairly.
+        :param channel_id: The channel the request is for, used to share capacity fairly.
+        :return: A tuple containing the response and an error message. One of them will be None.
+        """
+        cache_key, cached_content = self.check_cache(message_chain)
+        if cached_content is not None:
+            return ChatCompletionMessage(role="assistant", content=cached_content), None
+
+        tokens = self.estimate_tokens(message_chain)
+
+        async def request():
+            started = time.perf_counter()
+            completion = await self.client.chat.completions.create(
+                model=self.model,
+                messages=message_chain,
+                tools=self.tools or NOT_GIVEN,
+                tool_choice="auto" if self.tools else NOT_GIVEN,
+                timeout=self.request_timeout
+            )
+            metrics.observe("openai.latency", time.perf_counter() - started)
+            return completion
+
+        try:
+            completion = await self.scheduler.run(request, tokens, priority, user_id, channel_id)
+        except Exception as e:
+            print(e)
+            metrics.increment("openai.errors")
+            return None, f"Error: {str(e)}"
+
+        if completion.usage:
+            self.scheduler.record_usage(tokens, completion.usage.total_tokens)
+        message = completion.choices[0].message
+        self.cache_response(cache_key, message_chain, message)
+        return message, None
+
+    async def stream(self, message_chain: list, on_content=None, priority=PRIORITY_NORMAL, user_id=None,
+                     channel_id=None) -> Tuple[ChatCompletionMessage, None] | Tuple[None, str]:
+        """
+        Streams a completion for the conversation, reporting the content as it arrives.
+        If the request is retried part way through, the content starts again from the beginning.
+        :param message_chain: the conversation history
+        :param on_content: An async callback called with the full content received so far after every new chunk.
+        :param priority: The scheduling priority of the request, see RequestScheduler.
+        :param user_id: The user the request is for, used to share capacity fairly.
+        :param channel_id: The channel the request is for, used to share capacity fairly.
+        :return: A tuple containing the assembled response and an error message. One of them will be None.
+        """
+        cache_key, cached_content = self.check_cache(message_chain)
+        if cached_content is not None:
+            if on_content:
+                await on_content(cached_content)
+            return ChatCompletionMessage(role="assistant", content=cached_content), None
+
+        tokens = self.estimate_tokens(message_chain)
+
+        async def request():
+            started = time.perf_counter()
+            stream = await self.client.chat.completions.create(
+                model=self.model,
+                messages=message_chain,
+                tools=self.tools or NOT_GIVEN,
+                tool_choice="auto" if self.tools else NOT_GIVEN,
+                timeout=self.request_timeout,
+                stream=True
+            )
+            content = ""
+            tool_calls = {}  # Tool calls arrive in fragments, keyed by their index
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    if not content:
+                        metrics.observe("openai.first_token", time.perf_counter() - started)
+                    content += delta.content
+                    if on_content:
+                        await on_content(content)
+                for call in delta.tool_calls or []:
+                    fragment = tool_calls.setdefault(call.index, {"id": None, "name": "", "arguments": ""})
+                    fragment["id"] = call.id or fragment["id"]
+                    if call.function:
+                        fragment["name"] += call.function.name or ""
+                        fragment["arguments"] += call.function.arguments or ""
+            metrics.observe("openai.latency", time.perf_counter() - started)
+            return content, tool_calls
+
+        try:
+            content, tool_calls = await self.scheduler.run(request, tokens, priority, user_id, channel_id)
+        except Exception as e:
+            print(e)
+            metrics.increment("openai.errors")
+            return None, f"Error: {str(e)}"
+
+        response = ChatCompletionMessage(
+            role="assistant",
+            content=content or None,
+            tool_calls=[
+                ChatCompletionMessageToolCall(id=call["id"], type="function",
+                                              function=Function(name=call["name"], arguments=call["arguments"]))
+                for _, call in sorted(tool_calls.items())
+            ] or None
+        )
+        self.cache_response(cache_key, message_chain, response)
+        return response, None
+
+    def check_cache(self, message_chain: list) -> Tuple[str | None, str | None]:
+        """
+        Look up the response to a chain in the response cache.
+        :param message_chain: the conversation history
+        :return: A tuple of the cache key, or None if the chain is not cacheable, and the cached content, or None.
+        """
+        if self.response_cache is None or not self.response_cache.is_cacheable(message_chain):
+            return None, None
+        cache_key = self.response_cache.make_key(self.model, self.tools, message_chain)
+        return cache_key, self.response_cache.get(cache_key)
+
+    def cache_response(self, cache_key: str | None, message_chain: list, response: ChatCompletionMessage) -> None:
+        """
+        Cache a response, unless its chain is not cacheable, the response calls tools or it addresses whoever asked.
+        """
+        if cache_key is None or not response.content or response.tool_calls:
+            return
+        if not self.response_cache.mentions_speaker(message_chain, response.content):
+            self.response_cache.put(cache_key, response.content)
+
+    def estimate_tokens(self, message_chain: list) -> int:
+        """
+        :return: The number of tokens a request is expected to use, for rate limiting.
+        """
+        prompt_tokens = sum(count_tokens(entry.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+                            for entry in message_chain)
+        return prompt_tokens + self.completion_token_estimate
+
+    async def close(self):
+        """
+        Close the pooled HTTP connections.
+        """
+        await self.client.close()
@@ -1,33 +1,74 @@
+import json
+import signal
+import time
+
 import docker
 import requests
 
+import PythonForkServer
+from PythonExecutor import PythonExecutor, KILLED_EXIT_CODE
+
 
-class DockerPythonExecutor:
-    """Runs the given Python code in a Docker container and returns the output."""
-    def __init__(self, image_name='python_runner', timeout=5):
-        self.client = docker.from_env()
+class DockerPythonExecutor(PythonExecutor):
+    """
+    Runs the given Python code in a Docker container and returns the output.
+    With a PythonContainerPool the code runs in one of the pool's warm containers, otherwise a new container is
+    started for every run. If the pool's containers run PythonForkServer, set forkserver so code is submitted to it
+    and starts with the heavy libraries already imported.
+    With a PythonSessionManager, code given a session ID runs in that session and keeps its variables for the next
+    run in the same session.
+    Output is read from the container as it is produced, with stdout and stderr kept apart. A run that prints more
+    than max_output_bytes to either of them is stopped, keeping the output up to that point.
+    The memory and CPU time limits apply to each run, sessions have the memory limit of their PythonSessionManager.
+    """
+    def __init__(self, image_name='python_runner', timeout=5, pool=None, forkserver=False,
+                 max_output_bytes=1024 * 1024, sessions=None, result_cache=None, memory_limit_bytes=None,
+                 cpu_time_limit=None):
+        super().__init__(timeout=timeout, max_output_bytes=max_output_bytes, result_cache=result_cache,
+                         memory_limit_bytes=memory_limit_bytes, cpu_time_limit=cpu_time_limit)
+        self.pool = pool
+        self.sessions = sessions
+        self.forkserver = forkserver
+        self.client = None if pool else docker.from_env()
         self.image_name = image_name
-        self.timeout = timeout
 
-    def run_code(self, code):
-        container = None
-        # GPT4 has a bad habit of just putting the output variables as the last line
-        # We need to make sure they are actually printed out
-        code = self.ensure_print_statement(code)
+    def execute(self, code, session_id, stdout, stderr):
+        if self.sessions and session_id is not None:
+            return self.run_code_in_session(code, session_id, stdout, stderr)
+        if self.pool:
+            return self.run_code_in_pool(code, stdout, stderr)
+        return self.run_code_in_new_container(code, stdout, stderr)
 
+    def environment_digest(self) -> str:
+        """
+        :return: The ID of the image the code runs in, which changes whenever it is rebuilt.
+        """
+        if self.pool:
+            if self.pool.client is None:
+                self.pool.start()
+            client, image_name = self.pool.client, self.pool.image_name
+        else:
+            client, image_name = self.client, self.image_name
+        return self.result_cache.digest(f"docker:{image_name}", lambda: client.images.get(image_name).id)
+
+    def run_code_in_new_container(self, code, stdout, stderr):
+        """
+        Runs the code in a container started for it.
+        """
+        container = None
         try:
-            container = self.client.containers.run(self.image_name,
-                                                   command=["python", "-c", code],
-                                                   detach=True)
+            started = time.monotonic()
+            container = self.client.containers.run(self.image_name, command=self.command(code), detach=True)
+            output = container.attach(stdout=True, stderr=True, stream=True, logs=True, demux=True)
+            if not self.collect(output, stdout, stderr):
+                container.kill()
+                return stdout, None
+
             # Wait for the container to finish
             result = container.wait(timeout=self.timeout)
-
-            # Check if the container timed out
-            if result.get('StatusCode', 0) != 0:
-                return None, "Error: Code execution timed out or error occurred."
-
-            output = container.logs()
-            return output.decode('utf-8'), None
+            exit_code = result.get('StatusCode', 0)
+            self.read_usage(exit_code, time.monotonic() - started, stderr)
+            return self.result(exit_code, stdout, stderr)
         # Return the specific error message to the user if possible
         except docker.errors.ContainerError as e:
             return None, f"Container error: {e.stderr.decode('utf-8')}"
@@ -45,18 +86,114 @@ class DockerPythonExecutor:
                     pass
                 container.remove()
 
-    @staticmethod
-    def ensure_print_statement(code):
-        """Ensure that the script prints something"""
-        lines = code.strip().split('\n')
+    def run_code_in_pool(self, code, stdout, stderr):
+        """
+        Runs the code in a warm container from the pool.
+        """
+        try:
+            pooled = self.pool.acquire(timeout=self.timeout)
+        except Exception as e:
+            return None, f"An error occurred: {e}"
 
-        # Check if any line contains a print statement
-        has_print = any("print(" in line for line in lines)
+        reusable = False
+        try:
+            started = time.monotonic()
+            exit_code = self.exec_in(self.pool.client.api, pooled.container, self.command(code), stdout, stderr)
+            if exit_code is None:
+                # The code is still running, the container is replaced rather than reused
+                return stdout, None
+            self.read_usage(exit_code, time.monotonic() - started, stderr)
+            # A run killed by the timeout may have left processes behind, the state check catches other leaks
+            reusable = exit_code != KILLED_EXIT_CODE
+            return self.result(exit_code, stdout, stderr)
+        except Exception as e:
+            return None, f"An error occurred: {e}"
+        finally:
+            self.pool.release(pooled, reusable=reusable)
+
+    def run_code_in_session(self, code, session_id, stdout, stderr):
+        """
+        Runs the code in a session, see PythonSessionManager.
+        """
+        try:
+            with self.sessions.use(session_id) as session:
+                command = self.sessions.command(session_id, code, self.timeout, self.cpu_time_limit)
+                exit_code = self.exec_in(self.sessions.pool.client.api, self.sessions.container(), command, stdout,
+                                         stderr)
+                if exit_code is not None:
+                    self.read_usage(exit_code, None, stderr, forkserver=True)
+                # Killed by the timeout, or still running after printing too much, its variables are lost either way
+                session.broken = exit_code is None or exit_code == KILLED_EXIT_CODE
+        except Exception as e:
+            return None, f"An error occurred: {e}"
+
+        if exit_code is None:
+            return stdout, None
+        output, error = self.result(exit_code, stdout, stderr)
+        if exit_code == KILLED_EXIT_CODE:
+            error = f"{error}\nThe session's variables were lost."
+        return output, error
 
-        if not has_print and lines:
-            # Add a print statement around the last line if it's not empty
-            last_line = lines[-1].strip()
-            if last_line:
-                lines[-1] = f'print({last_line})'
+    def exec_in(self, api, container, command, stdout, stderr):
+        """
+        Run a command in a running container, collecting its output.
+        :return: The exit code of the command, or None if it printed too much and was cut off.
+        """
+        exec_id = api.exec_create(container.id, command)["Id"]
+        output = api.exec_start(exec_id, stream=True, demux=True)
+        if not self.collect(output, stdout, stderr):
+            return None
+        return api.exec_inspect(exec_id)["ExitCode"]
 
-        return '\n'.join(lines)
+    def read_usage(self, exit_code, elapsed, stderr, forkserver=None):
+        """
+        Fill in usage from a finished run. The fork server measures the run itself and appends its usage to stderr,
+        which is cut off here. Otherwise only how the run was killed can be told, from the exit code of timeout.
+        :param elapsed: How long the run took, in seconds.
+        :param forkserver: Whether the run went through the fork server, by default whether forkserver is set.
+        """
+        if self.forkserver if forkserver is None else forkserver:
+            trailer = stderr.remove_trailer(PythonForkServer.USAGE_MARKER.encode())
+            try:
+                reported = json.loads(trailer) if trailer else {}
+            except ValueError:
+                reported = {}
+            for name in ("cpu_seconds", "peak_memory_bytes", "timed_out", "signal"):
+                if reported.get(name) is not None:
+                    setattr(self.usage, name, reported[name])
+        elif exit_code > 128:
+            # A shell style exit code for a signal, either timeout's SIGKILL or e.g. SIGXCPU from the CPU limit
+            self.usage.signal = exit_code - 128
+            self.usage.timed_out = self.usage.signal == signal.SIGKILL and elapsed >= self.timeout
+
+    def command(self, code):
+        """
+        :return: The command that runs the code in a container, killing it after the timeout.
+        """
+        if self.forkserver:
+            return PythonForkServer.run_command(code, self.timeout, self.memory_limit_bytes, self.cpu_time_limit)
+        # The limits are set by the shell, so they also apply to runs in a pooled container. Only the soft CPU limit
+        # is set, for SIGXCPU rather than the SIGKILL of the hard limit.
+        limits = f"ulimit -S -t {int(self.cpu_time_limit)}"
+        if self.memory_limit_bytes:
+            limits += f" && ulimit -v {int(self.memory_limit_bytes) // 1024}"
+        return ["sh", "-c", f'{limits} && exec timeout -s KILL "$0" python -c "$1"', str(self.timeout), code]
+
+    @staticmethod
+    def collect(output, stdout, stderr):
+        """
+        Read the output of a run as it arrives.
+        :param output: The stream of (stdout, stderr) chunks from Docker, either of which may be None.
+        :param stdout: The OutputCapture for stdout.
+        :param stderr: The OutputCapture for stderr.
+        :return: False if the run printed too much and was cut off, True if it finished.
+        """
+        for stdout_chunk, stderr_chunk in output:
+            if stdout_chunk:
+                stdout.write(stdout_chunk)
+            if stderr_chunk:
+                stderr.write(stderr_chunk)
+            if stdout.exceeded or stderr.exceeded:
+                output.close()
+                return False
+        return True
@@ -1,14 +1,27 @@
-import json
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 
-from MessageNode import MessageNode
+from ChainCache import ChainCache
+from MessageNode import MessageNode, compact_id
+from MessageStore import DictMessageStore, DEFAULT_RETENTION
+from TokenCounter import count_tokens, MESSAGE_OVERHEAD_TOKENS
 
 
 class MessageGraph:
-    def __init__(self, file_path):
-        self.messages = {}
-        self.file_path = file_path
-        self.load_messages()
+    def __init__(self, file_path=None, store=None, fsync=True, chain_cache_size=100000):
+        """
+        Initialize the graph on top of a storage backend.
+        :param file_path: The path of the JSON snapshot used by the default dictionary backend.
+        :param store: The MessageStore to use, if None a DictMessageStore is created from file_path.
+        :param fsync: Whether the default dictionary backend fsyncs its log after every change.
+        :param chain_cache_size: The total number of messages the chain cache may hold across all cached chains.
+        """
+        if store is None:
+            if file_path is None:
+                raise ValueError("Either file_path or store must be provided")
+            store = DictMessageStore(file_path, fsync=fsync)
+        self.store = store
+        self.chain_cache = ChainCache(max_entries=chain_cache_size)
 
     def add_message(self, message_id, role, content, timestamp, reply_to=None, tool_call=None):
         """
@@ -18,7 +31,8 @@ class MessageGraph:
         :param content: The content of the message, as a string.
         :param timestamp: The timestamp of the message.
         :param reply_to: The ID of the message to which this message is a reply, or None if it is not a reply.
-        :param tool_call: The ID of the tool call associated with this message, or None if it is not a tool call.
+        :param tool_call: The ID of the tool call a tool message is the result of, or the tool calls of an assistant
+        message as a JSON list, see MessageNode. None for other messages.
         :return:
         """
         if message_id is None:  # While not recommended, it is possible to use any data type as message IDs
@@ -31,30 +45,121 @@ class MessageGraph:
             return "Timestamp cannot be None"
 
         new_message = MessageNode(message_id, role, content, timestamp, parent_id=reply_to, tool_call=tool_call)
-        self.messages[message_id] = new_message
+        self.store.put(new_message)
+        # A replaced message invalidates any chain built on it, and lets chains cached before it existed be rebuilt
+        self.chain_cache.invalidate(message_id)
+
+    def set_parent(self, message_id, parent_id):
+        """
+        Change the message the given message is a reply to, e.g. to prepend a system prompt to a chain.
+        :param message_id: The discord ID of the message.
+        :param parent_id: The ID of the new parent message, or None to make the message a root.
+        :return: An error string if the message is not found, otherwise None.
+        """
+        if message_id not in self.store:
+            return "Message not found"
+
+        self.store.set_parent(message_id, compact_id(parent_id))
+        self.chain_cache.invalidate(message_id)
 
     def get_message_chain(self, message_id):
         """
         Build a chain of messages starting from the given message and including the 'chain' of replies to it.
         :param message_id:  The discord ID of the message.
         :return: A list of dictionaries, each containing the role and content of a message in the chain.
+        The dictionaries are shared with the message nodes and must not be modified.
         """
-        if message_id not in self.messages:
+        nodes = self.get_chain_nodes(message_id)
+        if nodes is None:
             return "Message not found"
 
-        chain = []
-        current_id = message_id
+        return [node.to_chain_entry() for node in nodes]
+
+    def get_chain_nodes(self, message_id):
+        """
+        Get the message nodes in the chain ending at the given message, using the chain cache where possible.
+        :param message_id:  The discord ID of the message.
+        :return: A tuple of MessageNodes, root first, or None if the message is not found.
+        """
+        chain = self.chain_cache.get(message_id)
+        if chain is not None:
+            return chain
+
+        node = self.store.get(message_id)
+        if node is None:
+            return None
+
+        # Extend the parent's cached chain if possible, otherwise walk the chain in the store. Peeked, so a reply
+        # whose chain is not cached counts as one miss, not two.
+        parent_chain = self.chain_cache.peek(node.parent_id) if node.parent_id is not None else ()
+        if parent_chain is not None:
+            chain = parent_chain + (node,)
+        else:
+            chain = tuple(self.store.chain(message_id))
+
+        self.chain_cache.put(message_id, chain)
+        return chain
+
+    def get_budgeted_message_chain(self, message_id, token_budget, keep_recent=4):
+        """
+        Build the message chain for the given message, trimmed to fit a token budget.
+        The system prompt at the root and the most recent messages are always kept, older messages in between are
+        dropped (newest kept first) and replaced by a short note saying how many were left out.
+        :param message_id: The discord ID of the message.
+        :param token_budget: The maximum number of tokens the chain should take up.
+        :param keep_recent: The number of most recent messages to keep even if they exceed the budget.
+        :return: A tuple of the chain (as in get_message_chain) and the number of tokens trimmed from it.
+        """
+        nodes = self.get_chain_nodes(message_id)
+        if nodes is None:
+            return "Message not found", 0
+
+        total_tokens = sum(node.token_count for node in nodes)
+        if total_tokens <= token_budget:
+            return [node.to_chain_entry() for node in nodes], 0
+
+        head = nodes[:1] if nodes[0].role == "system" else ()
+        body = nodes[len(head):]
+        recent_start = max(len(body) - keep_recent, 0)
+        used_tokens = sum(node.token_count for node in head) + sum(node.token_count for node in body[recent_start:])
+        # Reserve room for the note, its exact length barely depends on the number of dropped messages
+        note_tokens = count_tokens(self.elision_note(len(body))) + MESSAGE_OVERHEAD_TOKENS
+
+        # Keep adding older messages while they fit
+        while recent_start > 0 and used_tokens + note_tokens + body[recent_start - 1].token_count <= token_budget:
+            recent_start -= 1
+            used_tokens += body[recent_start].token_count
+        # A tool result is meaningless without the assistant message that called it
+        while recent_start < len(body) - 1 and body[recent_start].role == "tool":
+            used_tokens -= body[recent_start].token_count
+            recent_start += 1
+
+        chain = [node.to_chain_entry() for node in head]
+        if recent_start > 0:
+            chain.append({"role": "system", "content": self.elision_note(recent_start)})
+        chain.extend(node.to_chain_entry() for node in body[recent_start:])
+        trimmed_tokens = sum(node.token_count for node in body[:recent_start])
+        return chain, trimmed_tokens
+
+    @staticmethod
+    def elision_note(dropped_messages):
+        """
+        The note that replaces messages dropped from a chain by get_budgeted_message_chain.
+        :param dropped_messages: The number of messages dropped.
+        """
+        return f"[{dropped_messages} earlier messages in this conversation were omitted to save space]"
 
-        while current_id:
-            current_node = self.messages[current_id]
-            if current_node.role == "tool":
-                chain.append({"role": current_node.role, "content": current_node.content,
-                              "tool_call_id": current_node.tool_call})
-            else:
-                chain.append({"role": current_node.role, "content": current_node.content})
-            current_id = current_node.parent_id
+    def get_root_id(self, message_id):
+        """
+        Get the ID of the first message in the chain ending at the given message.
+        :param message_id:  The discord ID of the message.
+        :return: The ID of the root message, or None if the message is not found.
+        """
+        nodes = self.get_chain_nodes(message_id)
+        if nodes is None:
+            return None
 
-        return chain[::-1]
+        return nodes[0].message_id
 
     def get_message_role(self, message_id):
         """
@@ -62,45 +167,35 @@ class MessageGraph:
         :param message_id:  The discord ID of the message.
         :return: The role of the message as a string, or "None" if the message is not found.
         """
-        if message_id not in self.messages:
+        node = self.store.get(message_id)
+        if node is None:
             return "None"
 
-        return self.messages[message_id].role
+        return node.role
 
-    def save_messages(self):
-        """
-        Save the messages to a JSON file.
-        """
-        with open(self.file_path, 'w') as file:
-            json.dump({mid: node.to_dict() for mid, node in self.messages.items()}, file)
+    def __contains__(self, message_id):
+        return message_id in self.store
 
-    def load_messages(self):
+    def save_messages(self):
         """
-        Load the messages from a JSON file, or create an empty graph if the file does not exist.
+        Persist the messages, for the dictionary backend this writes a snapshot and truncates the log.
         """
-        try:
-            with open(self.file_path, 'r') as file:
-                data = json.load(file)
-                one_week_ago = datetime.now() - timedelta(weeks=1)
-
-                for mid, mdata in data.items():
-                    if datetime.fromtimestamp(mdata["timestamp"]) > one_week_ago:
-                        self.messages[mid] = MessageNode.from_dict(mdata)
+        self.store.save()
 
-        except FileNotFoundError:
-            pass  # File not found, so we start with an empty graph
-
-    def delete_old_messages(self):
+    def delete_old_messages(self, retention=DEFAULT_RETENTION):
         """
-        Delete messages older than one year.
+        Delete messages older than the retention period.
+        Replies to a deleted message are kept, their chains simply start at the oldest message still stored.
+        :param retention: How long to keep messages, as a timedelta.
+        :return: A dictionary of eviction metrics: the number of messages evicted and the time taken in seconds.
         """
-        one_year_ago = datetime.now() - timedelta(weeks=52)
-        to_delete = [mid for mid, node in self.messages.items() if datetime.fromtimestamp(node.timestamp) < one_year_ago]
-
-        for mid in to_delete:
-            del self.messages[mid]
+        start = time.perf_counter()
+        cutoff = (datetime.now() - retention).timestamp()
+        deleted = self.store.delete_older_than(cutoff)
+        for message_id in deleted:
+            self.chain_cache.invalidate(message_id)
 
-        self.save_messages()
+        return {"evicted": len(deleted), "duration": time.perf_counter() - start}
 
     def __del__(self):
         """
@@ -0,0 +1,61 @@
+import json
+import os
+
+
+class MessageLog:
+    """
+    An append-only, line-delimited JSON log of changes made to a MessageGraph.
+    Each change is written (and optionally fsynced) as soon as it happens, so a crash loses at most the record
+    being written. The log is truncated whenever a full snapshot of the graph has been saved.
+    """
+    def __init__(self, file_path, fsync=True):
+        """
+        Initialize the log.
+        :param file_path: The path of the log file, it is created if it does not exist.
+        :param fsync: Whether to fsync after every record. Disabling this trades durability for speed.
+        """
+        self.file_path = file_path
+        self.fsync = fsync
+        self.file = open(self.file_path, 'a', encoding='utf-8')
+
+    def append(self, record):
+        """
+        Append a record to the log.
+        :param record: A JSON serialisable dictionary describing the change.
+        """
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def replay(self):
+        """
+        Read the records in the log, oldest first.
+        A torn final line (e.g. from a crash mid-write) is ignored.
+        :return: A generator of the records in the log.
+        """
+        try:
+            with open(self.file_path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"Skipping corrupt record in {self.file_path}")
+        except FileNotFoundError:
+            return
+
+    def truncate(self):
+        """
+        Empty the log, to be called once every record in it is covered by a snapshot.
+        """
+        self.file.truncate(0)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        """
+        Close the log file.
+        """
+        if not self.file.closed:
+            self.file.close()
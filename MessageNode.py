@@ -1,4 +1,44 @@
+import json
+from enum import Enum
+
+from TokenCounter import count_tokens, MESSAGE_OVERHEAD_TOKENS
+
+
+class Role(str, Enum):
+    """
+    The role of a message. Members compare equal to their plain string values, and every node shares the same
+    member object instead of holding its own copy of the string.
+    """
+    USER = "user"
+    ASSISTANT = "assistant"
+    TOOL = "tool"
+    SYSTEM = "system"
+
+    def __str__(self):
+        return self.value
+
+
+# Lookup table used instead of Role(value), which is much slower when building millions of nodes
+ROLES = {role.value: role for role in Role}
+
+
+def compact_id(message_id):
+    """
+    Convert a message ID to an integer where possible, e.g. discord IDs that were turned into strings by JSON.
+    Integers take less memory than strings and compare faster.
+    :param message_id: The message ID.
+    :return: The ID as an integer if it is a string of digits, otherwise the ID unchanged.
+    """
+    if isinstance(message_id, str) and message_id.isdigit():
+        return int(message_id)
+    return message_id
+
+
 class MessageNode:
+    # Nodes have no __dict__, which matters when the graph holds millions of them
+    __slots__ = ("message_id", "role", "content", "timestamp", "parent_id", "tool_call",
+                 "_token_count", "_chain_entry")
+
     def __init__(self, message_id, role, content, timestamp, parent_id=None, tool_call=None):
         """
         Initialize a new message node.
@@ -7,14 +47,47 @@ class MessageNode:
         :param content: The content of the message, as a string.
         :param timestamp: The timestamp of the message.
         :param parent_id: The ID of the message to which this message is a reply, or None if it is not a reply.
-        :param tool_call: The ID of the tool call associated with this message, or None if it is not a tool call.
+        :param tool_call: For tool messages, the ID of the tool call this message is the result of. For assistant
+        messages that call tools, the tool calls as a JSON list in the format of the chat completions API.
+        Otherwise None.
         """
-        self.message_id = message_id
-        self.role = role
+        self.message_id = compact_id(message_id)
+        self.role = ROLES[role]
         self.content = content
         self.timestamp = timestamp
-        self.parent_id = parent_id  # 'Pointer' to the parent message
+        self.parent_id = compact_id(parent_id)  # 'Pointer' to the parent message
         self.tool_call = tool_call
+        self._token_count = None  # Computed on first use, see token_count
+        self._chain_entry = None  # Built on first use, see to_chain_entry
+
+    @property
+    def token_count(self):
+        """
+        The number of tokens this message takes up in a chat completion request, including the per-message overhead.
+        Counted once with the local tokenizer and cached, as the content of a message never changes.
+        """
+        if self._token_count is None:
+            self._token_count = count_tokens(self.content) + MESSAGE_OVERHEAD_TOKENS
+            if self.tool_call:
+                self._token_count += count_tokens(self.tool_call)
+        return self._token_count
+
+    def to_chain_entry(self):
+        """
+        Convert the message node to the dictionary format used in message chains.
+        The dictionary is built once and shared by every chain containing this message, so it must not be modified.
+        :return: A dictionary with the role and content of the message, the tool call ID for tool messages and the
+        tool calls for assistant messages that call tools.
+        """
+        if self._chain_entry is None:
+            if self.role == Role.TOOL:
+                self._chain_entry = {"role": self.role.value, "content": self.content, "tool_call_id": self.tool_call}
+            elif self.role == Role.ASSISTANT and self.tool_call:
+                self._chain_entry = {"role": self.role.value, "content": self.content or None,
+                                     "tool_calls": json.loads(self.tool_call)}
+            else:
+                self._chain_entry = {"role": self.role.value, "content": self.content}
+        return self._chain_entry
 
     def to_dict(self):
         """
@@ -24,7 +97,7 @@ class MessageNode:
         """
         return {
             "message_id": self.message_id,
-            "role": self.role,
+            "role": self.role.value,
             "content": self.content,
             "timestamp": self.timestamp,
             "parent_id": self.parent_id,
@@ -0,0 +1,348 @@
+import heapq
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from itertools import count, islice
+
+from MessageLog import MessageLog
+from MessageNode import MessageNode
+from SnapshotReader import iter_snapshot
+
+# How long messages are kept by default, both when loading and when evicting old messages
+DEFAULT_RETENTION = timedelta(weeks=1)
+
+
+class MessageStore:
+    """
+    The storage backend of a MessageGraph.
+    Subclasses decide where MessageNodes live, the graph only talks to them through these methods.
+    """
+    def get(self, message_id):
+        """
+        Get a message node.
+        :param message_id: The discord ID of the message.
+        :return: The MessageNode, or None if it is not stored.
+        """
+        raise NotImplementedError
+
+    def put(self, node):
+        """
+        Store a message node, replacing any node with the same ID.
+        :param node: The MessageNode to store.
+        """
+        raise NotImplementedError
+
+    def set_parent(self, message_id, parent_id):
+        """
+        Change the parent of a stored message node.
+        :param message_id: The discord ID of the message.
+        :param parent_id: The ID of the new parent message, or None.
+        """
+        raise NotImplementedError
+
+    def chain(self, message_id):
+        """
+        Get the chain of message nodes from the root of the conversation to the given message.
+        :param message_id: The discord ID of the last message in the chain.
+        :return: A list of MessageNodes, root first, or an empty list if the message is not stored.
+        """
+        raise NotImplementedError
+
+    def delete_older_than(self, timestamp):
+        """
+        Delete every message older than the given timestamp.
+        Only the expired messages are visited, via an index ordered by timestamp.
+        :param timestamp: The cutoff, as a unix timestamp.
+        :return: A list of the IDs of the deleted messages.
+        """
+        raise NotImplementedError
+
+    def save(self):
+        """
+        Make sure every change is persisted.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Release any files or connections held by the store.
+        """
+
+    def __contains__(self, message_id):
+        return self.get(message_id) is not None
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class DictMessageStore(MessageStore):
+    """
+    Keeps every message node in a dictionary, persisted as a JSON snapshot plus an append-only log of changes.
+    A min-heap of (timestamp, sequence number, message ID) orders the messages by age for eviction. Entries for
+    replaced or deleted messages are left in the heap and skipped when they reach the top.
+    """
+    def __init__(self, file_path, fsync=True, retention=DEFAULT_RETENTION):
+        """
+        Initialize the store from its snapshot file and log.
+        :param file_path: The path of the JSON snapshot, the log is stored next to it with a .log suffix.
+        :param fsync: Whether to fsync the log after every change.
+        :param retention: Messages older than this are not loaded from the snapshot.
+        """
+        self.messages = {}
+        self.file_path = file_path
+        self.retention = retention
+        self.expiry_heap = []
+        self.sequence = count()  # Breaks timestamp ties, as integer and string message IDs cannot be compared
+        self.log = MessageLog(f"{file_path}.log", fsync=fsync)
+        self.load()
+
+    def get(self, message_id):
+        return self.messages.get(message_id)
+
+    def put(self, node):
+        self.messages[node.message_id] = node
+        heapq.heappush(self.expiry_heap, (node.timestamp, next(self.sequence), node.message_id))
+        self.log.append({"op": "add", "node": node.to_dict()})
+
+    def set_parent(self, message_id, parent_id):
+        self.messages[message_id].parent_id = parent_id
+        self.log.append({"op": "set_parent", "message_id": message_id, "parent_id": parent_id})
+
+    def chain(self, message_id):
+        chain = []
+        current_id = message_id
+
+        while current_id in self.messages:
+            current_node = self.messages[current_id]
+            chain.append(current_node)
+            current_id = current_node.parent_id
+
+        return chain[::-1]
+
+    def delete_older_than(self, timestamp):
+        deleted = []
+        while self.expiry_heap and self.expiry_heap[0][0] < timestamp:
+            node_timestamp, _, mid = heapq.heappop(self.expiry_heap)
+            node = self.messages.get(mid)
+            # Skip entries left behind by messages that were since replaced or deleted
+            if node is not None and node.timestamp == node_timestamp:
+                del self.messages[mid]
+                deleted.append(mid)
+
+        if deleted:
+            self.log.append({"op": "delete", "message_ids": deleted})
+        return deleted
+
+    def save(self):
+        """
+        Snapshot the messages to a JSON file and truncate the log.
+        The snapshot is written to a temporary file first and atomically renamed,
+        so a crash mid-save leaves the previous snapshot and the log intact.
+        """
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            # Write one record at a time rather than building a copy of the whole graph first
+            file.write("{")
+            for index, (mid, node) in enumerate(self.messages.items()):
+                separator = ",\n" if index else "\n"
+                file.write(f"{separator}{json.dumps(str(mid))}: {json.dumps(node.to_dict())}")
+            file.write("\n}")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.file_path)
+        self.log.truncate()
+
+    def load(self):
+        """
+        Load the messages from the JSON snapshot and replay the log on top of it,
+        or start with an empty store if neither exists.
+        """
+        cutoff = (datetime.now() - self.retention).timestamp()
+        try:
+            # Stream the snapshot so messages past the cutoff are never all held in memory at once
+            for mdata in iter_snapshot(self.file_path, min_timestamp=cutoff):
+                node = MessageNode.from_dict(mdata)
+                # Key on the stored ID, JSON turns integer keys into strings
+                self.messages[node.message_id] = node
+
+        except FileNotFoundError:
+            pass  # File not found, so we start with an empty graph
+
+        for record in self.log.replay():
+            self.apply_log_record(record)
+
+        self.expiry_heap = [(node.timestamp, next(self.sequence), mid) for mid, node in self.messages.items()]
+        heapq.heapify(self.expiry_heap)
+
+    def apply_log_record(self, record):
+        """
+        Apply a single record from the log to the in-memory messages.
+        :param record: The record, as written by put, set_parent or delete_older_than.
+        """
+        if record["op"] == "add":
+            node = MessageNode.from_dict(record["node"])
+            self.messages[node.message_id] = node
+        elif record["op"] == "set_parent" and record["message_id"] in self.messages:
+            self.messages[record["message_id"]].parent_id = record["parent_id"]
+        elif record["op"] == "delete":
+            for mid in record["message_ids"]:
+                self.messages.pop(mid, None)
+
+    def close(self):
+        self.log.close()
+
+    def __contains__(self, message_id):
+        return message_id in self.messages
+
+    def __len__(self):
+        return len(self.messages)
+
+
+class SQLiteMessageStore(MessageStore):
+    """
+    Keeps message nodes in an SQLite database, with only recently used nodes held in memory.
+    Message IDs may be integers or strings, the ID columns have no type affinity so both round-trip unchanged.
+    """
+    COLUMNS = "message_id, role, content, timestamp, parent_id, tool_call"
+
+    def __init__(self, db_path, cache_size=1024, legacy_json_path=None):
+        """
+        Open (or create) the database.
+        :param db_path: The path of the SQLite database file.
+        :param cache_size: The number of message nodes to keep in the in-memory LRU cache.
+        :param legacy_json_path: A message_history.json snapshot to import if the database is empty.
+        """
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                message_id PRIMARY KEY,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                parent_id,
+                tool_call
+            );
+            CREATE INDEX IF NOT EXISTS messages_parent_id ON messages (parent_id);
+            CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp);
+        """)
+        self.connection.commit()
+
+        if legacy_json_path and len(self) == 0:
+            self.import_json(legacy_json_path)
+
+    def import_json(self, json_path):
+        """
+        Import the messages from a JSON snapshot written by DictMessageStore.
+        :param json_path: The path of the snapshot, missing files are ignored.
+        :return: The number of messages imported.
+        """
+        imported = 0
+        try:
+            rows = (self.node_to_row(MessageNode.from_dict(mdata)) for mdata in iter_snapshot(json_path))
+            with self.connection:
+                for batch in iter(lambda: list(islice(rows, 1000)), []):
+                    self.connection.executemany(
+                        f"INSERT OR REPLACE INTO messages ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)", batch
+                    )
+                    imported += len(batch)
+        except FileNotFoundError:
+            return 0
+
+        print(f"Imported {imported} messages from {json_path}")
+        return imported
+
+    @staticmethod
+    def node_to_row(node):
+        return node.message_id, node.role.value, node.content, node.timestamp, node.parent_id, node.tool_call
+
+    @staticmethod
+    def row_to_node(row):
+        return MessageNode(row[0], row[1], row[2], row[3], parent_id=row[4], tool_call=row[5])
+
+    def cache_node(self, node):
+        """
+        Add a node to the LRU cache, evicting the least recently used node if the cache is full.
+        """
+        self.cache[node.message_id] = node
+        self.cache.move_to_end(node.message_id)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def get(self, message_id):
+        if message_id is None:
+            return None
+        node = self.cache.get(message_id)
+        if node is not None:
+            self.cache.move_to_end(message_id)
+            return node
+
+        row = self.connection.execute(
+            f"SELECT {self.COLUMNS} FROM messages WHERE message_id = ?", (message_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        node = self.row_to_node(row)
+        self.cache_node(node)
+        return node
+
+    def put(self, node):
+        with self.connection:
+            self.connection.execute(
+                f"INSERT OR REPLACE INTO messages ({self.COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)", self.node_to_row(node)
+            )
+        self.cache_node(node)
+
+    def set_parent(self, message_id, parent_id):
+        with self.connection:
+            self.connection.execute("UPDATE messages SET parent_id = ? WHERE message_id = ?", (parent_id, message_id))
+        node = self.cache.get(message_id)
+        if node is not None:
+            node.parent_id = parent_id
+
+    def chain(self, message_id):
+        # Walk from the message to the root in a single query, the depth guard stops runaway recursion on cycles
+        rows = self.connection.execute(f"""
+            WITH RECURSIVE chain({self.COLUMNS}, depth) AS (
+                SELECT {self.COLUMNS}, 0 FROM messages WHERE message_id = ?
+                UNION ALL
+                SELECT m.message_id, m.role, m.content, m.timestamp, m.parent_id, m.tool_call, chain.depth + 1
+                FROM messages m JOIN chain ON m.message_id = chain.parent_id
+                WHERE chain.depth < 10000
+            )
+            SELECT {self.COLUMNS} FROM chain ORDER BY depth DESC
+        """, (message_id,)).fetchall()
+
+        chain = []
+        for row in rows:
+            # Prefer the cached node so every caller sees the same object
+            node = self.cache.get(row[0]) or self.row_to_node(row)
+            self.cache_node(node)
+            chain.append(node)
+        return chain
+
+    def delete_older_than(self, timestamp):
+        # Both statements use the timestamp index, so only expired rows are visited
+        with self.connection:
+            deleted = [row[0] for row in self.connection.execute(
+                "SELECT message_id FROM messages WHERE timestamp < ?", (timestamp,)
+            )]
+            self.connection.execute("DELETE FROM messages WHERE timestamp < ?", (timestamp,))
+        for mid in deleted:
+            self.cache.pop(mid, None)
+        return deleted
+
+    def save(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
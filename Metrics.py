@@ -0,0 +1,71 @@
+import time
+from collections import defaultdict, deque
+
+
+class Metrics:
+    """
+    A minimal in-process registry of counters, gauges and timing samples, used to monitor the bot.
+    Timings keep only the most recent samples, so percentiles describe recent behaviour.
+    """
+    def __init__(self, max_samples=1000):
+        """
+        Initialize an empty registry.
+        :param max_samples: The number of recent samples to keep for each timing.
+        """
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.timings = defaultdict(lambda: deque(maxlen=max_samples))
+        self.started = time.time()
+
+    def increment(self, name, value=1):
+        """
+        Add to a counter.
+        :param name: The name of the counter, e.g. "messages.evicted".
+        :param value: The amount to add.
+        """
+        self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        """
+        Record the current value of a gauge, e.g. a queue depth.
+        """
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """
+        Record a timing sample.
+        :param name: The name of the timing, e.g. "openai.latency".
+        :param seconds: The duration in seconds.
+        """
+        self.timings[name].append(seconds)
+
+    def percentile(self, name, percentile):
+        """
+        Get a percentile of the recent samples of a timing.
+        :param name: The name of the timing.
+        :param percentile: The percentile, between 0 and 100.
+        :return: The value in seconds, or None if there are no samples.
+        """
+        samples = sorted(self.timings.get(name, ()))
+        if not samples:
+            return None
+        index = min(int(len(samples) * percentile / 100), len(samples) - 1)
+        return samples[index]
+
+    def snapshot(self):
+        """
+        :return: A dictionary of every counter, gauge and the count, p50 and p99 of every timing.
+        """
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "timings": {
+                name: {"count": len(samples), "p50": self.percentile(name, 50), "p99": self.percentile(name, 99)}
+                for name, samples in self.timings.items()
+            },
+        }
+
+
+# The registry shared by the whole bot
+metrics = Metrics()
@@ -0,0 +1,81 @@
+class OutputCapture:
+    """
+    Collects one output stream of a sandbox run, e.g. stdout, as it arrives in chunks.
+    The first max_bytes are kept, after that only the last tail_bytes are, so memory stays bounded however much a run
+    prints. The total number of bytes is always counted.
+    """
+    def __init__(self, max_bytes=1024 * 1024, tail_bytes=4096):
+        """
+        :param max_bytes: The number of bytes kept from the start of the output, the hard cap on its size.
+        :param tail_bytes: The number of bytes kept from the end of the output once it is over max_bytes.
+        """
+        self.max_bytes = max_bytes
+        self.tail_bytes = tail_bytes
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, chunk: bytes) -> None:
+        """
+        Add a chunk of output.
+        """
+        self.total += len(chunk)
+        room = self.max_bytes - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail += chunk
+            del self.tail[:-self.tail_bytes]
+
+    @property
+    def exceeded(self) -> bool:
+        """Whether the output was longer than max_bytes, so part of it was dropped."""
+        return self.total > self.max_bytes
+
+    def data(self) -> bytes:
+        """
+        :return: The kept output, e.g. to upload as a file. If part was dropped, a note says where and how much.
+        """
+        if not self.exceeded:
+            return bytes(self.head)
+        omitted = self.total - len(self.head) - len(self.tail)
+        return bytes(self.head) + f"\n[... {omitted} bytes omitted ...]\n".encode() + bytes(self.tail)
+
+    def text(self) -> str:
+        return self.data().decode("utf-8", "replace")
+
+    def summary(self, max_chars) -> str:
+        """
+        :param max_chars: The maximum length of the summary.
+        :return: The output if it fits in max_chars, otherwise its start and end with a note of how much was left out.
+        """
+        start = self.head.decode("utf-8", "replace")
+        if not self.exceeded and len(start) <= max_chars:
+            return start
+        end = self.tail.decode("utf-8", "replace") if self.exceeded else start
+
+        note_room = 60  # Room for the note about the omitted part
+        head_chars = (max_chars - note_room) * 2 // 3
+        tail_chars = max_chars - note_room - head_chars
+        head = start[:head_chars]
+        tail = end[-tail_chars:] if tail_chars > 0 else ""
+        omitted = self.total - len(head.encode("utf-8")) - len(tail.encode("utf-8"))
+        return f"{head}\n[... {omitted} bytes omitted ...]\n{tail}"
+
+    def remove_trailer(self, marker: bytes) -> bytes | None:
+        """
+        Cut off the last line of the output if it starts with the marker, e.g. the usage the sandbox appends to stderr.
+        :return: The rest of the line after the marker, or None if the output has no such line.
+        """
+        buffer = self.tail if self.exceeded else self.head
+        index = buffer.rfind(marker)
+        if index < 0:
+            return None
+        trailer = bytes(buffer[index + len(marker):])
+        self.total -= len(buffer) - index
+        del buffer[index:]
+        return trailer
+
+    def __len__(self):
+        return self.total
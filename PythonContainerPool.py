@@ -0,0 +1,242 @@
+import threading
+import time
+
+import docker
+
+# Lists everything a run could leave behind: files in the working directory and /tmp, and running processes
+STATE_CHECK_COMMAND = ["sh", "-c", "ls -A /usr/src/app /tmp; ls /proc | grep -c '^[0-9]'"]
+
+
+class PooledContainer:
+    """An idle sandbox container, started ahead of time and reused for several runs."""
+    __slots__ = ("container", "baseline", "runs")
+
+    def __init__(self, container, baseline):
+        """
+        :param container: The running Docker container.
+        :param baseline: The output of STATE_CHECK_COMMAND in the fresh container, see PythonContainerPool.is_clean.
+        """
+        self.container = container
+        self.baseline = baseline
+        self.runs = 0
+
+
+class PythonContainerPool:
+    """
+    Keeps sandbox containers running and idle, so running code does not wait for a container to start.
+    Containers are started with a long sleep as their main process and code is run in them with docker exec. A
+    container is replaced after max_runs runs, when a run times out or fails, or when a run leaves files or processes
+    behind, so no state leaks from one run to the next. All containers share one Docker client.
+    The pool is thread safe, code is expected to run in worker threads.
+    """
+    def __init__(self, image_name='python_runner', min_size=2, max_size=4, max_runs=50, command=None,
+                 ready_command=None, ready_timeout=30.0):
+        """
+        :param image_name: The image to start the containers from.
+        :param command: The main process of the containers, by default a long sleep. See PythonForkServer.
+        :param ready_command: A command that succeeds once a new container is ready for code, or None.
+        :param ready_timeout: How long a new container may take to become ready, in seconds.
+        :param min_size: The number of idle containers kept ready.
+        :param max_size: The maximum number of containers, idle and busy. Further runs wait for a free container.
+        :param max_runs: The number of runs after which a container is replaced.
+        """
+        self.image_name = image_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_runs = max_runs
+        self.command = command or ["sleep", "infinity"]
+        self.ready_command = ready_command
+        self.ready_timeout = ready_timeout
+        self.client = None
+        self.idle = []
+        self.size = 0  # Idle, busy and starting containers
+        self.starting = 0  # Containers being started by replenish
+        self.condition = threading.Condition()
+
+    def start(self) -> None:
+        """
+        Connect to Docker and start the minimum number of containers in the background.
+        Called automatically by the first acquire.
+        """
+        with self.condition:
+            if self.client is None:
+                self.client = docker.from_env()
+        self.replenish_later()
+
+    def acquire(self, timeout=None) -> PooledContainer:
+        """
+        Take an idle container, starting a new one if none are idle and the pool is not full.
+        :param timeout: How long to wait for a container if the pool is full, in seconds. None waits forever.
+        :return: The container, which must be handed back with release.
+        """
+        if self.client is None:
+            self.start()
+
+        with self.condition:
+            if not self.idle and self.size >= self.max_size:
+                if not self.condition.wait_for(lambda: self.idle or self.size < self.max_size, timeout):
+                    raise TimeoutError("No sandbox container became free in time")
+            if self.idle:
+                pooled = self.idle.pop()
+                self.replenish_later()
+                return pooled
+            self.size += 1
+
+        try:
+            return self.create_container()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, pooled: PooledContainer, reusable=True) -> None:
+        """
+        Hand a container back after a run.
+        :param pooled: The container from acquire.
+        :param reusable: False if the run failed or timed out, in which case the container is replaced.
+        """
+        pooled.runs += 1
+        if reusable and pooled.runs < self.max_runs and self.is_clean(pooled):
+            with self.condition:
+                self.idle.append(pooled)
+                self.condition.notify()
+            return
+
+        self.discard(pooled)
+        self.replenish_later()
+
+    def discard(self, pooled: PooledContainer) -> None:
+        """
+        Remove a container from the pool and from Docker.
+        """
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+        try:
+            pooled.container.remove(force=True)
+        except docker.errors.APIError as e:
+            print(f"Error removing sandbox container: {e}")
+
+    def create_container(self) -> PooledContainer:
+        """
+        Start a new container and record its initial state. The caller must have counted it in size.
+        """
+        container = self.client.containers.run(self.image_name, command=self.command, detach=True,
+                                               network_disabled=True, auto_remove=False)
+        if self.ready_command and not self.wait_until_started(container):
+            container.remove(force=True)
+            raise RuntimeError("Sandbox container did not become ready")
+        baseline = self.state_of(container)
+        if baseline is None:
+            container.remove(force=True)
+            raise RuntimeError("Sandbox container did not start")
+        return PooledContainer(container, baseline)
+
+    def wait_until_started(self, container) -> bool:
+        """
+        Run the ready command in a new container until it succeeds, e.g. until the fork server has loaded its modules.
+        :return: Whether the container became ready within the ready timeout.
+        """
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline:
+            try:
+                exit_code, _ = container.exec_run(self.ready_command)
+            except docker.errors.APIError:
+                return False
+            if exit_code == 0:
+                return True
+            time.sleep(0.1)
+        return False
+
+    @staticmethod
+    def state_of(container) -> bytes | None:
+        """
+        :return: The output of STATE_CHECK_COMMAND in the container, or None if the container is not healthy.
+        """
+        try:
+            exit_code, output = container.exec_run(STATE_CHECK_COMMAND)
+        except docker.errors.APIError:
+            return None
+        return output if exit_code == 0 else None
+
+    def is_clean(self, pooled: PooledContainer) -> bool:
+        """
+        :return: Whether the container is healthy and in the same state as when it started.
+        """
+        return self.state_of(pooled.container) == pooled.baseline
+
+    def replenish(self) -> None:
+        """
+        Start containers until the minimum number are idle or starting, without exceeding the maximum size.
+        """
+        while True:
+            with self.condition:
+                if len(self.idle) + self.starting >= self.min_size or self.size >= self.max_size:
+                    return
+                self.size += 1
+                self.starting += 1
+            try:
+                pooled = self.create_container()
+            except Exception as e:
+                print(f"Error starting sandbox container: {e}")
+                with self.condition:
+                    self.size -= 1
+                    self.starting -= 1
+                    self.condition.notify()
+                return
+            with self.condition:
+                self.starting -= 1
+                self.idle.append(pooled)
+                self.condition.notify()
+
+    def replenish_later(self) -> None:
+        """
+        Replenish the pool in a background thread, so the caller does not wait for containers to start.
+        """
+        threading.Thread(target=self.replenish, daemon=True).start()
+
+    def check_health(self) -> int:
+        """
+        Replace idle containers that have stopped or changed, e.g. after being killed by Docker.
+        :return: The number of containers replaced.
+        """
+        with self.condition:
+            idle, self.idle = self.idle, []
+
+        replaced = 0
+        for pooled in idle:
+            if self.is_clean(pooled):
+                with self.condition:
+                    self.idle.append(pooled)
+                    self.condition.notify()
+            else:
+                self.discard(pooled)
+                replaced += 1
+        self.replenish()
+        return replaced
+
+    def close(self) -> None:
+        """
+        Remove every idle container. Busy containers are removed when they are released.
+        """
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.min_size = 0
+        for pooled in idle:
+            self.discard(pooled)
+
+    def stats(self) -> dict:
+        """
+        :return: The number of idle containers and the total number of containers.
+        """
+        with self.condition:
+            return {"idle": len(self.idle), "size": self.size}
+
+    def wait_until_ready(self, timeout=60.0) -> bool:
+        """
+        Wait until the minimum number of containers are idle, e.g. before benchmarking.
+        :return: Whether the pool became ready within the timeout.
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.idle) >= self.min_size, timeout)
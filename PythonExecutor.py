@@ -0,0 +1,162 @@
+import ast
+import signal
+import time
+
+import SandboxUsage
+from OutputCapture import OutputCapture
+from SandboxUsage import RunUsage
+
+KILLED_EXIT_CODE = 137  # What a shell reports for a process killed by SIGKILL, e.g. by a timeout
+
+
+class PythonExecutor:
+    """
+    The sandbox the python tool runs code in.
+    Subclasses decide where the code runs, e.g. DockerPythonExecutor in a container or SubprocessPythonExecutor in a
+    local process, and only implement execute and environment_digest. Running code here makes sure it prints
+    something, and with a SandboxResultCache reuses the output of deterministic code that ran before.
+    What each run cost and how it ended is left in usage, see SandboxUsage.
+    """
+    def __init__(self, timeout=5, max_output_bytes=1024 * 1024, result_cache=None, memory_limit_bytes=None,
+                 cpu_time_limit=None):
+        """
+        :param timeout: How long code may run, in seconds.
+        :param max_output_bytes: How much code may print to stdout or stderr before it is stopped.
+        :param result_cache: A SandboxResultCache, or None to always run the code.
+        :param memory_limit_bytes: How much memory code may use, or None for the backend's default.
+        :param cpu_time_limit: How much CPU time code may use, in seconds. None allows a second more than the timeout.
+        """
+        self.timeout = timeout
+        self.max_output_bytes = max_output_bytes
+        self.result_cache = result_cache
+        self.memory_limit_bytes = memory_limit_bytes
+        self.cpu_time_limit = cpu_time_limit or int(timeout) + 1
+        self.usage = RunUsage()
+
+    def run_code(self, code, session_id=None):
+        """
+        Run the code, killing it if it runs for longer than the timeout.
+        :param code: The Python code to run.
+        :param session_id: The session to run the code in, or None to run it from scratch.
+        :return: A tuple of an OutputCapture of the code's stdout and an error message. One of them will be None.
+        """
+        # GPT4 has a bad habit of just putting the output variables as the last line
+        # We need to make sure they are actually printed out
+        code = self.ensure_print_statement(code)
+        stdout = OutputCapture(self.max_output_bytes)
+        stderr = OutputCapture(self.max_output_bytes)
+        self.usage = RunUsage()
+        started = time.perf_counter()
+
+        # The output of a session run depends on what ran in the session before, so it is never cached
+        key = self.cache_key(code) if self.result_cache and session_id is None else None
+        if key:
+            cached = self.result_cache.get(key)
+            if cached is not None:
+                stdout.write(cached)
+                self.usage.wall_seconds = time.perf_counter() - started
+                self.usage.output_bytes = len(stdout)
+                self.usage.exit_reason = SandboxUsage.EXIT_CACHED
+                return stdout, None
+
+        output, error = self.execute(code, session_id, stdout, stderr)
+        self.usage.wall_seconds = time.perf_counter() - started
+        self.usage.output_bytes = len(stdout) + len(stderr)
+        self.usage.exit_reason = self.exit_reason(stdout, stderr)
+        # Only runs that finished normally, not e.g. runs cut off for printing too much to stdout or stderr
+        if key and self.usage.exit_reason == SandboxUsage.EXIT_OK:
+            self.result_cache.put(key, output.data(), self.usage.wall_seconds)
+        return output, error
+
+    def exit_reason(self, stdout, stderr) -> str:
+        """
+        :return: Why the run ended, one of the SandboxUsage.EXIT_ constants, from what execute left in usage.
+        """
+        usage = self.usage
+        if stdout.exceeded or stderr.exceeded:
+            return SandboxUsage.EXIT_OUTPUT_LIMIT
+        if usage.exit_code is None:
+            return SandboxUsage.EXIT_SANDBOX_ERROR
+        if usage.timed_out:
+            return SandboxUsage.EXIT_TIMEOUT
+        if usage.signal == signal.SIGXCPU or usage.cpu_seconds is not None and usage.cpu_seconds >= self.cpu_time_limit:
+            return SandboxUsage.EXIT_CPU_LIMIT
+        if usage.exit_code == KILLED_EXIT_CODE:
+            # Killed by something other than the timeout, which is most often the OOM killer
+            return SandboxUsage.EXIT_OOM if usage.signal in (None, signal.SIGKILL) else SandboxUsage.EXIT_KILLED
+        if usage.exit_code != 0:
+            return SandboxUsage.EXIT_OOM if b"MemoryError" in stderr.data() else SandboxUsage.EXIT_ERROR
+        return SandboxUsage.EXIT_OK
+
+    def execute(self, code, session_id, stdout, stderr):
+        """
+        Run the code in the sandbox, writing its output to the captures as it is printed.
+        :param code: The Python code to run, after ensure_print_statement.
+        :param session_id: The session to run the code in, or None. Backends without sessions ignore it.
+        :param stdout: The OutputCapture for stdout.
+        :param stderr: The OutputCapture for stderr.
+        :return: The same as run_code. The exit code, and any CPU time, peak memory, timeout or signal the backend
+            can measure, are set in usage.
+        """
+        raise NotImplementedError
+
+    def environment_digest(self) -> str:
+        """
+        :return: A string that changes whenever the sandbox changes in a way that could change the output of code,
+            e.g. the ID of the Docker image. Part of the result cache key.
+        """
+        raise NotImplementedError
+
+    def cache_key(self, code):
+        """
+        :return: The result cache key of the code, or None if its output must not be cached.
+        """
+        try:
+            return self.result_cache.key_for(code, self.environment_digest)
+        except Exception as e:
+            print(f"Error looking up the sandbox environment digest: {e}")
+            return None
+
+    def result(self, exit_code, stdout, stderr):
+        """
+        Record the exit code of a run that finished in usage.
+        :return: The result of run_code for the run.
+        """
+        self.usage.exit_code = exit_code
+        reason = self.exit_reason(stdout, stderr)
+        if reason == SandboxUsage.EXIT_OK:
+            return stdout, None
+        if reason == SandboxUsage.EXIT_ERROR or reason == SandboxUsage.EXIT_OOM and exit_code != KILLED_EXIT_CODE:
+            # The traceback is what the model needs to fix its code
+            return None, stderr.summary(1500) or f"Code exited with status {exit_code}."
+        message = {
+            SandboxUsage.EXIT_TIMEOUT: "Code execution timed out.",
+            SandboxUsage.EXIT_CPU_LIMIT: f"Code execution used more than {self.cpu_time_limit}s of CPU time.",
+            SandboxUsage.EXIT_OOM: "Code execution ran out of memory.",
+        }.get(reason, "Code execution was killed.")
+        return None, f"{message}\n{stderr.summary(1000)}".rstrip()
+
+    @staticmethod
+    def ensure_print_statement(code):
+        """Ensure that the script prints something"""
+        lines = code.strip().split('\n')
+
+        # Check if any line contains a print statement
+        has_print = any("print(" in line for line in lines)
+
+        if not has_print and lines:
+            # Add a print statement around the last line if it's not empty
+            last_line = lines[-1].strip()
+            if last_line and PythonExecutor.is_expression(last_line):
+                lines[-1] = f'print({last_line})'
+
+        return '\n'.join(lines)
+
+    @staticmethod
+    def is_expression(line):
+        """Whether the line is a single expression, rather than e.g. an assignment that sets up a session"""
+        try:
+            body = ast.parse(line).body
+        except SyntaxError:
+            return False
+        return len(body) == 1 and isinstance(body[0], ast.Expr)
@@ -0,0 +1,526 @@
+"""
+A fork server for the python_runner sandbox image.
+
+``python PythonForkServer.py serve`` imports the heavy libraries once and then listens on a Unix socket. Every snippet
+submitted to it runs in a freshly forked child, which starts with the libraries already imported, has its stdout and
+stderr captured separately, has resource limits applied and is killed if it runs past its timeout.
+
+``python PythonForkServer.py run TIMEOUT MEMORY_LIMIT CPU_SECONDS CODE`` submits a snippet, prints its stdout and
+stderr and exits with its exit code, or 137 if it was killed, the same as ``timeout -s KILL TIMEOUT python -c CODE``.
+The limits are 0 for the defaults. A last line starting with USAGE_MARKER is appended to stderr, giving the CPU time
+and peak memory the snippet used and why it was killed.
+
+``python PythonForkServer.py session ID TIMEOUT IDLE_TIMEOUT MEMORY_LIMIT CPU_SECONDS CODE`` runs a snippet like
+``run``, but in a long-lived forked session that keeps its variables between snippets. ``close-session ID`` kills the
+session.
+
+``python PythonForkServer.py ping`` exits with 0 once the server is accepting snippets.
+
+This file runs inside the image, which uses Python 3.9, and only uses the standard library.
+"""
+import json
+import os
+import resource
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+SOCKET_PATH = "/tmp/forkserver.sock"
+PRELOADED_MODULES = ["numpy", "pandas", "scipy", "scipy.stats", "sklearn", "sympy"]
+MAX_OUTPUT_BYTES = 1024 * 1024  # Per stream, a snippet printing more is killed
+TAIL_OUTPUT_BYTES = 4096  # Kept from the end of a stream that was cut off
+MEMORY_LIMIT_BYTES = 1024 * 1024 * 1024  # On top of the memory the server already maps
+FILE_SIZE_LIMIT_BYTES = 16 * 1024 * 1024
+OPEN_FILES_LIMIT = 64
+KILLED_EXIT_CODE = 137  # What a shell reports for a process killed by SIGKILL
+SESSION_DIRECTORY = "/tmp"  # Where the sockets and pid files of sessions are
+# Starts the line the client appends to stderr with the snippet's resource usage, which the host strips off
+USAGE_MARKER = "\0sandbox-usage:"
+
+# The commands the host runs in the container, see PythonContainerPool and DockerPythonExecutor
+SCRIPT_PATH = "/usr/src/app/PythonForkServer.py"
+SERVE_COMMAND = ["python", SCRIPT_PATH, "serve"]
+# The client skips site initialisation (-S), starting the interpreter is most of the cost of a run
+PING_COMMAND = ["python", "-S", SCRIPT_PATH, "ping"]
+
+
+def run_command(code, timeout, memory_limit=None, cpu_seconds=None):
+    """
+    :param memory_limit: The memory the snippet may use on top of the server's, None for MEMORY_LIMIT_BYTES.
+    :param cpu_seconds: The CPU time the snippet may use, None for a second more than the timeout.
+    :return: The command that runs code through the fork server, killing it after timeout seconds.
+    """
+    return ["python", "-S", SCRIPT_PATH, "run", str(timeout), str(memory_limit or 0), str(cpu_seconds or 0), code]
+
+
+def session_command(session_id, code, timeout, idle_timeout, memory_limit, cpu_seconds=None):
+    """
+    :return: The command that runs code in a session, which keeps its variables for the next command in the same
+        session. The session is started if it is not running, and exits once idle for idle_timeout seconds. The
+        memory limit applies to the whole session, the CPU time limit to each snippet.
+    """
+    return ["python", "-S", SCRIPT_PATH, "session", str(session_id), str(timeout), str(idle_timeout),
+            str(memory_limit), str(cpu_seconds or 0), code]
+
+
+def close_session_command(session_id):
+    """
+    :return: The command that kills a session.
+    """
+    return ["python", "-S", SCRIPT_PATH, "close-session", str(session_id)]
+
+
+def preload():
+    # Forked children must not inherit idle BLAS thread pools, which can deadlock after fork
+    for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ.setdefault(variable, "1")
+    for name in PRELOADED_MODULES:
+        try:
+            __import__(name)
+        except ImportError as e:
+            print(f"Could not preload {name}: {e}", file=sys.stderr)
+
+
+def mapped_bytes():
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[0]) * resource.getpagesize()
+
+
+def run_child(code, stdout_fd, stderr_fd, cpu_seconds, memory_limit, close_fds):
+    """
+    Runs the snippet in the forked child, never returns.
+    """
+    try:
+        # A process group of its own, so a timeout kills any processes the snippet starts too
+        os.setsid()
+        for fd in close_fds:
+            os.close(fd)
+        os.dup2(stdout_fd, 1)
+        os.dup2(stderr_fd, 2)
+        os.close(stdout_fd)
+        os.close(stderr_fd)
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(null_fd, 0)
+        os.close(null_fd)
+        sys.stdin = open(0, closefd=False)
+        sys.stdout = open(1, "w", closefd=False)
+        sys.stderr = open(2, "w", closefd=False)
+
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+        # SIGXCPU at the soft limit, SIGKILL a second later at the hard limit if that does not stop it
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+        resource.setrlimit(resource.RLIMIT_FSIZE, (FILE_SIZE_LIMIT_BYTES, FILE_SIZE_LIMIT_BYTES))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (OPEN_FILES_LIMIT, OPEN_FILES_LIMIT))
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    except Exception:
+        os._exit(70)
+
+    exit_code = execute(code, {"__name__": "__main__", "__builtins__": __builtins__})
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(exit_code)
+
+
+def execute(code, namespace):
+    """
+    Run a snippet in the given globals, printing its traceback to stderr if it fails.
+    :return: The exit code python -c would have exited with.
+    """
+    try:
+        exec(compile(code, "<code>", "exec"), namespace)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except BaseException as e:
+        # Leave this function's frame out of the traceback, as python -c would
+        traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+        return 1
+    return 0
+
+
+def run_snippet(code, timeout, memory_limit, cpu_seconds, close_fds=()):
+    """
+    Fork a child to run the snippet and collect its stdout and stderr.
+    Each stream keeps its first MAX_OUTPUT_BYTES and its last TAIL_OUTPUT_BYTES. A snippet that prints more than
+    MAX_OUTPUT_BYTES to either is killed, there is no point letting it run on.
+    :param close_fds: File descriptors of the server that the child must not keep, e.g. its sockets.
+    :return: A tuple of the stdout bytes, the stderr bytes, the exit code and the resource usage, see usage_of.
+    """
+    stdout_read, stdout_write = os.pipe()
+    stderr_read, stderr_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(stdout_read)
+        os.close(stderr_read)
+        run_child(code, stdout_write, stderr_write, cpu_seconds, memory_limit, close_fds)
+    os.close(stdout_write)
+    os.close(stderr_write)
+
+    outputs = {stdout_read: _CappedOutput(), stderr_read: _CappedOutput()}
+    open_fds = list(outputs)
+    deadline = time.monotonic() + timeout
+    killed = False
+    while open_fds:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or any(output.exceeded for output in outputs.values()):
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            killed = remaining <= 0
+            break
+        ready, _, _ = select.select(open_fds, [], [], remaining)
+        for fd in ready:
+            chunk = os.read(fd, 65536)
+            if chunk:
+                outputs[fd].write(chunk)
+            else:
+                open_fds.remove(fd)
+    os.close(stdout_read)
+    os.close(stderr_read)
+
+    _, status, rusage = os.wait4(pid, 0)
+    if killed or os.WIFSIGNALED(status):
+        exit_code = KILLED_EXIT_CODE
+    else:
+        exit_code = os.WEXITSTATUS(status)
+    usage = usage_of(rusage, timed_out=killed, signal_number=os.WTERMSIG(status) if os.WIFSIGNALED(status) else None)
+    return outputs[stdout_read].data(), outputs[stderr_read].data(), exit_code, usage
+
+
+def usage_of(rusage, timed_out=False, signal_number=None, cpu_seconds=None):
+    """
+    :param rusage: The resource usage of the process that ran a snippet.
+    :param timed_out: Whether the snippet was killed for running past its timeout.
+    :param signal_number: The signal that killed it, if any. 0 if it was killed by an unknown signal.
+    :param cpu_seconds: The CPU time the snippet used, by default all of the process's.
+    :return: The usage reported to the host, see SandboxUsage.RunUsage.
+    """
+    return {
+        "cpu_seconds": rusage.ru_utime + rusage.ru_stime if cpu_seconds is None else cpu_seconds,
+        "peak_memory_bytes": rusage.ru_maxrss * 1024,  # Linux reports kilobytes
+        "timed_out": timed_out,
+        "signal": signal_number,
+    }
+
+
+def write_usage(usage):
+    """
+    Append the usage to stderr, after everything the snippet printed, for the host to strip off.
+    """
+    sys.stderr.write(USAGE_MARKER + json.dumps(usage) + "\n")
+    sys.stderr.flush()
+
+
+class CpuTimeExceeded(Exception):
+    """Raised in a session snippet that runs past its CPU time limit."""
+
+
+class _CappedOutput:
+    """The start and end of one output stream of a snippet, the same as the host's OutputCapture."""
+
+    def __init__(self):
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, chunk):
+        self.total += len(chunk)
+        room = MAX_OUTPUT_BYTES - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail += chunk
+            del self.tail[:-TAIL_OUTPUT_BYTES]
+
+    @property
+    def exceeded(self):
+        return self.total > MAX_OUTPUT_BYTES
+
+    def data(self):
+        if not self.exceeded:
+            return bytes(self.head)
+        omitted = self.total - len(self.head) - len(self.tail)
+        return bytes(self.head) + f"\n[... {omitted} bytes omitted ...]\n".encode() + bytes(self.tail)
+
+
+def start_session(request, close_fds):
+    """
+    Fork a session child for the request, see run_session. The server does not wait for it, reap_children does.
+    :return: The response to send back.
+    """
+    session_id = request["session"]
+    if not session_id.isalnum():
+        return {"error": f"Invalid session ID: {session_id}"}
+    socket_path, pid_path = session_paths(session_id)
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    # Listening before the fork, so the client can connect as soon as it has the response
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    listener.listen(1)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setsid()
+            for fd in close_fds:
+                os.close(fd)
+            null_fd = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null_fd, fd)
+            os.close(null_fd)
+            sys.stdin = open(0, closefd=False)
+            sys.stdout = open(1, "w", closefd=False)
+            sys.stderr = open(2, "w", closefd=False)
+            memory_limit = mapped_bytes() + int(request["memory_limit"])
+            resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+            resource.setrlimit(resource.RLIMIT_FSIZE, (FILE_SIZE_LIMIT_BYTES, FILE_SIZE_LIMIT_BYTES))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (OPEN_FILES_LIMIT, OPEN_FILES_LIMIT))
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            run_session(listener, float(request["idle_timeout"]), socket_path, pid_path)
+        finally:
+            os._exit(0)
+    listener.close()
+    with open(pid_path, "w") as pid_file:
+        pid_file.write(str(pid))
+    return {"pid": pid}
+
+
+def run_session(listener, idle_timeout, socket_path, pid_path):
+    """
+    Runs in a session child: runs the snippets sent to the listener one after another in the same globals, so later
+    snippets see the variables of earlier ones. Each snippet comes with the stdout and stderr of the client that sent
+    it, which it prints to directly. The session exits once it has been idle for idle_timeout seconds.
+    """
+    namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+    cpu_time_exceeded = []
+
+    def raise_cpu_time_exceeded(signal_number, frame):
+        # Rather than dying of SIGXCPU, the snippet fails and the session keeps its variables
+        cpu_time_exceeded.append(signal_number)
+        raise CpuTimeExceeded("The snippet used up its CPU time")
+
+    signal.signal(signal.SIGXCPU, raise_cpu_time_exceeded)
+    listener.settimeout(idle_timeout)
+    while True:
+        try:
+            connection, _ = listener.accept()
+        except socket.timeout:
+            break
+        with connection:
+            connection.settimeout(None)
+            data, fds, _, _ = socket.recv_fds(connection, 65536, 2)
+            while not data.endswith(b"\n"):
+                chunk = connection.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+            request = json.loads(data)
+            os.dup2(fds[0], 1)
+            os.dup2(fds[1], 2)
+            for fd in fds:
+                os.close(fd)
+            # The CPU limit counts the session's whole life, so each snippet gets its allowance on top of what the
+            # session already used. Only the soft limit is set, the session must be able to raise it again.
+            before = resource.getrusage(resource.RUSAGE_SELF)
+            used = before.ru_utime + before.ru_stime
+            cpu_limit = int(used + int(request["cpu_seconds"]) + 0.5)
+            del cpu_time_exceeded[:]
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu_limit, resource.RLIM_INFINITY))
+            exit_code = execute(request["code"], namespace)
+            resource.setrlimit(resource.RLIMIT_CPU, (resource.RLIM_INFINITY, resource.RLIM_INFINITY))
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            except OSError:
+                pass
+            # Let go of the client's output, so its reader sees the end of it
+            null_fd = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(null_fd, 1)
+            os.dup2(null_fd, 2)
+            os.close(null_fd)
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            usage = usage_of(after, signal_number=cpu_time_exceeded[0] if cpu_time_exceeded else None,
+                             cpu_seconds=after.ru_utime + after.ru_stime - used)
+            send_json(connection, {"exit_code": exit_code, "usage": usage})
+    remove_session_files(socket_path, pid_path)
+
+
+def run_in_session(session_id, timeout, idle_timeout, memory_limit, cpu_seconds, code):
+    """
+    Client side of a session: run the snippet in the session, starting the session first if it is not running.
+    The session is killed if the snippet runs past its timeout, losing its variables. The snippet's usage is
+    appended to stderr, see write_usage.
+    :param cpu_seconds: The CPU time the snippet may use, 0 for a second more than the timeout.
+    :return: The exit code of the snippet, or 137 if it was killed.
+    """
+    socket_path, pid_path = session_paths(session_id)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except OSError:
+        response = submit({"session": session_id, "idle_timeout": idle_timeout, "memory_limit": memory_limit})
+        if "error" in response:
+            sys.exit(response["error"])
+        connection.connect(socket_path)
+
+    with connection:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        message = json.dumps({"code": code, "cpu_seconds": cpu_seconds or int(timeout) + 1}).encode() + b"\n"
+        socket.send_fds(connection, [message], [1, 2])
+        connection.settimeout(timeout)
+        timed_out = False
+        try:
+            response = connection.makefile("rb").readline()
+        except socket.timeout:
+            response = b""
+            timed_out = True
+    if not response:
+        # Timed out or the session died, e.g. it was killed for using too much memory or CPU time
+        close_session(session_id)
+        write_usage({"timed_out": timed_out, "signal": None if timed_out else 0})
+        return KILLED_EXIT_CODE
+    response = json.loads(response)
+    write_usage(response["usage"])
+    return response["exit_code"]
+
+
+def close_session(session_id):
+    """
+    Kill a session and everything it started, whether it is idle or running a snippet.
+    """
+    socket_path, pid_path = session_paths(session_id)
+    try:
+        with open(pid_path) as pid_file:
+            pid = int(pid_file.read())
+    except (OSError, ValueError):
+        pid = None
+    if pid is not None:
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # A session that has only just started may not have its own process group yet
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        except OSError:
+            pass
+    remove_session_files(socket_path, pid_path)
+
+
+def session_paths(session_id):
+    """
+    :return: The paths of the socket and the pid file of a session.
+    """
+    return f"{SESSION_DIRECTORY}/session-{session_id}.sock", f"{SESSION_DIRECTORY}/session-{session_id}.pid"
+
+
+def remove_session_files(*paths):
+    for path in paths:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+def reap_children():
+    """
+    Collect the exit status of session children that have exited, so they do not linger as zombies.
+    """
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def serve():
+    preload()
+    base_memory = mapped_bytes()
+    if os.path.exists(SOCKET_PATH):
+        os.unlink(SOCKET_PATH)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SOCKET_PATH)
+    server.listen(8)
+    while True:
+        connection, _ = server.accept()
+        reap_children()
+        with connection:
+            request = receive_json(connection)
+            if request.get("ping"):
+                send_json(connection, {"ok": True})
+                continue
+            if "session" in request:
+                send_json(connection, start_session(request, close_fds=(server.fileno(), connection.fileno())))
+                continue
+            timeout = float(request["timeout"])
+            memory_limit = base_memory + (request.get("memory_limit") or MEMORY_LIMIT_BYTES)
+            cpu_seconds = request.get("cpu_seconds") or int(timeout) + 1
+            stdout, stderr, exit_code, usage = run_snippet(request["code"], timeout, memory_limit, cpu_seconds,
+                                                           close_fds=(server.fileno(), connection.fileno()))
+            send_json(connection, {"stdout": stdout.decode("utf-8", "replace"),
+                                   "stderr": stderr.decode("utf-8", "replace"), "exit_code": exit_code,
+                                   "usage": usage})
+
+
+def send_json(connection, message):
+    connection.sendall(json.dumps(message).encode() + b"\n")
+
+
+def receive_json(connection):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data)
+
+
+def submit(message):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(SOCKET_PATH)
+    with client:
+        send_json(client, message)
+        return receive_json(client)
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "serve"
+    if command == "serve":
+        serve()
+    elif command == "ping":
+        try:
+            submit({"ping": True})
+        except (OSError, ValueError):
+            sys.exit(1)
+    elif command == "session":
+        session_id, timeout, idle_timeout, memory_limit, cpu_seconds, code = sys.argv[2:8]
+        sys.exit(run_in_session(session_id, float(timeout), float(idle_timeout), int(memory_limit),
+                                int(cpu_seconds), code))
+    elif command == "close-session":
+        close_session(sys.argv[2])
+    elif command == "run":
+        timeout, memory_limit, cpu_seconds, code = sys.argv[2:6]
+        result = submit({"timeout": float(timeout), "memory_limit": int(memory_limit),
+                         "cpu_seconds": int(cpu_seconds), "code": code})
+        sys.stdout.write(result["stdout"])
+        sys.stdout.flush()
+        sys.stderr.write(result["stderr"])
+        write_usage(result["usage"])
+        sys.exit(result["exit_code"])
+    else:
+        sys.exit(f"Unknown command: {command}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+from contextlib import contextmanager
+
+import docker
+
+import PythonForkServer
+
+
+class PythonSession:
+    """A sandbox interpreter bound to one conversation, which keeps its variables between runs."""
+    __slots__ = ("session_id", "last_used", "lock", "broken")
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()  # One run at a time per session
+        self.broken = False  # Set when a run kills or abandons the session, so it is closed after the run
+
+
+class PythonSessionManager:
+    """
+    Keeps a Python session per conversation, so a later python tool call in the same reply thread can use the
+    variables of earlier ones instead of recomputing them.
+    The sessions are forked by the PythonForkServer of one sandbox container, taken from the given pool and held for
+    as long as the manager runs. Each session has a memory ceiling, is closed once idle for idle_timeout seconds, and
+    the least recently used session is closed to make room once max_sessions are open.
+    The manager is thread safe, code is expected to run in worker threads.
+    """
+    def __init__(self, pool, max_sessions=8, idle_timeout=900.0, memory_limit_bytes=512 * 1024 * 1024,
+                 container_timeout=30.0):
+        """
+        :param pool: The PythonContainerPool to take the container from. Its containers must run PythonForkServer.
+        :param max_sessions: The maximum number of open sessions.
+        :param idle_timeout: How long a session is kept without being used, in seconds.
+        :param memory_limit_bytes: How much memory each session may use on top of the fork server's.
+        :param container_timeout: How long to wait for the container, in seconds.
+        """
+        self.pool = pool
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.memory_limit_bytes = memory_limit_bytes
+        self.container_timeout = container_timeout
+        self.pooled = None
+        self.sessions = {}  # session ID -> PythonSession, least recently used first
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def session_id_for(conversation_id) -> str:
+        """
+        :param conversation_id: The ID of the conversation, e.g. the ID of its root message, which for a conversation
+            started by a mention is a string such as "123_system".
+        :return: The session ID of the conversation. The fork server only accepts alphanumeric IDs, which this is, and
+            names a socket after it, so it is kept short.
+        """
+        return hashlib.sha256(str(conversation_id).encode()).hexdigest()[:32]
+
+    @contextmanager
+    def use(self, session_id):
+        """
+        Hold the session for a run, opening it if needed. Runs in the same session wait for each other.
+        :param session_id: The ID of the session, e.g. the ID of the conversation's root message.
+        :return: A context manager giving the PythonSession.
+        """
+        session = self.open(session_id)
+        with session.lock:
+            try:
+                yield session
+            except docker.errors.APIError:
+                session.broken = True
+                self.check_container()
+                raise
+            finally:
+                session.last_used = time.monotonic()
+                if session.broken:
+                    self.close(session_id)
+
+    def open(self, session_id) -> PythonSession:
+        """
+        :return: The session with the given ID, opened if needed. Opening may close the least recently used session.
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is None:
+                session = PythonSession(session_id)
+            self.sessions[session_id] = session
+            evicted = [
+                other for other in self.sessions.values()
+                if other is not session and not other.lock.locked()
+            ][:max(len(self.sessions) - self.max_sessions, 0)]
+        for other in evicted:
+            self.close(other.session_id)
+        return session
+
+    def command(self, session_id, code, timeout, cpu_seconds=None) -> list[str]:
+        """
+        :param cpu_seconds: The CPU time the code may use, None for a second more than the timeout.
+        :return: The command that runs the code in the session, to run in the container.
+        """
+        # The session exits on its own a while after it would have been closed here, in case the close is missed
+        return PythonForkServer.session_command(session_id, code, timeout, self.idle_timeout * 2,
+                                                self.memory_limit_bytes, cpu_seconds)
+
+    def container(self):
+        """
+        :return: The container the sessions run in, taken from the pool the first time.
+        """
+        with self.lock:
+            if self.pooled is None:
+                self.pooled = self.pool.acquire(timeout=self.container_timeout)
+            return self.pooled.container
+
+    def check_container(self) -> None:
+        """
+        Give up the container if it has died, along with every session in it. The next run takes a new one.
+        """
+        with self.lock:
+            if self.pooled is None or self.pool.state_of(self.pooled.container) is not None:
+                return
+            pooled, self.pooled = self.pooled, None
+            self.sessions.clear()
+        print("Python session container died, its sessions were lost")
+        self.pool.discard(pooled)
+        self.pool.replenish_later()
+
+    def close(self, session_id) -> None:
+        """
+        Close a session, killing anything it is running.
+        """
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            pooled = self.pooled
+        if session is None or pooled is None:
+            return
+        try:
+            pooled.container.exec_run(PythonForkServer.close_session_command(session_id))
+        except docker.errors.APIError as e:
+            print(f"Error closing python session {session_id}: {e}")
+
+    def evict_idle(self) -> int:
+        """
+        Close the sessions that have not been used for idle_timeout seconds.
+        :return: The number of sessions closed.
+        """
+        cutoff = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [
+                session.session_id for session in self.sessions.values()
+                if session.last_used < cutoff and not session.lock.locked()
+            ]
+        for session_id in idle:
+            self.close(session_id)
+        return len(idle)
+
+    def shutdown(self) -> None:
+        """
+        Close every session and hand the container back to the pool to be removed.
+        """
+        with self.lock:
+            pooled, self.pooled = self.pooled, None
+            self.sessions.clear()
+        if pooled is not None:
+            self.pool.discard(pooled)
+
+    def stats(self) -> dict:
+        """
+        :return: The number of open sessions.
+        """
+        with self.lock:
+            return {"sessions": len(self.sessions)}
@@ -0,0 +1,111 @@
+import asyncio
+import contextvars
+
+from Metrics import metrics
+
+# The thread whose messages the current handler call is for, see RequestCoalescer.commit
+_current_key = contextvars.ContextVar("coalescer_key")
+
+
+class _ThreadState:
+    """The messages waiting for, or being handled by, a model call in one thread."""
+    __slots__ = ("pending", "first_pending_at", "timer", "in_flight", "in_flight_items", "committed")
+
+    def __init__(self):
+        self.pending = []
+        self.first_pending_at = None
+        self.timer = None
+        self.in_flight = None
+        self.in_flight_items = []
+        self.committed = False  # Whether the in-flight call has started delivering, so it must not be redone
+
+
+class RequestCoalescer:
+    """
+    Merges bursts of messages in the same thread into a single call of a handler.
+    A thread's messages are held until no new message has arrived for `window` seconds (but never longer than
+    `max_delay` seconds), then handed to the handler together. If a message arrives while the handler is still
+    running for the same thread, that call is cancelled and its messages are handled again with the new one.
+    Handlers should call commit and shield any work that must not be interrupted or redone once it starts, e.g.
+    sending the reply. A message arriving after that is handled in a call of its own.
+    """
+    def __init__(self, handler, window=0.75, max_delay=3.0):
+        """
+        :param handler: An async callable taking the list of messages in a burst, oldest first.
+        :param window: How long to wait for further messages after each message, in seconds.
+        :param max_delay: The longest a message is held before its burst is handled, in seconds.
+        """
+        self.handler = handler
+        self.window = window
+        self.max_delay = max_delay
+        self.threads = {}
+        self.delivering = set()  # Committed calls that a newer call has replaced as in flight, kept until they end
+
+    def submit(self, key, item) -> None:
+        """
+        Queue a message for handling.
+        :param key: Identifies the thread the message belongs to, e.g. the ID of the message it replies to.
+        :param item: The message.
+        """
+        loop = asyncio.get_running_loop()
+        state = self.threads.setdefault(key, _ThreadState())
+
+        if state.in_flight is not None and not state.in_flight.done() and not state.committed:
+            # The in-flight call is answering an out of date conversation, redo it with the new message included
+            state.in_flight.cancel()
+            state.pending = state.in_flight_items + state.pending
+            state.in_flight_items = []
+            metrics.increment("coalescer.superseded")
+
+        state.pending.append(item)
+        if state.first_pending_at is None:
+            state.first_pending_at = loop.time()
+        if state.timer is not None:
+            state.timer.cancel()
+        delay = min(self.window, max(state.first_pending_at + self.max_delay - loop.time(), 0))
+        state.timer = loop.call_later(delay, self.flush, key)
+
+    def flush(self, key) -> None:
+        """
+        Hand the pending messages of a thread to the handler.
+        """
+        state = self.threads[key]
+        items = state.pending
+        state.pending = []
+        state.first_pending_at = None
+        state.timer = None
+
+        metrics.increment("coalescer.batches")
+        metrics.increment("coalescer.merged", len(items) - 1)
+        if state.in_flight is not None and not state.in_flight.done():
+            self.delivering.add(state.in_flight)
+            state.in_flight.add_done_callback(self.delivering.discard)
+        state.in_flight_items = items
+        state.committed = False
+        state.in_flight = asyncio.create_task(self.run(key, items))
+
+    def commit(self) -> None:
+        """
+        Called by the handler once it starts delivering its response. The call is no longer cancelled by newer
+        messages, which start a burst of their own instead of having the committed messages handled again.
+        """
+        state = self.threads.get(_current_key.get(None))
+        if state is not None and state.in_flight is asyncio.current_task():
+            state.committed = True
+
+    async def run(self, key, items) -> None:
+        _current_key.set(key)
+        try:
+            await self.handler(items)
+        except asyncio.CancelledError:
+            pass  # Superseded by a newer message, which is handled in a new call
+        except Exception as e:
+            print(f"Error handling messages: {e}")
+        finally:
+            state = self.threads.get(key)
+            if state is not None and state.in_flight is asyncio.current_task():
+                state.in_flight = None
+                state.in_flight_items = []
+                state.committed = False
+                if not state.pending:
+                    del self.threads[key]
@@ -0,0 +1,283 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict, deque
+
+import openai
+
+from Metrics import metrics
+
+# Lower values are served first
+PRIORITY_HIGH = 0  # e.g. the bot was mentioned directly
+PRIORITY_NORMAL = 1  # e.g. a reply to one of the bot's messages
+PRIORITY_LOW = 2  # e.g. work nobody is waiting on
+PRIORITIES = (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+
+
+class TokenBucket:
+    """
+    A token bucket that refills continuously at a fixed rate per minute, up to one minute's worth of tokens.
+    """
+    def __init__(self, rate_per_minute):
+        """
+        :param rate_per_minute: The refill rate, and the capacity of the bucket.
+        """
+        self.capacity = rate_per_minute
+        self.rate = rate_per_minute / 60
+        self.level = rate_per_minute
+        self.updated = time.monotonic()
+
+    def refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount) -> float:
+        """
+        :param amount: The number of tokens needed, capped at the capacity of the bucket.
+        :return: How long until the bucket holds that many tokens, in seconds. 0 if it already does.
+        """
+        self.refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(missing / self.rate, 0.0)
+
+    def consume(self, amount) -> None:
+        """
+        Take tokens from the bucket. The level can go negative, e.g. when a request used more tokens than estimated.
+        """
+        self.refill()
+        self.level -= amount
+
+    def drain(self) -> None:
+        """
+        Empty the bucket, e.g. after the server reports that the rate limit was hit.
+        """
+        self.refill()
+        self.level = min(self.level, 0)
+
+
+class _Waiter:
+    """A request waiting for its turn."""
+    __slots__ = ("tokens", "future", "queued")
+
+    def __init__(self, tokens, future):
+        self.tokens = tokens
+        self.future = future
+        self.queued = time.perf_counter()
+
+
+class RequestScheduler:
+    """
+    Decides when each model request may be sent.
+    Requests are admitted in priority order, and within a priority in round-robin order across channels and then
+    across users in each channel, so one busy user or channel cannot starve the others. A request is only admitted
+    while fewer than `max_concurrent_requests` are in flight and the requests-per-minute and tokens-per-minute buckets
+    allow it. Rate limit (429), server (5xx) and connection errors are retried with jittered exponential backoff.
+    """
+    def __init__(self, max_concurrent_requests=8, requests_per_minute=None, tokens_per_minute=None,
+                 max_retries=4, base_backoff=1.0, max_backoff=30.0, metrics_prefix="scheduler"):
+        """
+        :param max_concurrent_requests: The maximum number of requests in flight at once.
+        :param requests_per_minute: The request rate limit, or None for no limit.
+        :param tokens_per_minute: The token rate limit, or None for no limit.
+        :param max_retries: How many times a failed request is retried before its error is raised.
+        :param base_backoff: The backoff before the first retry, in seconds. It doubles with every retry.
+        :param max_backoff: The longest backoff, in seconds.
+        :param metrics_prefix: The prefix of this scheduler's metrics, to tell several schedulers apart.
+        """
+        self.max_concurrent_requests = max_concurrent_requests
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.metrics_prefix = metrics_prefix
+        # priority -> channel -> user -> waiters, the ordered dicts give the round-robin order
+        self.queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.wakeup = None
+
+    async def run(self, call, tokens=0, priority=PRIORITY_NORMAL, user_id=None, channel_id=None):
+        """
+        Wait for a turn, then make the request, retrying it if it fails with a retryable error.
+        :param call: An async callable that makes the request and returns its result.
+        :param tokens: The estimated number of tokens the request will use.
+        :param priority: One of PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.
+        :param user_id: The user the request is for, used to share capacity fairly.
+        :param channel_id: The channel the request is for, used to share capacity fairly.
+        :return: The result of the call.
+        """
+        attempt = 0
+        while True:
+            await self.acquire(tokens, priority, user_id, channel_id)
+            try:
+                return await call()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                delay = self.backoff(e, attempt)
+                attempt += 1
+                metrics.increment(f"{self.metrics_prefix}.retries")
+                print(f"Retrying model request in {delay:.1f}s after error: {e}")
+            finally:
+                self.release()
+            await asyncio.sleep(delay)
+
+    async def acquire(self, tokens, priority=PRIORITY_NORMAL, user_id=None, channel_id=None) -> None:
+        """
+        Wait until a request may be sent. Every acquire must be followed by a release once the request is done.
+        """
+        waiter = _Waiter(tokens, asyncio.get_running_loop().create_future())
+        channel_queues = self.queues[priority].setdefault(channel_id, OrderedDict())
+        channel_queues.setdefault(user_id, deque()).append(waiter)
+        self.queue_depth += 1
+        self.dispatch()
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Admitted just as the caller gave up, hand the slot back
+                self.release()
+            raise
+        finally:
+            metrics.observe(f"{self.metrics_prefix}.wait", time.perf_counter() - waiter.queued)
+
+    def release(self) -> None:
+        """
+        Mark a request as done, letting the next one in.
+        """
+        self.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self) -> None:
+        """
+        Admit as many waiting requests as the concurrency limit and rate limits allow.
+        """
+        while self.in_flight < self.max_concurrent_requests:
+            waiter = self.peek()
+            if waiter is None:
+                break
+            if waiter.future.done():
+                # The caller gave up while waiting
+                self.pop()
+                continue
+
+            delay = self.rate_limit_delay(waiter.tokens)
+            if delay > 0:
+                # The head of the queue waits for the buckets to refill, so lower priorities cannot overtake it
+                if self.wakeup is None:
+                    self.wakeup = asyncio.get_running_loop().call_later(delay, self.wake)
+                break
+
+            self.pop()
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            if self.token_bucket:
+                self.token_bucket.consume(waiter.tokens)
+            self.in_flight += 1
+            waiter.future.set_result(None)
+
+        metrics.set_gauge(f"{self.metrics_prefix}.queue_depth", self.queue_depth)
+        metrics.set_gauge(f"{self.metrics_prefix}.in_flight", self.in_flight)
+
+    def wake(self) -> None:
+        self.wakeup = None
+        self.dispatch()
+
+    def rate_limit_delay(self, tokens) -> float:
+        """
+        :return: How long until both buckets allow a request using this many tokens, in seconds.
+        """
+        delay = 0.0
+        if self.request_bucket:
+            delay = self.request_bucket.time_until(1)
+        if self.token_bucket:
+            delay = max(delay, self.token_bucket.time_until(tokens))
+        return delay
+
+    def peek(self) -> _Waiter | None:
+        """
+        :return: The next request to admit, or None if nothing is waiting.
+        """
+        for priority in PRIORITIES:
+            channels = self.queues[priority]
+            if channels:
+                users = next(iter(channels.values()))
+                return next(iter(users.values()))[0]
+        return None
+
+    def pop(self) -> None:
+        """
+        Remove the request returned by peek, moving its user and channel to the back of the round-robin order.
+        """
+        for priority in PRIORITIES:
+            channels = self.queues[priority]
+            if not channels:
+                continue
+            channel_id, users = next(iter(channels.items()))
+            user_id, waiters = next(iter(users.items()))
+            waiters.popleft()
+            if waiters:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if users:
+                channels.move_to_end(channel_id)
+            else:
+                del channels[channel_id]
+            self.queue_depth -= 1
+            return
+
+    def record_usage(self, estimated_tokens, used_tokens) -> None:
+        """
+        Correct the token bucket once the actual usage of a request is known.
+        :param estimated_tokens: The estimate the request was admitted with.
+        :param used_tokens: The number of tokens the request actually used.
+        """
+        if self.token_bucket:
+            self.token_bucket.consume(used_tokens - estimated_tokens)
+
+    def backoff(self, error, attempt) -> float:
+        """
+        :param error: The error the request failed with.
+        :param attempt: The number of retries so far.
+        :return: How long to wait before retrying, in seconds.
+        """
+        # Full jitter, so requests that failed together do not retry together
+        delay = random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+        if isinstance(error, openai.RateLimitError):
+            metrics.increment(f"{self.metrics_prefix}.rate_limited")
+            # Everyone else is over the limit too, hold back new requests until the bucket refills
+            if self.request_bucket:
+                self.request_bucket.drain()
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    def stats(self) -> dict:
+        """
+        :return: The number of queued requests at each priority and the number in flight.
+        """
+        return {
+            "queued": {
+                priority: sum(len(waiters) for users in channels.values() for waiters in users.values())
+                for priority, channels in self.queues.items()
+            },
+            "in_flight": self.in_flight,
+        }
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    :return: Whether a request that failed with this error may succeed if it is sent again.
+    """
+    if isinstance(error, openai.RateLimitError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500
+    # Includes timeouts
+    return isinstance(error, openai.APIConnectionError)
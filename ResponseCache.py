@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+
+from Metrics import metrics
+
+# Questions whose answer depends on when or how often they are asked, e.g. "what time is it" or "roll a die"
+NON_DETERMINISTIC = re.compile(
+    r"\b(now|today|tonight|tomorrow|yesterday|current(ly)?|latest|recent(ly)?|time|date|random(ly)?|roll|flip|"
+    r"shuffle|pick|choose|joke|story|poem)\b",
+    re.IGNORECASE
+)
+
+
+class ResponseCache:
+    """
+    Remembers the responses to message chains, so an identical question with an identical prompt is answered
+    without calling the model again.
+    Entries are keyed by a hash of the model, the tool definitions and the serialized chain, and are evicted when they
+    are older than the TTL or, least recently used first, when the cache is over its size in bytes. Only short chains
+    without tool calls or time- and chance-dependent questions are cached. The cache is saved to a JSON file so it
+    survives restarts.
+    The bot prefixes user messages with the author's name, "Name: question". The name is left out of the key, so the
+    same question from different users shares an entry, and responses that mention the asker's name are not cached.
+    """
+    def __init__(self, file_path=None, max_bytes=4 * 1024 * 1024, ttl=24 * 60 * 60, max_messages=2):
+        """
+        Initialize the cache, loading the entries saved in file_path that have not expired.
+        :param file_path: The path of the JSON file the cache is saved to, or None to keep it in memory only.
+        :param max_bytes: The maximum total size of the cached responses and their keys, in bytes.
+        :param ttl: How long a response is reused for, in seconds.
+        :param max_messages: Only chains of up to this many messages are cached, longer conversations rarely repeat.
+            2 is the system prompt and a single question.
+        """
+        self.file_path = file_path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.entries = OrderedDict()  # key -> (response content, time cached)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        if file_path:
+            self.load()
+
+    @staticmethod
+    def make_key(model, tools, message_chain) -> str:
+        """
+        :return: The cache key of a request, a hash of everything that determines its response but who asked.
+        """
+        messages = [
+            {**entry, "content": ResponseCache.split_speaker(entry["content"])[1]} if entry["role"] == "user" else entry
+            for entry in message_chain
+        ]
+        serialized = json.dumps({"model": model, "tools": tools, "messages": messages},
+                                sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, message_chain) -> bool:
+        """
+        :param message_chain: The chain of a request.
+        :return: Whether the response to this chain may be cached and reused.
+        """
+        if not message_chain or len(message_chain) > self.max_messages:
+            return False
+        for entry in message_chain:
+            if entry["role"] == "tool" or entry.get("tool_calls"):
+                return False
+        return not NON_DETERMINISTIC.search(message_chain[-1].get("content") or "")
+
+    @staticmethod
+    def split_speaker(content) -> tuple[str, str]:
+        """
+        :param content: The content of a user message, "Name: question".
+        :return: A tuple of the author's name, empty if there is none, and the question.
+        """
+        speaker, separator, question = (content or "").partition(": ")
+        return (speaker, question) if separator else ("", content)
+
+    def mentions_speaker(self, message_chain, content) -> bool:
+        """
+        :param message_chain: The chain of a request.
+        :param content: The response to it.
+        :return: Whether the response mentions the name of whoever asked, which makes it wrong for anyone else.
+        """
+        speaker = self.split_speaker(message_chain[-1].get("content"))[0].strip()
+        return bool(speaker) and speaker.casefold() in content.casefold()
+
+    def get(self, key) -> str | None:
+        """
+        :param key: The cache key, see make_key.
+        :return: The cached response content, or None if there is no fresh entry.
+        """
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[1] > self.ttl:
+            self.remove(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            metrics.increment("response_cache.misses")
+            return None
+
+        self.hits += 1
+        metrics.increment("response_cache.hits")
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, content, cached_at=None) -> None:
+        """
+        Cache a response, evicting the least recently used entries if the cache is over its size.
+        :param key: The cache key, see make_key.
+        :param content: The response content.
+        :param cached_at: When the response was created, defaults to now.
+        """
+        entry_size = self.entry_size(key, content)
+        if entry_size > self.max_bytes:
+            return
+        self.remove(key)
+
+        self.entries[key] = (content, cached_at or time.time())
+        self.size += entry_size
+        while self.size > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+        metrics.set_gauge("response_cache.bytes", self.size)
+
+    def remove(self, key) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= self.entry_size(key, entry[0])
+
+    @staticmethod
+    def entry_size(key, content) -> int:
+        return len(key) + len(content.encode("utf-8"))
+
+    def stats(self) -> dict:
+        """
+        :return: The number of hits and misses, the hit rate, and the number and total size of the entries.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+    def save(self) -> None:
+        """
+        Save the cache to its file, least recently used first.
+        The file is written to a temporary file first and atomically renamed, so a crash mid-save leaves the previous
+        file intact.
+        """
+        if not self.file_path:
+            return
+        temp_path = f"{self.file_path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as file:
+            json.dump([[key, content, cached_at] for key, (content, cached_at) in self.entries.items()], file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.file_path)
+
+    def load(self) -> None:
+        """
+        Load the entries saved in the cache file that have not expired.
+        """
+        try:
+            with open(self.file_path, "r", encoding="utf-8") as file:
+                saved_entries = json.load(file)
+        except FileNotFoundError:
+            return
+        except (json.JSONDecodeError, OSError) as e:
+            print(f"Error loading response cache, starting empty: {e}")
+            return
+
+        cutoff = time.time() - self.ttl
+        for key, content, cached_at in saved_entries:
+            if cached_at >= cutoff:
+                self.put(key, content, cached_at)
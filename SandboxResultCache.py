@@ -0,0 +1,254 @@
+import ast
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from Metrics import metrics
+
+# Code using any of these may print something different every time it runs, or depend on or change the sandbox
+NON_DETERMINISTIC_MODULES = {
+    "random", "secrets", "uuid", "time", "datetime", "calendar", "zoneinfo", "os", "sys", "pathlib", "shutil",
+    "glob", "tempfile", "io", "subprocess", "socket", "urllib", "http", "requests", "threading", "multiprocessing",
+    "asyncio", "signal", "ctypes", "importlib", "platform", "getpass", "resource", "gc", "pickle", "shelve", "sqlite3",
+}
+NON_DETERMINISTIC_NAMES = {"open", "input", "exec", "eval", "compile", "__import__", "globals", "locals", "vars",
+                           "hash", "id", "breakpoint"}
+NON_DETERMINISTIC_ATTRIBUTES = {
+    # Random numbers, e.g. np.random or rng.integers via default_rng
+    "random", "default_rng", "rand", "randn", "randint", "choice", "shuffle", "permutation", "seed", "urandom",
+    # The current time
+    "now", "today", "utcnow", "time", "perf_counter", "monotonic", "process_time",
+    # Files, e.g. pandas and numpy readers and writers
+    "read_csv", "to_csv", "read_excel", "to_excel", "read_json", "to_json", "read_parquet", "to_parquet",
+    "read_pickle", "to_pickle", "read_table", "read_sql", "to_sql", "load", "loadtxt", "genfromtxt", "save",
+    "savez", "savetxt", "fromfile", "tofile", "savefig", "memmap",
+    "environ", "getenv",
+}
+
+
+class SandboxResultCache:
+    """
+    Remembers the output of sandbox runs, so a snippet the model writes again is answered without running it.
+    Entries are keyed by a hash of the normalized code and a digest of the sandbox it ran in, e.g. the ID of the
+    Docker image, so rebuilding the sandbox starts afresh. Only code that cannot depend on chance, the time or the
+    filesystem is cached, see is_cacheable.
+    Each entry is a file in the cache directory, and the least recently used files are deleted once the directory is
+    over its size in bytes. The time the cached runs took is added up, to show how much running time was saved.
+    The cache is thread safe, code is expected to run in worker threads.
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, digest_ttl=60.0):
+        """
+        Initialize the cache, indexing the entries already in the directory.
+        :param directory: The directory the entries are stored in, created if needed.
+        :param max_bytes: The maximum total size of the entry files, in bytes.
+        :param digest_ttl: How long a sandbox digest is reused before it is looked up again, in seconds.
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.digest_ttl = digest_ttl
+        self.entries = OrderedDict()  # key -> size of its file, least recently used first
+        self.size = 0
+        self.digests = {}  # sandbox name -> (digest, time looked up)
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.saved_seconds = 0.0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    @staticmethod
+    def normalize(code) -> str | None:
+        """
+        :return: A canonical form of the code that ignores comments and formatting, or None if it does not parse.
+        """
+        try:
+            return ast.dump(ast.parse(code))
+        except (SyntaxError, ValueError):
+            return None
+
+    @staticmethod
+    def make_key(normalized_code, environment_digest) -> str:
+        """
+        :return: The cache key of a run, a hash of everything that determines its output.
+        """
+        return hashlib.sha256(f"{environment_digest}\0{normalized_code}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable(code) -> bool:
+        """
+        :return: Whether the output of the code only depends on the code, so it may be reused. Code that imports or
+            uses anything to do with randomness, time, files or the environment is not cacheable.
+        """
+        try:
+            tree = ast.parse(code)
+        except (SyntaxError, ValueError):
+            return False
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                modules = [node.module or ""]
+                if any(alias.name in NON_DETERMINISTIC_ATTRIBUTES for alias in node.names):
+                    return False
+            elif isinstance(node, ast.Name):
+                if node.id in NON_DETERMINISTIC_NAMES:
+                    return False
+                continue
+            elif isinstance(node, ast.Attribute):
+                if node.attr in NON_DETERMINISTIC_ATTRIBUTES:
+                    return False
+                continue
+            else:
+                continue
+            if any(module.split(".")[0] in NON_DETERMINISTIC_MODULES for module in modules):
+                return False
+        return True
+
+    def key_for(self, code, environment_digest) -> str | None:
+        """
+        :param code: The code about to run, after PythonExecutor.ensure_print_statement.
+        :param environment_digest: A function returning the digest of the sandbox the code runs in, only called if
+            the code is cacheable. See PythonExecutor.environment_digest.
+        :return: The cache key of the run, or None if it must not be cached.
+        """
+        normalized = self.normalize(code)
+        if normalized is None or not self.is_cacheable(code):
+            with self.lock:
+                self.skipped += 1
+            metrics.increment("sandbox_cache.skipped")
+            return None
+        return self.make_key(normalized, environment_digest())
+
+    def digest(self, name, look_up) -> str:
+        """
+        Remember the digest of a sandbox for digest_ttl seconds, so it is not looked up for every run.
+        :param name: The name of the sandbox, e.g. the Docker image.
+        :param look_up: A function returning the current digest of the sandbox.
+        :return: The digest.
+        """
+        with self.lock:
+            digest, looked_up = self.digests.get(name, (None, 0.0))
+        if digest is None or time.monotonic() - looked_up > self.digest_ttl:
+            digest = look_up()
+            with self.lock:
+                self.digests[name] = (digest, time.monotonic())
+        return digest
+
+    def get(self, key) -> bytes | None:
+        """
+        :param key: The cache key, see key_for.
+        :return: The cached stdout of the run, or None if it is not cached.
+        """
+        with self.lock:
+            cached = key in self.entries
+            if cached:
+                self.entries.move_to_end(key)
+        entry = self.read(key) if cached else None
+
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                metrics.increment("sandbox_cache.misses")
+                return None
+            self.hits += 1
+            self.saved_seconds += entry["duration"]
+        metrics.increment("sandbox_cache.hits")
+        metrics.set_gauge("sandbox_cache.saved_seconds", self.saved_seconds)
+        return entry["stdout"].encode("utf-8", "surrogateescape")
+
+    def put(self, key, stdout: bytes, duration) -> None:
+        """
+        Cache the output of a run, evicting the least recently used entries if the cache is over its size.
+        :param key: The cache key, see key_for.
+        :param stdout: The stdout of the run.
+        :param duration: How long the run took, in seconds. Every hit counts this as saved.
+        """
+        data = json.dumps({"stdout": stdout.decode("utf-8", "surrogateescape"), "duration": duration}).encode()
+        if len(data) > self.max_bytes:
+            return
+        path = self.path(key)
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+        with self.lock:
+            self.size += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            evicted = []
+            while self.size > self.max_bytes:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                evicted.append(evicted_key)
+        for evicted_key in evicted:
+            self.delete(evicted_key)
+        metrics.set_gauge("sandbox_cache.bytes", self.size)
+
+    def read(self, key) -> dict | None:
+        """
+        :return: The entry stored for the key, or None if its file is missing or damaged.
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                entry = json.loads(file.read())
+            # Keep the least recently used order on disk for the next start
+            os.utime(path)
+            return entry
+        except (OSError, ValueError) as e:
+            print(f"Error reading sandbox cache entry {key}: {e}")
+            with self.lock:
+                self.size -= self.entries.pop(key, 0)
+            return None
+
+    def delete(self, key) -> None:
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def path(self, key) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def load(self) -> None:
+        """
+        Index the entries in the directory, least recently used first, deleting any left over from a crash mid-write.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                os.unlink(entry.path)
+            elif entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        evicted = []
+        while self.size > self.max_bytes:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            evicted.append(key)
+        for key in evicted:
+            self.delete(key)
+
+    def stats(self) -> dict:
+        """
+        :return: The number of hits, misses and runs that could not be cached, the hit rate, the running time saved
+            in seconds, and the number and total size of the entries.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "skipped": self.skipped,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
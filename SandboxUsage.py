@@ -0,0 +1,138 @@
+import time
+from collections import Counter, defaultdict, deque
+
+from Metrics import metrics
+
+# Why a sandbox run ended
+EXIT_OK = "ok"
+EXIT_ERROR = "error"  # The code raised an exception or exited with a nonzero status
+EXIT_TIMEOUT = "timeout"  # Killed for running past the wall-clock timeout
+EXIT_CPU_LIMIT = "cpu_limit"  # Killed for using more CPU time than allowed
+EXIT_OOM = "oom"  # Ran out of memory, either a MemoryError or killed by the OOM killer
+EXIT_OUTPUT_LIMIT = "output_limit"  # Stopped for printing more than the output cap
+EXIT_KILLED = "killed"  # Killed by a signal for another or unknown reason
+EXIT_SANDBOX_ERROR = "sandbox_error"  # The sandbox itself failed, e.g. Docker was unreachable
+EXIT_CACHED = "cached"  # Answered from the result cache without running
+
+
+class RunUsage:
+    """What one sandbox run cost and how it ended. Resources the backend cannot measure are None."""
+    __slots__ = ("wall_seconds", "cpu_seconds", "peak_memory_bytes", "output_bytes", "exit_code", "exit_reason",
+                 "timed_out", "signal")
+
+    def __init__(self):
+        self.wall_seconds = 0.0
+        self.cpu_seconds = None
+        self.peak_memory_bytes = None  # Peak resident memory
+        self.output_bytes = 0  # stdout and stderr, including any part that was dropped
+        self.exit_code = None
+        self.exit_reason = None
+        self.timed_out = False  # Set by backends that know they killed the run for its timeout
+        self.signal = None  # The signal that killed the run, if the backend knows it
+
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class UsageTotals:
+    """The sums of the runs of one user or channel, see SandboxUsageTracker.stats."""
+    __slots__ = ("runs", "wall_seconds", "cpu_seconds", "peak_memory_bytes", "output_bytes", "exit_reasons")
+
+    def __init__(self):
+        self.runs = 0
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_memory_bytes = 0  # The largest peak of any run
+        self.output_bytes = 0
+        self.exit_reasons = Counter()
+
+    def add(self, usage: RunUsage) -> None:
+        self.runs += 1
+        self.wall_seconds += usage.wall_seconds
+        self.cpu_seconds += usage.cpu_seconds or 0.0
+        self.peak_memory_bytes = max(self.peak_memory_bytes, usage.peak_memory_bytes or 0)
+        self.output_bytes += usage.output_bytes
+        self.exit_reasons[usage.exit_reason] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "runs": self.runs,
+            "wall_seconds": self.wall_seconds,
+            "cpu_seconds": self.cpu_seconds,
+            "peak_memory_bytes": self.peak_memory_bytes,
+            "output_bytes": self.output_bytes,
+            "exit_reasons": dict(self.exit_reasons),
+        }
+
+
+class SandboxUsageTracker:
+    """
+    Keeps the usage of recent sandbox runs, so the expensive users, channels and tool calls can be found.
+    Runs are kept for the window, after which they drop out of the statistics. Every run is also exported as metrics:
+    the sandbox.run.* timings and the sandbox.runs.* counters for each exit reason.
+    """
+    def __init__(self, window=24 * 60 * 60):
+        """
+        :param window: How long runs count towards the statistics, in seconds.
+        """
+        self.window = window
+        self.by_user = defaultdict(deque)  # user ID -> (time, RunUsage) of recent runs, oldest first
+        self.by_channel = defaultdict(deque)  # channel ID -> the same
+
+    def record(self, usage: RunUsage, user_id=None, channel_id=None) -> None:
+        """
+        Record a finished run.
+        :param usage: The usage of the run.
+        :param user_id: The user the run was for.
+        :param channel_id: The channel the run was for.
+        """
+        now = time.time()
+        if user_id is not None:
+            self.by_user[user_id].append((now, usage))
+        if channel_id is not None:
+            self.by_channel[channel_id].append((now, usage))
+        self.prune(now)
+
+        metrics.increment(f"sandbox.runs.{usage.exit_reason}")
+        metrics.increment("sandbox.output_bytes", usage.output_bytes)
+        metrics.observe("sandbox.run.wall_time", usage.wall_seconds)
+        if usage.cpu_seconds is not None:
+            metrics.observe("sandbox.run.cpu_time", usage.cpu_seconds)
+        if usage.peak_memory_bytes is not None:
+            metrics.set_gauge("sandbox.run.last_peak_memory_bytes", usage.peak_memory_bytes)
+
+    def prune(self, now=None) -> None:
+        """
+        Drop the runs that are older than the window.
+        """
+        cutoff = (now or time.time()) - self.window
+        for runs_by_key in (self.by_user, self.by_channel):
+            for key in list(runs_by_key):
+                runs = runs_by_key[key]
+                while runs and runs[0][0] < cutoff:
+                    runs.popleft()
+                if not runs:
+                    del runs_by_key[key]
+
+    def stats(self, user_id=None, channel_id=None) -> dict:
+        """
+        :param user_id: The user to sum the runs of, or None.
+        :param channel_id: The channel to sum the runs of, or None. Ignored if a user is given.
+        :return: The totals of the runs in the window, see UsageTotals.to_dict.
+        """
+        self.prune()
+        runs = self.by_user.get(user_id, ()) if user_id is not None else self.by_channel.get(channel_id, ())
+        totals = UsageTotals()
+        for _, usage in runs:
+            totals.add(usage)
+        return totals.to_dict()
+
+    def top_users(self, count=5, by="cpu_seconds") -> list[tuple]:
+        """
+        :param count: The number of users to return.
+        :param by: The UsageTotals field to rank by, e.g. "wall_seconds".
+        :return: (user ID, totals) of the users who used the most in the window, most first.
+        """
+        self.prune()
+        totals = [(user_id, self.stats(user_id=user_id)) for user_id in self.by_user]
+        return sorted(totals, key=lambda item: item[1][by], reverse=True)[:count]
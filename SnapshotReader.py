@@ -0,0 +1,162 @@
+import json
+import re
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = re.compile(r'\s*')
+# The separator and key before each record, e.g. `, "1234": `. The key duplicates the record's message_id.
+_ENTRY_PREFIX = re.compile(r'\s*(,)?\s*"(?:[^"\\]|\\.)*"\s*:\s*')
+# Inside a JSON string the quotes would be escaped, so this only ever matches the record's own key
+_TIMESTAMP_KEY = '"timestamp": '
+_NUMBER = re.compile(r'-?[0-9][0-9.eE+-]*')
+
+
+def iter_snapshot(file_path, min_timestamp=None, chunk_size=1 << 16):
+    """
+    Stream the message records of a message_history.json snapshot one at a time, without loading the whole file.
+    Each record is decoded as soon as it has been read, so memory use is bounded by the records the caller keeps
+    rather than the size of the file.
+    :param file_path: The path of the snapshot, a JSON object mapping message IDs to message records.
+    :param min_timestamp: If given, records with a timestamp at or before this unix timestamp are skipped.
+    :param chunk_size: The number of characters to read at a time.
+    :return: A generator of message record dictionaries.
+    :raises FileNotFoundError: If the snapshot does not exist.
+    :raises ValueError: If the snapshot is not a JSON object of message records.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        if _has_line_records(file):
+            yield from _iter_line_records(file, min_timestamp)
+        else:
+            yield from _iter_chunk_records(file, min_timestamp, chunk_size)
+
+
+def _has_line_records(file):
+    """
+    Check whether the snapshot has one record per line, as written by DictMessageStore.save.
+    The file position is left at the start of the file.
+    """
+    first_line = file.readline()
+    second_line = file.readline().rstrip().rstrip(",")
+    file.seek(0)
+    if first_line.strip() != "{":
+        return False
+    match = _ENTRY_PREFIX.match(second_line)
+    return match is not None and second_line.endswith("}")
+
+
+def _iter_line_records(file, min_timestamp):
+    """
+    Read a snapshot with one record per line.
+    The timestamp is found with a plain string search before the record is decoded, so records past the cutoff are
+    skipped without being parsed.
+    """
+    file.readline()  # The opening brace
+    for line in file:
+        line = line.strip()
+        if line == "}":
+            return
+        # The key is normally a plain ID, only fall back to the regex if it contains escapes
+        split = line.find('": {')
+        if line.startswith('"') and split != -1 and "\\" not in line[:split]:
+            record_text = line[split + 3:].rstrip(",")
+        else:
+            match = _ENTRY_PREFIX.match(line)
+            if match is None:
+                raise ValueError("Malformed snapshot: expected one record per line")
+            record_text = line[match.end():].rstrip(",")
+
+        if min_timestamp is not None:
+            start = record_text.find(_TIMESTAMP_KEY)
+            if start != -1:
+                timestamp = _NUMBER.match(record_text, start + len(_TIMESTAMP_KEY))
+                if timestamp is not None and float(timestamp.group()) <= min_timestamp:
+                    continue
+
+        record = json.loads(record_text)
+        if not isinstance(record, dict):
+            raise ValueError("Malformed snapshot: expected a record")
+        if min_timestamp is None or record["timestamp"] > min_timestamp:
+            yield record
+    raise ValueError("Malformed snapshot: truncated")
+
+
+def _iter_chunk_records(file, min_timestamp, chunk_size):
+    """
+    Read a snapshot in any layout (e.g. written by json.dump on a single line) through a sliding buffer.
+    """
+    reader = _ChunkReader(file, chunk_size)
+    if not reader.skip_whitespace():
+        return  # An empty file is treated as an empty snapshot
+    if reader.buffer[reader.pos] != "{":
+        raise ValueError("Malformed snapshot: expected a JSON object")
+    reader.pos += 1
+
+    first = True
+    while True:
+        match = _ENTRY_PREFIX.match(reader.buffer, reader.pos)
+        if match is None or match.end() == len(reader.buffer):
+            # Either the end of the object, or a key cut off at the end of the buffer
+            if reader.skip_whitespace() and reader.buffer[reader.pos] == "}":
+                return
+            if not reader.read_more():
+                raise ValueError("Malformed snapshot: truncated or invalid key")
+            continue
+        if first == (match.group(1) is not None):
+            raise ValueError(f"Malformed snapshot: unexpected separator near character {reader.pos}")
+        first = False
+        reader.pos = match.end()
+
+        record = reader.decode_object()
+        if min_timestamp is None or record["timestamp"] > min_timestamp:
+            yield record
+
+
+class _ChunkReader:
+    """A cursor over a text file that decodes JSON values from a sliding buffer."""
+    def __init__(self, file, chunk_size):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+
+    def read_more(self):
+        """
+        Append the next chunk to the buffer, dropping what has already been consumed.
+        :return: False at the end of the file.
+        """
+        chunk = self.file.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip_whitespace(self):
+        """
+        Move past any whitespace, reading more of the file if needed.
+        :return: False if the end of the file was reached.
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return True
+            if not self.read_more():
+                return False
+
+    def decode_object(self):
+        """
+        Decode the next JSON object, reading more of the file until it is complete.
+        Unlike a number, an object cut off at the end of the buffer never decodes successfully.
+        """
+        while True:
+            if not self.skip_whitespace():
+                raise ValueError("Malformed snapshot: truncated record")
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise ValueError("Malformed snapshot: truncated or invalid record")
+                continue
+            if not isinstance(value, dict):
+                raise ValueError(f"Malformed snapshot: expected a record near character {self.pos}")
+            self.pos = end
+            return value
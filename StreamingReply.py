@@ -0,0 +1,99 @@
+import time
+
+import discord
+
+from Metrics import metrics
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+
+class StreamingReply:
+    """
+    Shows a response in Discord while it is still being generated.
+    A placeholder reply is posted straight away and edited as the text grows. Edits are throttled to stay within
+    Discord's rate limits, and once the text passes the 2000 character limit the rest continues in a new reply.
+    """
+    def __init__(self, original_message: discord.Message, edit_interval=1.0, placeholder="..."):
+        """
+        :param original_message: The message being replied to.
+        :param edit_interval: The minimum time between edits of the same reply, in seconds.
+        :param placeholder: The text shown until the first part of the response arrives.
+        """
+        self.original_message = original_message
+        self.edit_interval = edit_interval
+        self.placeholder = placeholder
+        self.text = ""
+        self.sent_messages = []  # One Discord message per 2000 character part
+        self.shown_parts = []  # The text currently shown in each sent message
+        self.last_edit = 0.0
+        self.started = time.perf_counter()
+
+    async def start(self) -> None:
+        """
+        Post the placeholder reply.
+        """
+        sent_message = await self.original_message.reply(self.placeholder)
+        self.sent_messages.append(sent_message)
+        self.shown_parts.append(self.placeholder)
+
+    async def update(self, text: str) -> None:
+        """
+        Record the text received so far, updating Discord if the last edit was long enough ago.
+        The first text is always shown immediately.
+        :param text: The full text of the response so far.
+        """
+        self.text = text
+        first_text = self.shown_parts == [self.placeholder]
+        if first_text or time.perf_counter() - self.last_edit >= self.edit_interval:
+            await self.flush()
+            if first_text:
+                metrics.observe("discord.first_visible_token", time.perf_counter() - self.started)
+
+    async def finish(self, text: str) -> list:
+        """
+        Show the complete response.
+        :param text: The complete text of the response.
+        :return: A list of (sent message, part) tuples, one for each 2000 character part of the text, in order.
+        """
+        self.text = text
+        await self.flush()
+        return list(zip(self.sent_messages, self.shown_parts))
+
+    async def discard(self) -> None:
+        """
+        Delete every reply posted so far, e.g. when the response turned out to be a tool call.
+        """
+        for sent_message in self.sent_messages:
+            try:
+                await sent_message.delete()
+            except discord.HTTPException as e:
+                print(f"Error deleting streamed reply: {e}")
+        self.sent_messages = []
+        self.shown_parts = []
+
+    async def flush(self) -> None:
+        """
+        Bring the replies in Discord up to date with the text received so far.
+        """
+        parts = [self.text[i:i + DISCORD_MESSAGE_LIMIT] for i in range(0, len(self.text), DISCORD_MESSAGE_LIMIT)]
+        for index, part in enumerate(parts):
+            if index < len(self.sent_messages):
+                if self.shown_parts[index] != part:
+                    await self.sent_messages[index].edit(content=part)
+                    self.shown_parts[index] = part
+            else:
+                # The previous part is full, continue in a new reply
+                sent_message = await self.original_message.reply(part)
+                self.sent_messages.append(sent_message)
+                self.shown_parts.append(part)
+
+        # The text can get shorter when the stream is retried and starts again, remove the replies it no longer fills
+        keep = max(len(parts), 1)
+        for sent_message in self.sent_messages[keep:]:
+            try:
+                await sent_message.delete()
+            except discord.HTTPException as e:
+                print(f"Error deleting streamed reply: {e}")
+        del self.sent_messages[keep:]
+        del self.shown_parts[keep:]
+        self.last_edit = time.perf_counter()
@@ -0,0 +1,274 @@
+import hashlib
+import os
+import platform
+import selectors
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from PythonExecutor import PythonExecutor, KILLED_EXIT_CODE
+
+# The libraries the tool description promises, their versions are part of the environment digest
+SANDBOX_LIBRARIES = ["numpy", "pandas", "scipy", "scikit-learn", "sympy"]
+
+# Runs in the sandboxed interpreter: applies the resource limits, then runs the code as python -c would. Limits are
+# applied here rather than in a preexec_fn, which is not safe to use from the worker threads code runs in.
+BOOTSTRAP = """
+import resource, sys, traceback
+memory, cpu_seconds, file_size, open_files = map(int, sys.argv[1:5])
+resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))
+resource.setrlimit(resource.RLIMIT_NOFILE, (open_files, open_files))
+resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+code = sys.argv[5]
+sys.argv = ["-c"]
+del resource, memory, cpu_seconds, file_size, open_files
+try:
+    exec(compile(code, "<code>", "exec"), {"__name__": "__main__", "__builtins__": __builtins__})
+except SystemExit:
+    raise
+except BaseException as e:
+    traceback.print_exception(type(e), e, e.__traceback__.tb_next)
+    sys.exit(1)
+"""
+
+# Prints the interpreter's version and the versions of the libraries given as arguments
+DESCRIBE_ENVIRONMENT = """
+import sys
+from importlib import metadata
+print(sys.version)
+for library in sys.argv[1:]:
+    try:
+        print(library, metadata.version(library))
+    except metadata.PackageNotFoundError:
+        print(library, "missing")
+"""
+
+# Builds a new root for the code in a private mount namespace and runs the command given after the arguments in it,
+# from /tmp. The root holds the system directories and the interpreter's prefixes read-only, a few devices and the
+# code's working directory as /tmp, and nothing else of the host's filesystem, such as the bot's secrets.json.
+# Arguments: the directory to mount the root on, the working directory, the prefixes separated by colons.
+SANDBOX_ROOT_SCRIPT = """
+set -e
+root=$1; work=$2; prefixes=$3; shift 3
+chroot=$(PATH=/usr/sbin:/sbin:$PATH command -v chroot)
+mount -t tmpfs -o mode=755 sandbox "$root"
+IFS=:
+for path in /usr /bin /lib /lib64 /sbin /etc/alternatives /etc/ld.so.cache /etc/localtime $prefixes; do
+    [ -e "$path" ] || continue
+    if [ -L "$path" ]; then
+        mkdir -p "$root$(dirname "$path")"
+        ln -sfn "$(readlink "$path")" "$root$path"
+        continue
+    fi
+    if [ -d "$path" ]; then
+        mkdir -p "$root$path"
+    else
+        mkdir -p "$root$(dirname "$path")"
+        touch "$root$path"
+    fi
+    mount --rbind "$path" "$root$path"
+    mount -o remount,bind,ro "$root$path"
+done
+unset IFS
+mkdir -p "$root/dev" "$root/tmp"
+for device in null zero random urandom; do
+    touch "$root/dev/$device"
+    mount --bind "/dev/$device" "$root/dev/$device"
+done
+mount --bind "$work" "$root/tmp"
+exec "$chroot" "$root" /bin/sh -c 'cd /tmp && exec "$@"' sh "$@"
+"""
+
+# Prints the interpreter's prefixes, which the sandbox's root needs to run it
+PRINT_PREFIXES = "import sys; print(sys.base_prefix); print(sys.prefix)"
+
+FILESYSTEM_ISOLATION_UNAVAILABLE = ("Error: Python is not available here, the sandbox cannot hide the host's files "
+                                    "without unshare and unprivileged user namespaces.")
+
+# Whether unshare can create the namespaces each command asks for, checked on first use, see
+# SubprocessPythonExecutor.unshare_command
+isolation_available = {}
+
+
+class SubprocessPythonExecutor(PythonExecutor):
+    """
+    Runs the given Python code in a local subprocess, for hosts without Docker and for quick calculations that do not
+    need a container.
+    The subprocess runs an isolated interpreter (python -I) with CPU time, memory, file size and open file limits, in a
+    temporary directory of its own that is deleted afterwards, with a minimal environment and without network access.
+    It is killed along with anything it started once it runs past the timeout or prints more than max_output_bytes.
+    The code runs in a root of its own, in a mount namespace, that only holds the system directories and the
+    interpreter read-only and its temporary directory as /tmp, so it cannot read the bot's files such as secrets.json.
+    This needs unshare and unprivileged user namespaces; where they are not available no code is run, unless
+    isolate_filesystem is turned off, in which case the code can read and write anything the bot can.
+    """
+    def __init__(self, timeout=5, max_output_bytes=1024 * 1024, result_cache=None, python=None,
+                 memory_limit_bytes=1024 * 1024 * 1024, cpu_time_limit=None, file_size_limit_bytes=16 * 1024 * 1024,
+                 open_files_limit=64, isolate_network=True, isolate_filesystem=True):
+        """
+        :param python: The interpreter to run the code with, by default the one running the bot.
+        :param memory_limit_bytes: The address space the code may use.
+        :param cpu_time_limit: The CPU time the code may use, in seconds. None allows a second more than the timeout.
+        :param file_size_limit_bytes: The largest file the code may write.
+        :param open_files_limit: The number of files the code may have open at once.
+        :param isolate_network: Whether to cut the code off from the network where possible.
+        :param isolate_filesystem: Whether to hide the host's filesystem from the code, refusing to run it where that
+            is not possible. Only turn this off where the code may read and write anything the bot can.
+        """
+        super().__init__(timeout=timeout, max_output_bytes=max_output_bytes, result_cache=result_cache,
+                         memory_limit_bytes=memory_limit_bytes, cpu_time_limit=cpu_time_limit)
+        self.python = python or sys.executable
+        self.file_size_limit_bytes = file_size_limit_bytes
+        self.open_files_limit = open_files_limit
+        self.isolate_network = isolate_network
+        self.isolate_filesystem = isolate_filesystem
+        self.python_prefixes = None  # Asked of the interpreter on first use
+
+    def execute(self, code, session_id, stdout, stderr):
+        try:
+            with tempfile.TemporaryDirectory(prefix="sandbox-") as directory:
+                prefix = self.sandbox_prefix(directory)
+                if prefix is None:
+                    return None, FILESYSTEM_ISOLATION_UNAVAILABLE
+                exit_code = self.run_process(code, prefix, directory, stdout, stderr)
+        except Exception as e:
+            return None, f"An error occurred: {e}"
+        if exit_code is None:
+            return stdout, None
+        return self.result(exit_code, stdout, stderr)
+
+    def run_process(self, code, prefix, directory, stdout, stderr):
+        """
+        Run the code in a sandboxed subprocess, collecting its output as it is printed. The CPU time and peak memory it
+        used, and the signal that killed it, are set in usage.
+        :param prefix: The command that isolates the code, see sandbox_prefix.
+        :param directory: The code's temporary directory.
+        :return: The exit code of the code, 137 if it was killed, or None if it printed too much and was cut off.
+        """
+        command = prefix + [
+            self.python, "-I", "-c", BOOTSTRAP, str(self.memory_limit_bytes), str(int(self.cpu_time_limit)),
+            str(self.file_size_limit_bytes), str(self.open_files_limit), code,
+        ]
+        # The code sees its directory as /tmp in a root of its own
+        home = "/tmp" if self.isolate_filesystem else directory
+        environment = {
+            "PATH": os.defpath, "HOME": home, "TMPDIR": home, "LANG": "C.UTF-8",
+            "PYTHONIOENCODING": "utf-8", "MPLBACKEND": "Agg",
+            # Idle BLAS thread pools count against the memory limit and are no use for small calculations
+            "OMP_NUM_THREADS": "1", "OPENBLAS_NUM_THREADS": "1", "MKL_NUM_THREADS": "1",
+        }
+        # A session of its own, so a timeout kills any processes the code starts too
+        process = subprocess.Popen(command, cwd=directory, env=environment, stdin=subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        captures = {process.stdout: stdout, process.stderr: stderr}
+        deadline = time.monotonic() + self.timeout
+        cut_off = killed = False
+        with selectors.DefaultSelector() as selector:
+            for pipe in captures:
+                selector.register(pipe, selectors.EVENT_READ)
+            while selector.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    killed = True
+                    break
+                for key, _ in selector.select(remaining):
+                    chunk = os.read(key.fd, 65536)
+                    if chunk:
+                        captures[key.fileobj].write(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+                if stdout.exceeded or stderr.exceeded:
+                    cut_off = True
+                    break
+
+        if killed or cut_off:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        process.stdout.close()
+        process.stderr.close()
+        # wait4 rather than wait, for the resources the process used. unshare, the shell and chroot each replace
+        # themselves with the next command, so the process is still the interpreter in the end.
+        _, status, rusage = os.wait4(process.pid, 0)
+        exit_code = process.returncode = os.waitstatus_to_exitcode(status)
+        self.usage.cpu_seconds = rusage.ru_utime + rusage.ru_stime
+        self.usage.peak_memory_bytes = rusage.ru_maxrss * 1024  # Linux reports kilobytes
+        self.usage.timed_out = killed
+        if exit_code < 0:
+            self.usage.signal = -exit_code
+        if cut_off:
+            return None
+        if killed or exit_code < 0:
+            # Killed by the timeout, or by a signal such as SIGXCPU for going over the CPU time limit
+            return KILLED_EXIT_CODE
+        return exit_code
+
+    def sandbox_prefix(self, directory) -> list[str] | None:
+        """
+        :param directory: The code's temporary directory, the root and the working directory are made in it.
+        :return: The command prefix that runs the code isolated from the host, or None if the filesystem is to be
+            isolated and that is not possible here.
+        """
+        unshare = self.unshare_command()
+        if not self.isolate_filesystem:
+            return unshare or []
+        if unshare is None:
+            return None
+        root, work = os.path.join(directory, "root"), os.path.join(directory, "work")
+        os.mkdir(root)
+        os.mkdir(work)
+        if self.python_prefixes is None:
+            result = subprocess.run([self.python, "-I", "-c", PRINT_PREFIXES], capture_output=True, text=True,
+                                    timeout=30, check=True)
+            self.python_prefixes = ":".join(sorted(set(result.stdout.split())))
+        return unshare + ["sh", "-c", SANDBOX_ROOT_SCRIPT, "sandbox", root, work, self.python_prefixes]
+
+    def unshare_command(self) -> list[str] | None:
+        """
+        :return: The unshare command that gives the code the namespaces it is isolated in, or None if there is nothing
+            to isolate or that is not possible on this host.
+        """
+        namespaces = (["--mount"] if self.isolate_filesystem else []) + (["--net"] if self.isolate_network else [])
+        if not namespaces:
+            return None
+        command = ["unshare", "--user", "--map-root-user", *namespaces, "--"]
+        key = " ".join(namespaces)
+        if key not in isolation_available:
+            isolation_available[key] = self.check_isolation(command)
+            if not isolation_available[key] and self.isolate_filesystem:
+                print("Filesystem isolation is not available, the subprocess sandbox will not run any code")
+            elif not isolation_available[key]:
+                print("Network isolation is not available, subprocess sandbox code can reach the network")
+        return command if isolation_available[key] else None
+
+    @staticmethod
+    def check_isolation(command) -> bool:
+        """
+        :return: Whether unshare can create the namespaces the command asks for, which needs unprivileged user
+            namespaces.
+        """
+        if platform.system() != "Linux" or shutil.which("unshare") is None:
+            return False
+        try:
+            result = subprocess.run(command + ["true"], capture_output=True, timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            return False
+        return result.returncode == 0
+
+    def environment_digest(self) -> str:
+        """
+        :return: A hash of the interpreter and the versions of the libraries the code can use.
+        """
+        return self.result_cache.digest(f"subprocess:{self.python}", self.describe_environment)
+
+    def describe_environment(self) -> str:
+        # Asked of the interpreter itself, which may not be the one running the bot
+        result = subprocess.run([self.python, "-I", "-c", DESCRIBE_ENVIRONMENT, *SANDBOX_LIBRARIES],
+                                capture_output=True, timeout=30, check=True)
+        return hashlib.sha256(result.stdout).hexdigest()
@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime
+
+from Metrics import metrics
+
+
+class TimerScheduler:
+    """
+    Keeps the pending timers in memory, in a heap ordered by when they expire, and hands them to a handler once they
+    do. The timers are read from the TimerStore once, when the scheduler is created, and the store is only written
+    when a timer is added or fires. In between, run sleeps until the next timer is due, and add wakes it early if the
+    new timer is due before that.
+    A timer is deleted from the store after its handler has run, so a crash in between fires it again on restart
+    rather than losing it.
+    The scheduler is not thread safe, it is only used from the event loop.
+    """
+    def __init__(self, store):
+        """
+        Initialize the scheduler with the timers in the store.
+        :param store: The TimerStore the timers are kept in.
+        """
+        self.store = store
+        # (expiry timestamp, timer id, timer), the next to expire first. The ids order timers that expire together,
+        # the timers themselves do not compare. The store gives them in order, which is already a heap.
+        self.heap = [(expires_at, timer["id"], timer) for expires_at, timer in store.pending()]
+        self.wakeup = asyncio.Event()
+        metrics.set_gauge("timers.pending", len(self.heap))
+
+    def add(self, user_id, channel_id, name, expire_time: datetime) -> None:
+        """
+        Add a timer, waking run if it is now the next to expire.
+        :param user_id: The user to notify.
+        :param channel_id: The channel to notify them in.
+        :param name: What the timer is for.
+        :param expire_time: When the timer expires, in local time.
+        """
+        timer = self.store.add(user_id, channel_id, name, expire_time)
+        heapq.heappush(self.heap, (expire_time.timestamp(), timer["id"], timer))
+        metrics.set_gauge("timers.pending", len(self.heap))
+        if self.heap[0][2] is timer:
+            self.wakeup.set()
+
+    def pop_expired(self, now=None) -> list[dict]:
+        """
+        Take the timers that have expired off the heap.
+        :param now: The current timestamp, by default the time now.
+        :return: The expired timers, the earliest first.
+        """
+        now = time.time() if now is None else now
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expired.append(heapq.heappop(self.heap)[2])
+        return expired
+
+    def seconds_until_next(self, now=None) -> float | None:
+        """
+        :return: How long until the next timer expires, or None if there are no timers.
+        """
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - (time.time() if now is None else now), 0.0)
+
+    async def run(self, on_expired) -> None:
+        """
+        Hand timers to on_expired as they expire, until cancelled.
+        :param on_expired: An async function called with the list of timers that expired together.
+        """
+        while True:
+            self.wakeup.clear()
+            expired = self.pop_expired()
+            if expired:
+                metrics.increment("timers.fired", len(expired))
+                try:
+                    await on_expired(expired)
+                except Exception as e:
+                    print(f"Error handling expired timers: {e}")
+                try:
+                    self.store.delete([timer["id"] for timer in expired])
+                except Exception as e:
+                    print(f"Error deleting expired timers: {e}")
+                metrics.set_gauge("timers.pending", len(self.heap))
+                continue
+
+            # Sleeps for as long as there is nothing to do, add sets wakeup if a new timer is due sooner
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.seconds_until_next())
+            except asyncio.TimeoutError:
+                pass
+
+    def __len__(self):
+        return len(self.heap)
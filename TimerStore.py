@@ -0,0 +1,132 @@
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+SCHEMA_VERSION = 1  # Stored as the database's user_version once the legacy JSON file has been imported
+
+
+class TimerStore:
+    """
+    Keeps pending timers in an SQLite database, so a timer survives a crash or restart once add has returned.
+    Every write is a transaction of its own on a single connection, behind a lock, so there is only ever one writer
+    and a crash leaves either all of a write or none of it. Timers are indexed by when they expire.
+    A timer is a dict of its id, user_id, channel_id, name and expire_time, an ISO 8601 local time.
+    """
+    COLUMNS = "id, user_id, channel_id, name, expire_time"
+
+    def __init__(self, db_path, legacy_json_path=None):
+        """
+        Open (or create) the database.
+        :param db_path: The path of the SQLite database file.
+        :param legacy_json_path: A timers.json file to import the first time the database is opened.
+        """
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS timers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id NOT NULL,
+                channel_id NOT NULL,
+                name TEXT,
+                expire_time TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS timers_expires_at ON timers (expires_at);
+        """)
+        self.connection.commit()
+
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            # Only once, the file still lists timers that have fired since
+            if legacy_json_path:
+                self.import_json(legacy_json_path)
+            with self.lock, self.connection:
+                self.connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def import_json(self, json_path):
+        """
+        Import the timers from a timers.json file written before timers were stored here.
+        :param json_path: The path of the file, missing or unreadable files are ignored.
+        :return: The number of timers imported.
+        """
+        try:
+            with open(json_path, "r") as file:
+                timers = json.load(file)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Error reading timers file {json_path}: {e}")
+            return 0
+
+        rows = [self.timer_to_row(timer) for timer in timers]
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO timers (user_id, channel_id, name, expire_time, expires_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+        print(f"Imported {len(rows)} timers from {json_path}")
+        return len(rows)
+
+    @staticmethod
+    def timer_to_row(timer):
+        expires_at = datetime.fromisoformat(timer["expire_time"]).timestamp()
+        return timer["user_id"], timer["channel_id"], timer["name"], timer["expire_time"], expires_at
+
+    @staticmethod
+    def row_to_timer(row):
+        return {"id": row[0], "user_id": row[1], "channel_id": row[2], "name": row[3], "expire_time": row[4]}
+
+    def add(self, user_id, channel_id, name, expire_time: datetime) -> dict:
+        """
+        Store a new timer, durably by the time this returns.
+        :return: The timer, with the id it was stored under.
+        """
+        timer = {"user_id": user_id, "channel_id": channel_id, "name": name, "expire_time": expire_time.isoformat()}
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO timers (user_id, channel_id, name, expire_time, expires_at) VALUES (?, ?, ?, ?, ?)",
+                self.timer_to_row(timer)
+            )
+        timer["id"] = cursor.lastrowid
+        return timer
+
+    def delete(self, timer_ids) -> None:
+        """
+        Delete timers, e.g. once they have fired, in a single transaction.
+        :param timer_ids: The ids of the timers.
+        """
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM timers WHERE id = ?", [(timer_id,) for timer_id in timer_ids])
+
+    def due(self, timestamp) -> list[dict]:
+        """
+        :param timestamp: The cutoff, as a unix timestamp.
+        :return: The timers that expire at or before the cutoff, the earliest first. Only those are visited, via the
+            expiry index.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {self.COLUMNS} FROM timers WHERE expires_at <= ? ORDER BY expires_at, id", (timestamp,)
+            ).fetchall()
+        return [self.row_to_timer(row) for row in rows]
+
+    def pending(self) -> list[tuple[float, dict]]:
+        """
+        :return: (expiry timestamp, timer) of every stored timer, the earliest first.
+        """
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT {self.COLUMNS}, expires_at FROM timers ORDER BY expires_at, id"
+            ).fetchall()
+        return [(row[5], self.row_to_timer(row)) for row in rows]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM timers").fetchone()[0]
@@ -1,9 +1,11 @@
 import datetime
-import json
+from collections import defaultdict
 
+DISCORD_MESSAGE_LIMIT = 2000
 
-async def set_timer(ctx, discord_client, time: str, timer_name: str):
-    """Sets a timer and writes to timers.json based on user reaction."""
+
+async def set_timer(ctx, discord_client, timer_scheduler, time: str, timer_name: str):
+    """Sets a timer in the TimerScheduler based on user reaction."""
     # Validate and calculate the timer end time
     try:
         timer_end = datetime.datetime.fromisoformat(time)
@@ -38,26 +40,47 @@ async def set_timer(ctx, discord_client, time: str, timer_name: str):
     reaction, user = await discord_client.wait_for('reaction_add', check=check)
     if str(reaction.emoji) == '👍':
         # Set the timer for the user who reacted with thumbsup
-        add_timer(user.id, ctx.channel.id, timer_name, timer_end)
+        timer_scheduler.add(user.id, ctx.channel.id, timer_name, timer_end)
         await ctx.reply(f"Timer set for {user.display_name} at {readable_time}.")
     elif str(reaction.emoji) == '❌' and user.id == ctx.author.id:
         # The user who requested the timer canceled it
         await ctx.reply("Timer setting canceled.")
 
 
-def add_timer(user_id, channel_id, timer_name, timer_end):
-    """Add a new timer to the JSON file."""
-    with open("timers.json", "r+") as file:
-        try:
-            timers = json.load(file)
-        except json.JSONDecodeError:
-            timers = []  # Handle empty file scenario
-        timers.append({
-            "user_id": user_id,
-            "channel_id": channel_id,
-            "name": timer_name,
-            "expire_time": timer_end.isoformat()
-        })
-        file.seek(0)
-        json.dump(timers, file, indent=4)
-        file.truncate()
+def timer_notifications(timers) -> dict:
+    """
+    Group expired timers into one notification per channel, mentioning every user whose timer expired there.
+    Mentions are built from the user IDs, so no user has to be fetched from Discord.
+    :param timers: The expired timers.
+    :return: A dictionary of channel ID to the messages to send there, more than one only if a message would be over
+        Discord's length limit.
+    """
+    # channel ID -> timer name -> user IDs, in the order the timers expired
+    users_by_name = defaultdict(lambda: defaultdict(list))
+    for timer in timers:
+        user_ids = users_by_name[timer["channel_id"]][timer["name"]]
+        if timer["user_id"] not in user_ids:
+            user_ids.append(timer["user_id"])
+
+    notifications = {}
+    for channel_id, names in users_by_name.items():
+        lines = []
+        for name, user_ids in names.items():
+            suffix = f" :alarm_clock:: '{str(name)[:200]}'"  # The name may be None, shown as 'None'
+            mentions = ""
+            for user_id in user_ids:
+                # So many users that the line is too long, the rest are mentioned on another line
+                if mentions and len(mentions) + len(f" <@{user_id}>") + len(suffix) > DISCORD_MESSAGE_LIMIT:
+                    lines.append(mentions + suffix)
+                    mentions = ""
+                mentions = f"{mentions} <@{user_id}>" if mentions else f"<@{user_id}>"
+            lines.append(mentions + suffix)
+
+        messages = [lines[0]]
+        for line in lines[1:]:
+            if len(messages[-1]) + 1 + len(line) > DISCORD_MESSAGE_LIMIT:
+                messages.append(line)
+            else:
+                messages[-1] += "\n" + line
+        notifications[channel_id] = messages
+    return notifications
@@ -0,0 +1,42 @@
+from functools import lru_cache
+
+try:
+    import tiktoken
+except ImportError:  # Fall back to an estimate if tiktoken is not installed
+    tiktoken = None
+
+DEFAULT_ENCODING = "o200k_base"  # The encoding used by gpt-4o
+# Tokens the chat format adds around every message on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name=DEFAULT_ENCODING):
+    """
+    Load a tiktoken encoding once and reuse it.
+    :param encoding_name: The name of the encoding.
+    :return: The encoding, or None if tiktoken is not available.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception as e:  # e.g. the encoding could not be downloaded
+        print(f"Could not load tokenizer {encoding_name}, estimating token counts instead: {e}")
+        return None
+
+
+def count_tokens(text, encoding_name=DEFAULT_ENCODING):
+    """
+    Count the tokens in a string with a local tokenizer.
+    If tiktoken is unavailable, the count is estimated as one token per four characters.
+    :param text: The text to count.
+    :param encoding_name: The name of the tiktoken encoding to use.
+    :return: The number of tokens.
+    """
+    if not text:
+        return 0
+    encoding = get_encoding(encoding_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,16 @@
+from MessageGraph import MessageGraph
+
+
+def test_reply_to_a_cached_chain_counts_one_miss(tmp_path):
+    graph = MessageGraph(str(tmp_path / "history.json"), fsync=False)
+    graph.add_message(1, "system", "You are a helpful bot.", 0)
+    graph.add_message(2, "user", "Alice: hi", 1, reply_to=1)
+    graph.get_message_chain(2)
+    graph.add_message(3, "assistant", "Hello!", 2, reply_to=2)
+    before = graph.chain_cache.stats()
+    assert [entry["content"] for entry in graph.get_message_chain(3)] == ["You are a helpful bot.", "Alice: hi",
+                                                                          "Hello!"]
+    after = graph.chain_cache.stats()
+    assert (after["hits"] - before["hits"], after["misses"] - before["misses"]) == (0, 1)
+    graph.get_message_chain(3)
+    assert graph.chain_cache.stats()["hits"] == after["hits"] + 1
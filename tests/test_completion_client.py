@@ -0,0 +1,34 @@
+import asyncio
+import time
+
+from Benchmarks.fake_openai import FakeOpenAIServer
+from CompletionClient import CompletionClient
+
+CHAIN = [{"role": "system", "content": "You are a bot"}, {"role": "user", "content": "someone: hello"}]
+
+
+def test_concurrent_requests_overlap():
+    requests, latency = 8, 0.3
+
+    async def main():
+        server = FakeOpenAIServer(latency=latency)
+        await server.start()
+        client = CompletionClient("fake-key", "gpt-4o", max_concurrent_requests=requests, base_url=server.base_url)
+        try:
+            started = time.perf_counter()
+            response, error = await client.create(CHAIN)
+            single = time.perf_counter() - started
+            assert error is None and response.content
+
+            started = time.perf_counter()
+            results = await asyncio.gather(*(client.create(CHAIN) for _ in range(requests)))
+            concurrent = time.perf_counter() - started
+        finally:
+            await client.close()
+            await server.stop()
+        assert all(error is None for _, error in results)
+        assert server.requests == requests + 1
+        # Queued one after the other they would take requests times as long
+        assert concurrent < single * 2
+
+    asyncio.run(main())
@@ -0,0 +1,125 @@
+import os
+import time
+
+import pytest
+
+from MessageNode import MessageNode
+from MessageStore import DictMessageStore, SQLiteMessageStore
+
+
+def ids(nodes):
+    return [node.message_id for node in nodes]
+
+
+def test_log_is_replayed_on_top_of_the_snapshot(tmp_path):
+    path = str(tmp_path / "history.json")
+    now = time.time()
+    store = DictMessageStore(path, fsync=False)
+    store.put(MessageNode("1_system", "system", "You are a helpful bot.", now - 30))
+    store.put(MessageNode(1, "user", "Alice: hi", now - 20, parent_id="1_system"))
+    store.put(MessageNode(2, "assistant", "Hello!", now - 10, parent_id=1))
+    store.save()
+
+    # Changed after the snapshot, so only in the log, as after a crash
+    store.put(MessageNode(3, "user", "Alice: and again", now, parent_id=2))
+    store.put(MessageNode(2, "assistant", "Hello again!", now - 10, parent_id=1))
+    store.set_parent(1, None)
+    assert store.delete_older_than(now - 25) == ["1_system"]
+    store.close()
+
+    reloaded = DictMessageStore(path, fsync=False)
+    assert ids(reloaded.chain(3)) == [1, 2, 3]
+    assert reloaded.get(2).content == "Hello again!"
+    assert "1_system" not in reloaded and len(reloaded) == 3
+    # Evicting after a reload still finds the replayed messages
+    assert sorted(reloaded.delete_older_than(now - 5)) == [1, 2]
+    reloaded.close()
+
+
+def test_save_replaces_the_snapshot_then_truncates_the_log(tmp_path):
+    path = str(tmp_path / "history.json")
+    now = time.time()
+    store = DictMessageStore(path, fsync=False)
+    store.put(MessageNode(1, "user", "Alice: hi", now))
+    store.save()
+    assert os.path.getsize(f"{path}.log") == 0
+    assert not os.path.exists(f"{path}.tmp")
+
+    store.put(MessageNode(2, "assistant", "Hello!", now, parent_id=1))
+    assert os.path.getsize(f"{path}.log") > 0
+    store.save()
+    assert os.path.getsize(f"{path}.log") == 0
+    store.close()
+    assert ids(DictMessageStore(path, fsync=False).chain(2)) == [1, 2]
+
+
+def test_failed_save_keeps_the_previous_snapshot_and_the_log(tmp_path, monkeypatch):
+    path = str(tmp_path / "history.json")
+    now = time.time()
+    store = DictMessageStore(path, fsync=False)
+    store.put(MessageNode(1, "user", "Alice: hi", now))
+    store.save()
+    store.put(MessageNode(2, "assistant", "Hello!", now, parent_id=1))
+
+    def crash(source, destination):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(OSError):
+        store.save()
+    monkeypatch.undo()
+    store.close()
+
+    assert os.path.getsize(f"{path}.log") > 0
+    reloaded = DictMessageStore(path, fsync=False)
+    assert ids(reloaded.chain(2)) == [1, 2]
+
+
+def test_torn_final_log_record_is_skipped(tmp_path):
+    path = str(tmp_path / "history.json")
+    store = DictMessageStore(path, fsync=False)
+    store.put(MessageNode(1, "user", "Alice: hi", time.time()))
+    store.close()
+    with open(f"{path}.log", "a", encoding="utf-8") as log:
+        log.write('{"op": "add", "node": {"message_id": 2')
+
+    reloaded = DictMessageStore(path, fsync=False)
+    assert ids(reloaded.chain(1)) == [1] and len(reloaded) == 1
+
+
+def test_sqlite_chain_keeps_integer_and_string_ids(tmp_path):
+    path = str(tmp_path / "messages.db")
+    now = time.time()
+    store = SQLiteMessageStore(path, cache_size=2)
+    store.put(MessageNode("1_system", "system", "You are a helpful bot.", now))
+    store.put(MessageNode(1, "user", "Alice: what's 2^64?", now, parent_id="1_system"))
+    store.put(MessageNode(2, "assistant", "", now, parent_id=1, tool_call='[{"id": "call_1"}]'))
+    store.put(MessageNode("call_1", "tool", "18446744073709551616", now, parent_id=2, tool_call="call_1"))
+    store.put(MessageNode(3, "assistant", "It is 18446744073709551616.", now, parent_id="call_1"))
+    store.put(MessageNode(4, "user", "Bob: unrelated", now))
+    assert ids(store.chain(3)) == ["1_system", 1, 2, "call_1", 3]
+    store.close()
+
+    # Read back from the database rather than the cache
+    reopened = SQLiteMessageStore(path, cache_size=2)
+    chain = reopened.chain(3)
+    assert ids(chain) == ["1_system", 1, 2, "call_1", 3]
+    assert [node.parent_id for node in chain] == [None, "1_system", 1, 2, "call_1"]
+    assert chain[3].tool_call == "call_1"
+    assert reopened.chain(5) == []
+    reopened.close()
+
+
+def test_sqlite_delete_older_than_evicts_the_cache(tmp_path):
+    now = time.time()
+    store = SQLiteMessageStore(str(tmp_path / "messages.db"))
+    store.put(MessageNode("1_system", "system", "You are a helpful bot.", now - 20))
+    store.put(MessageNode(1, "user", "Alice: hi", now - 10, parent_id="1_system"))
+    store.put(MessageNode(2, "assistant", "Hello!", now, parent_id=1))
+    assert store.get(1) is not None
+
+    assert sorted(store.delete_older_than(now - 5), key=str) == [1, "1_system"]
+    assert store.get(1) is None and store.get("1_system") is None
+    assert 1 not in store.cache and len(store) == 1
+    assert ids(store.chain(2)) == [2]
+    store.close()
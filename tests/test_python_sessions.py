@@ -0,0 +1,28 @@
+import os
+import tempfile
+
+import PythonForkServer
+from PythonSessionManager import PythonSessionManager
+
+
+def test_session_id_of_system_root_is_accepted(monkeypatch):
+    # A conversation started by a mention has the system prompt "<id>_system" as its root.
+    # Not pytest's tmp_path, which is too long for a socket path.
+    monkeypatch.setattr(PythonForkServer, "SESSION_DIRECTORY", tempfile.mkdtemp(dir="/tmp"))
+    assert "error" in PythonForkServer.start_session({"session": "123_system"}, close_fds=())
+
+    session_id = PythonSessionManager.session_id_for("123_system")
+    response = PythonForkServer.start_session(
+        {"session": session_id, "idle_timeout": 5, "memory_limit": 256 * 1024 * 1024}, close_fds=())
+    try:
+        assert "error" not in response
+        assert os.path.exists(PythonForkServer.session_paths(session_id)[0])
+    finally:
+        PythonForkServer.close_session(session_id)
+        os.waitpid(response["pid"], 0)
+
+
+def test_session_id_is_stable_per_conversation():
+    assert PythonSessionManager.session_id_for("123_system") == PythonSessionManager.session_id_for("123_system")
+    assert PythonSessionManager.session_id_for("123_system") != PythonSessionManager.session_id_for(123)
+    assert PythonSessionManager.session_id_for(123).isalnum()
@@ -0,0 +1,29 @@
+import asyncio
+
+from RequestCoalescer import RequestCoalescer
+
+
+def test_message_after_commit_is_handled_on_its_own():
+    calls = []
+    delivered = []
+
+    async def main():
+        async def handler(items):
+            calls.append(list(items))
+            await asyncio.sleep(0.2)
+            coalescer.commit()
+            await asyncio.shield(asyncio.sleep(0.3))
+            delivered.append(list(items))
+
+        coalescer = RequestCoalescer(handler, window=0.05)
+        coalescer.submit("thread", 1)
+        await asyncio.sleep(0.1)
+        coalescer.submit("thread", 2)  # Before the commit, the call is redone with both messages
+        await asyncio.sleep(0.3)
+        coalescer.submit("thread", 3)  # After the commit, only the new message is handled again
+        await asyncio.sleep(1.0)
+        assert not coalescer.threads and not coalescer.delivering
+
+    asyncio.run(main())
+    assert calls == [[1], [1, 2], [3]]
+    assert delivered == [[1, 2], [3]]
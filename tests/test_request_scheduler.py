@@ -0,0 +1,171 @@
+import asyncio
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+import RequestScheduler as scheduler_module
+from RequestScheduler import RequestScheduler, TokenBucket, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(scheduler_module, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Records the backoffs instead of sleeping, with the jitter at its upper bound."""
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(scheduler_module.asyncio, "sleep", sleep)
+    monkeypatch.setattr(scheduler_module, "random", SimpleNamespace(uniform=lambda low, high: high))
+    return delays
+
+
+def status_error(error_type, status_code, headers=None):
+    response = SimpleNamespace(status_code=status_code, headers=headers or {}, request=None)
+    return error_type("error", response=response, body=None)
+
+
+def failing_call(errors, result="ok"):
+    """An async callable that raises the given errors one per attempt, then returns result."""
+    attempts = []
+
+    async def call():
+        attempts.append(len(attempts))
+        if len(attempts) <= len(errors):
+            raise errors[len(attempts) - 1]
+        return result
+
+    return call, attempts
+
+
+def test_token_bucket_refills_at_its_rate_up_to_its_capacity(clock):
+    bucket = TokenBucket(60)
+    assert bucket.time_until(60) == 0.0
+    bucket.consume(60)
+    assert bucket.time_until(1) == 1.0
+    clock.now += 0.5
+    assert bucket.time_until(1) == 0.5
+    clock.now += 1000
+    assert bucket.time_until(60) == 0.0
+    assert bucket.time_until(100) == 0.0  # Never asks for more than the capacity
+    bucket.consume(61)
+    assert bucket.time_until(1) == 2.0
+    bucket.drain()
+    assert bucket.level == -1
+
+
+def test_requests_wait_for_the_bucket_to_refill(clock):
+    async def main():
+        scheduler = RequestScheduler(requests_per_minute=2)
+        await scheduler.acquire(0)
+        await scheduler.acquire(0)
+        waiting = asyncio.create_task(scheduler.acquire(0))
+        await asyncio.sleep(0)
+        scheduler.release()
+        assert not waiting.done() and scheduler.wakeup is not None
+        clock.now += 30  # A request's worth of refill
+        scheduler.wakeup.cancel()
+        scheduler.wake()
+        await asyncio.sleep(0)
+        assert waiting.done() and scheduler.in_flight == 2
+
+    asyncio.run(main())
+
+
+def admission_order(requests):
+    """
+    Queue requests behind one holding the only slot, then let them through one at a time.
+    :param requests: (name, priority, user ID, channel ID) tuples, in the order they are queued.
+    :return: The names in the order they were admitted.
+    """
+    order = []
+
+    async def request(name, priority, user_id, channel_id):
+        await scheduler.acquire(0, priority, user_id, channel_id)
+        order.append(name)
+        scheduler.release()
+
+    async def main():
+        await scheduler.acquire(0)
+        tasks = []
+        for args in requests:
+            tasks.append(asyncio.create_task(request(*args)))
+            await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+
+    scheduler = RequestScheduler(max_concurrent_requests=1)
+    asyncio.run(main())
+    return order
+
+
+def test_mentions_go_ahead_of_replies_and_background_work():
+    order = admission_order([
+        ("background", PRIORITY_LOW, 1, 1),
+        ("reply", PRIORITY_NORMAL, 2, 1),
+        ("mention", PRIORITY_HIGH, 3, 1),
+        ("second reply", PRIORITY_NORMAL, 4, 2),
+    ])
+    assert order == ["mention", "reply", "second reply", "background"]
+
+
+def test_channels_and_users_take_turns():
+    order = admission_order([
+        ("a1", PRIORITY_NORMAL, "a", 1),
+        ("a2", PRIORITY_NORMAL, "a", 1),
+        ("a3", PRIORITY_NORMAL, "a", 1),
+        ("b1", PRIORITY_NORMAL, "b", 1),
+        ("c1", PRIORITY_NORMAL, "c", 2),
+    ])
+    assert order == ["a1", "c1", "b1", "a2", "a3"]
+
+
+def test_rate_limit_and_server_errors_are_retried_with_backoff(sleeps):
+    scheduler = RequestScheduler(base_backoff=1.0, max_backoff=3.0)
+    call, attempts = failing_call([
+        status_error(openai.InternalServerError, 503),
+        status_error(openai.InternalServerError, 500),
+        openai.APIConnectionError(request=None),
+        status_error(openai.RateLimitError, 429, {"retry-after": "5"}),
+    ])
+    assert asyncio.run(scheduler.run(call)) == "ok"
+    assert len(attempts) == 5
+    # Doubling from the base backoff up to the maximum, or longer if the server asks for it
+    assert sleeps == [1.0, 2.0, 3.0, 5.0]
+    assert scheduler.in_flight == 0
+
+
+def test_other_errors_are_not_retried(sleeps):
+    scheduler = RequestScheduler()
+    call, attempts = failing_call([status_error(openai.BadRequestError, 400)])
+    with pytest.raises(openai.BadRequestError):
+        asyncio.run(scheduler.run(call))
+    assert len(attempts) == 1 and not sleeps
+    assert scheduler.in_flight == 0
+
+
+def test_retries_give_up_after_max_retries(sleeps):
+    scheduler = RequestScheduler(max_retries=2)
+    call, attempts = failing_call([status_error(openai.InternalServerError, 502)] * 3)
+    with pytest.raises(openai.InternalServerError):
+        asyncio.run(scheduler.run(call))
+    assert len(attempts) == 3 and len(sleeps) == 2
@@ -0,0 +1,27 @@
+from ResponseCache import ResponseCache
+
+
+def chain(question):
+    return [{"role": "system", "content": "You are a helpful bot."}, {"role": "user", "content": question}]
+
+
+def test_same_question_from_different_users_shares_an_entry():
+    cache = ResponseCache()
+    alice, bob = chain("Alice: what's 2^64?"), chain("Bob: what's 2^64?")
+    assert cache.is_cacheable(alice)
+    cache.put(cache.make_key("gpt-4o", [], alice), "18446744073709551616")
+    assert cache.get(cache.make_key("gpt-4o", [], bob)) == "18446744073709551616"
+    assert cache.make_key("gpt-4o", [], chain("Bob: what's 2^63?")) != cache.make_key("gpt-4o", [], bob)
+
+
+def test_responses_addressing_the_asker_are_recognised():
+    cache = ResponseCache()
+    assert cache.mentions_speaker(chain("Alice: hi"), "Hello alice!")
+    assert not cache.mentions_speaker(chain("Alice: hi"), "Hello!")
+    assert not cache.mentions_speaker(chain("no speaker here"), "Hello no speaker here")
+
+
+def test_only_a_prompt_and_a_single_question_are_cached():
+    cache = ResponseCache()
+    assert cache.is_cacheable(chain("Alice: what's 2^64?"))
+    assert not cache.is_cacheable(chain("Alice: what's 2^64?") + [{"role": "user", "content": "Alice: and 2^65?"}])
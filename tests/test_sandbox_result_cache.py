@@ -0,0 +1,25 @@
+from SandboxResultCache import SandboxResultCache
+from SubprocessPythonExecutor import SubprocessPythonExecutor
+
+
+def make_executor(tmp_path):
+    cache = SandboxResultCache(str(tmp_path / "cache"))
+    return SubprocessPythonExecutor(timeout=10, max_output_bytes=4096, result_cache=cache), cache
+
+
+def test_run_is_cached(tmp_path):
+    executor, cache = make_executor(tmp_path)
+    assert executor.run_code("print(6 * 7)")[0].text() == "42\n"
+    assert executor.run_code("print(6 * 7)")[0].text() == "42\n"
+    assert cache.stats()["hits"] == 1
+
+
+def test_run_cut_off_for_flooding_stderr_is_not_cached(tmp_path):
+    executor, cache = make_executor(tmp_path)
+    code = "import warnings\nprint('start', flush=True)\nfor i in range(100000):\n    warnings.warn(f'warning {i}')"
+    output, error = executor.run_code(code)
+    assert error is None and output.text() == "start\n"
+    assert executor.usage.exit_reason == "output_limit"
+    executor.run_code(code)
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["entries"] == 0
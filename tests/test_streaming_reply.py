@@ -0,0 +1,37 @@
+import asyncio
+
+from StreamingReply import StreamingReply
+
+
+class FakeMessage:
+    def __init__(self, content="", replies=None):
+        self.content = content
+        self.deleted = False
+        self.replies = replies if replies is not None else []
+
+    async def reply(self, content):
+        sent = FakeMessage(content, self.replies)
+        self.replies.append(sent)
+        return sent
+
+    async def edit(self, content):
+        self.content = content
+
+    async def delete(self):
+        self.deleted = True
+
+
+def test_retry_with_shorter_text_removes_surplus_replies():
+    original = FakeMessage()
+
+    async def main():
+        reply = StreamingReply(original, edit_interval=0)
+        await reply.start()
+        await reply.update("a" * 4500)  # Three parts
+        # The stream was retried and the final text fits in one message
+        return await reply.finish("b" * 100)
+
+    parts = asyncio.run(main())
+    assert [part for _, part in parts] == ["b" * 100]
+    assert parts[0][0].content == "b" * 100
+    assert [sent.deleted for sent in original.replies] == [False, True, True]
@@ -0,0 +1,42 @@
+import os
+
+import pytest
+
+import SubprocessPythonExecutor as subprocess_sandbox
+from SubprocessPythonExecutor import SubprocessPythonExecutor, FILESYSTEM_ISOLATION_UNAVAILABLE
+
+
+def isolated_executor():
+    executor = SubprocessPythonExecutor(timeout=10)
+    if executor.unshare_command() is None:
+        pytest.skip("unshare and user namespaces are not available")
+    return executor
+
+
+def test_code_cannot_read_the_bots_files(tmp_path):
+    executor = isolated_executor()
+    secrets = tmp_path / "secrets.json"
+    secrets.write_text('{"token": "secret"}')
+    code = "\n".join(
+        f"try:\n    open({path!r}).read()\n    print('read')\nexcept FileNotFoundError:\n    print('hidden')"
+        for path in [str(secrets), os.path.abspath(subprocess_sandbox.__file__), "/etc/passwd"]
+    )
+    output, error = executor.run_code(code)
+    assert error is None
+    assert output.text() == "hidden\nhidden\nhidden\n"
+
+
+def test_code_can_only_write_its_own_directory():
+    executor = isolated_executor()
+    code = ("import os\nopen('/tmp/result.txt', 'w').write('42')\nprint(os.getcwd(), os.listdir('.'))\n"
+            "try:\n    open('/usr/result.txt', 'w')\nexcept OSError:\n    print('read-only')")
+    output, error = executor.run_code(code)
+    assert error is None
+    assert output.text() == "/tmp ['result.txt']\nread-only\n"
+
+
+def test_refuses_to_run_without_filesystem_isolation(monkeypatch):
+    monkeypatch.setattr(SubprocessPythonExecutor, "unshare_command", lambda self: None)
+    assert SubprocessPythonExecutor().run_code("print(1)") == (None, FILESYSTEM_ISOLATION_UNAVAILABLE)
+    output, error = SubprocessPythonExecutor(isolate_filesystem=False).run_code("print(1)")
+    assert error is None and output.text() == "1\n"
@@ -0,0 +1,30 @@
+import re
+
+from TimerTool import timer_notifications
+
+
+def timer(user_id, channel_id, name):
+    return {"id": user_id, "user_id": user_id, "channel_id": channel_id, "name": name,
+            "expire_time": "2024-01-01T00:00:00"}
+
+
+def test_timers_are_grouped_per_channel():
+    notifications = timer_notifications([timer(1, 10, "raid"), timer(2, 10, "raid"), timer(3, 10, "tea"),
+                                         timer(4, 20, "raid")])
+    assert notifications == {
+        10: ["<@1> <@2> :alarm_clock:: 'raid'\n<@3> :alarm_clock:: 'tea'"],
+        20: ["<@4> :alarm_clock:: 'raid'"],
+    }
+
+
+def test_timer_without_a_name():
+    assert timer_notifications([timer(1, 10, None), timer(2, 10, "tea")]) == {
+        10: ["<@1> :alarm_clock:: 'None'\n<@2> :alarm_clock:: 'tea'"],
+    }
+
+
+def test_long_notifications_are_split_between_mentions():
+    messages = timer_notifications([timer(10 ** 17 + i, 10, "event") for i in range(300)])[10]
+    assert len(messages) > 1
+    assert all(len(message) <= 2000 for message in messages)
+    assert len(re.findall(r"<@\d+>", "".join(messages))) == 300